@@ -10,6 +10,31 @@ FieldParams = namedtuple(
     ('width', 'height', 'mines_count')
 )
 
+CellChange = namedtuple(
+    'CellChange',
+    ('position', 'status', 'number')
+)
+CellChange.__doc__ = """
+Изменение ячейки после действий игрока:
+новый статус (cells.CellStatus) и число мин
+вокруг, если ячейка открыта (иначе None).
+"""
+
+GameRecord = namedtuple(
+    'GameRecord',
+    ('level', 'geometry', 'width', 'height', 'mines_count', 'seed',
+     'won', 'elapsed', 'moves', 'bbbv', 'player', 'finished')
+)
+GameRecord.__doc__ = """
+Результат законченной игры: уровень
+(game_managers.LevelEnum), геометрия и
+параметры поля, зерно, выигрыш, время игры в
+секундах, количество ходов, 3BV (None, если
+не посчитан), кто играл ('human' или имя
+стратегии симуляции) и время окончания по
+time.time().
+"""
+
 
 class SingletonAbcMeta(ABCMeta):
     __instances = {}
@@ -0,0 +1,257 @@
+"""
+Бенчмарки ядра игры. Работают без Tk: поле
+рисуется в NullRenderContext.
+
+Пример запуска:
+
+    python benchmarks.py --output bench.json
+    python benchmarks.py --scenarios rookie warrior --repeat 5
+
+Результаты пишутся в JSON, чтобы их можно было
+сравнивать между коммитами.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from api import FieldParams
+from cells import CellStatus
+from game_managers import GameManager, LevelEnum
+from renderers import NullRenderContext
+from saves import load_game, write_snapshot
+
+
+SCENARIOS = OrderedDict((
+    ('rookie', (LevelEnum.ROOKIE, None, 'rectangle')),
+    ('veteran', (LevelEnum.VETERAN, None, 'rectangle')),
+    ('warrior', (LevelEnum.WARRIOR, None, 'rectangle')),
+    ('1000x1000', (
+        LevelEnum.CUSTOM, FieldParams(1000, 1000, 150000), 'rectangle')),
+    ('5000x5000', (
+        LevelEnum.CUSTOM, FieldParams(5000, 5000, 3750000), 'rectangle')),
+    ('hex-warrior', (LevelEnum.WARRIOR, None, 'hexagonal')),
+    ('hex-1000x1000', (
+        LevelEnum.CUSTOM, FieldParams(1000, 1000, 150000), 'hexagonal')),
+))
+
+# Количество ячеек, по которым делаются
+# аккорды (клик средней кнопкой).
+CHORDS_COUNT = 100
+
+# Модули ядра игры, которые должны
+# импортироваться без GUI-зависимостей,
+# бюджет времени на их холодный импорт
+# (в секундах) и запрещённые при этом модули.
+CORE_MODULES = ('api', 'cells', 'fields', 'game_managers')
+IMPORT_BUDGET = 0.1
+GUI_MODULES = ('tkinter', 'PIL')
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join(name for name in {gui_modules!r} if name in sys.modules))
+'''
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def prepare_chords(field, count):
+    """
+    Выбирает открытые числовые ячейки, вокруг
+    которых есть закрытые безопасные ячейки, и
+    ставит флаги на всех соседних минах, чтобы
+    аккорд по ним сработал.
+    """
+    state = field.state
+    chords = []
+    for idx in range(field.cell_count):
+        if len(chords) == count:
+            break
+        if (state.statuses[idx] != CellStatus.NUMBER
+                or state.mined_around[idx] == 0):
+            continue
+        neighbors = field.get_neighbors(idx)
+        if not any(state.statuses[i] == CellStatus.CLOSED
+                   and not state.mines[i] for i in neighbors):
+            continue
+        for i in neighbors:
+            if state.mines[i] and state.statuses[i] == CellStatus.CLOSED:
+                field.get_cell(i).right_button_click(i)
+        chords.append(idx)
+    return chords
+
+
+def run_scenario(level, custom_params, seed, geometry='rectangle'):
+    """
+    Прогоняет одну игру и возвращает время
+    каждой фазы в секундах.
+    """
+    manager = GameManager()
+    manager.geometry = geometry
+    manager.set_render_context(NullRenderContext())
+    results = OrderedDict()
+
+    results['new_game'], _ = timed(
+        manager.new_game, level, custom_params, seed)
+    field = manager.field
+    field.invalidate()
+    results['full_render'], _ = timed(field.render)
+
+    safe_idx = field.cell_count // 2 + field.width // 2
+    safe_position = field.get_position_by_idx(safe_idx)
+    results['generate'], _ = timed(field.generate, safe_position)
+    results['first_click'], _ = timed(
+        field.get_cell(safe_idx).left_button_click, safe_idx)
+    results['cells_opened'] = manager.safe_opened_count
+    results['incremental_render'], _ = timed(field.render)
+
+    chords = prepare_chords(field, CHORDS_COUNT)
+    field.render()
+
+    def chord_all():
+        for idx in chords:
+            field.get_cell(idx).middle_button_click(idx)
+    results['chords'], _ = timed(chord_all)
+    results['chords_count'] = len(chords)
+    results['chords_render'], _ = timed(field.render)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'game.sav')
+        results['save'], _ = timed(write_snapshot, manager, path)
+        # Загрузка без контекста рисования: её время
+        # не должно зависеть от отрисовки.
+        results['load'], _ = timed(load_game, GameManager(), path)
+
+    if manager.game_active:
+        results['finish_game'], _ = timed(manager.finish_game, False)
+    else:
+        results['finish_game'] = 0.0
+    return results
+
+
+def measure_import(repeat):
+    """
+    Замеряет холодный импорт ядра в отдельных
+    процессах. Возвращает минимальное время и
+    GUI-модули, которые оказались загружены.
+    """
+    script = IMPORT_SCRIPT.format(
+        modules=CORE_MODULES, gui_modules=GUI_MODULES)
+    times = []
+    gui_modules = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            (sys.executable, '-c', script),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True,
+        ).split('\n')
+        times.append(float(output[0]))
+        gui_modules = output[1].split()
+    return min(times), gui_modules
+
+
+def aggregate(runs):
+    """
+    Берёт минимум по повторам: он меньше всего
+    зависит от шума системы.
+    """
+    return OrderedDict(
+        (key, min(run[key] for run in runs))
+        for key in runs[0]
+    )
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки ядра игры')
+    parser.add_argument(
+        '--scenarios', nargs='+', choices=tuple(SCENARIOS),
+        default=tuple(SCENARIOS), help='какие сценарии запускать')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='количество повторов')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='зерно генератора мин')
+    parser.add_argument(
+        '--output', help='файл для результатов в формате JSON')
+    parser.add_argument(
+        '--import-budget', type=float, default=IMPORT_BUDGET,
+        help='допустимое время импорта ядра, с')
+    args = parser.parse_args(argv)
+
+    report = OrderedDict((
+        ('commit', get_commit()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('repeat', args.repeat),
+        ('seed', args.seed),
+        ('scenarios', OrderedDict()),
+    ))
+
+    import_time, gui_modules = measure_import(args.repeat)
+    report['import'] = OrderedDict((
+        ('time', import_time),
+        ('budget', args.import_budget),
+        ('gui_modules', gui_modules),
+    ))
+    print('import: time={:.4f}, budget={:.4f}, gui_modules={}'.format(
+        import_time, args.import_budget, ','.join(gui_modules) or '-'))
+
+    for name in args.scenarios:
+        level, custom_params, geometry = SCENARIOS[name]
+        runs = [
+            run_scenario(level, custom_params, args.seed, geometry)
+            for _ in range(args.repeat)
+        ]
+        result = aggregate(runs)
+        report['scenarios'][name] = result
+        print('{}: {}'.format(name, ', '.join(
+            '{}={:.4f}'.format(key, value)
+            if isinstance(value, float) else
+            '{}={}'.format(key, value)
+            for key, value in result.items()
+        )))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    return report
+
+
+def check_import(report):
+    """
+    Возвращает код выхода: 1, если импорт ядра
+    не уложился в бюджет или потянул за собой GUI.
+    """
+    result = report['import']
+    if result['gui_modules'] or result['time'] > result['budget']:
+        print('Импорт ядра игры не уложился в бюджет!')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(check_import(main(sys.argv[1:])))
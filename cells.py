@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod
+from array import array
 from enum import IntEnum, auto
 
 
@@ -12,7 +13,54 @@ class CellStatus(IntEnum):
     NUMBER = auto()
 
 
+class FieldState:
+    """
+    Состояние всех ячеек поля, хранящееся
+    покомпонентно в компактных массивах:
+    по одному байту на ячейку в каждом из
+    массивов mines, statuses и mined_around.
+
+    Ячейка здесь -- это просто индекс в
+    этих массивах.
+    """
+    def __init__(self, cell_count):
+        self.cell_count = cell_count
+
+        # Карта мин: 1 -- в ячейке мина, 0 -- нет.
+        self.mines = bytearray(cell_count)
+
+        # Значения CellStatus. В теории пользователь
+        # прежде чем открыть какую-либо ячейку
+        # может поставить сколь угодно флагов,
+        # поэтому статусы создаются вместе с
+        # фейковым полем и переживают генерацию.
+        self.statuses = bytearray((CellStatus.CLOSED,)) * cell_count
+
+        # Количество мин вокруг каждой ячейки.
+        # Заполняется при генерации поля.
+        self.mined_around = bytearray(cell_count)
+
+        # Количество соседей, помеченных флагом.
+        # Поддерживается при каждой смене статуса
+        # (см. AbstractField.set_status), поэтому
+        # аккорд проверяется за O(1).
+        self.flagged_around = bytearray(cell_count)
+
+        # Номер области нулевых ячеек ("opening"),
+        # к которой принадлежит ячейка, или -1.
+        self.opening_ids = array('i', (-1,)) * cell_count
+
+        # Истинно, если мины уже расставлены.
+        self.generated = False
+
+
 class Cell(metaclass=ABCMeta):
+    """
+    Поведение ячеек одного типа. Экземпляр
+    создаётся один на поле и тип ячейки, а
+    все операции принимают индекс ячейки в
+    FieldState.
+    """
     marked_statuses = (
         CellStatus.MARKED_BY_FLAG,
         CellStatus.MARKED_BY_QUESTION,
@@ -24,50 +72,40 @@ class Cell(metaclass=ABCMeta):
     )
     closed_statuses_count = len(closed_statuses)
 
-    def __init__(self,
-                 position,
-                 field,
-                 game_manager,
-                 status=CellStatus.CLOSED):
+    def __init__(self, field, game_manager):
         """
 
         :param field:
-        :param position:
-        :param status: В теории пользователь
-            прежде чем открыть какую-либо ячейку
-            может поставить сколь угодно флагов.
-            Поэтому при создании нормального поля
-            из фейкового, нужно переносить статус
-            ячеек.
+        :param game_manager:
         """
         self.field = field
         self.game_manager = game_manager
-        self.position = position
-        self.status = status
-        try:
-            self.status_idx = self.closed_statuses.index(status)
-        except ValueError:
-            raise ValueError(
-                'Передан неверный аргумент: status={}!'.format(status))
 
     @abstractmethod
-    def set_final_status(self, user_won):
-        pass
+    def get_final_status(self, idx, status):
+        """
+        Возвращает статус, который ячейка со
+        статусом status показывает после окончания
+        игры.
+        """
 
     @abstractmethod
-    def left_button_click(self):
+    def left_button_click(self, idx):
         pass
 
-    def right_button_click(self):
-        if self.status not in self.closed_statuses:
+    def right_button_click(self, idx):
+        status = self.field.state.statuses[idx]
+        if status not in self.closed_statuses:
             return
 
-        was_marked = self.status in self.marked_statuses
+        was_marked = status in self.marked_statuses
 
-        self.status_idx = (self.status_idx+1) % self.closed_statuses_count
-        self.status = self.closed_statuses[self.status_idx]
+        status_idx = self.closed_statuses.index(status)
+        status_idx = (status_idx+1) % self.closed_statuses_count
+        status = self.closed_statuses[status_idx]
+        self.field.set_status(idx, status)
 
-        become_marked = self.status in self.marked_statuses
+        become_marked = status in self.marked_statuses
 
         if was_marked and not become_marked:
             self.game_manager.add_mark(-1)
@@ -75,7 +113,7 @@ class Cell(metaclass=ABCMeta):
             self.game_manager.add_mark(1)
 
     @abstractmethod
-    def middle_button_click(self):
+    def middle_button_click(self, idx):
         pass
 
     @abstractmethod
@@ -84,20 +122,24 @@ class Cell(metaclass=ABCMeta):
 
 
 class MinedCell(Cell):
-    def set_final_status(self, user_won):
-        if self.status in (CellStatus.CLOSED, CellStatus.MARKED_BY_QUESTION):
-            self.status = (
+    def get_final_status(self, idx, status):
+        if self.game_manager.detonated:
+            # Время обратного отсчёта истекло.
+            return CellStatus.ACTIVE_MINE
+        if status in (CellStatus.CLOSED, CellStatus.MARKED_BY_QUESTION):
+            return (
                 CellStatus.MARKED_BY_FLAG
-                if user_won else
+                if self.game_manager.user_won else
                 CellStatus.PASSIVE_MINE
             )
+        return status
 
-    def left_button_click(self):
-        if self.status == CellStatus.CLOSED:
-            self.status = CellStatus.ACTIVE_MINE
+    def left_button_click(self, idx):
+        if self.field.state.statuses[idx] == CellStatus.CLOSED:
+            self.field.set_status(idx, CellStatus.ACTIVE_MINE)
             self.game_manager.mined_cell_opened()
 
-    def middle_button_click(self):
+    def middle_button_click(self, idx):
         pass
 
     def is_danger(self):
@@ -105,70 +147,52 @@ class MinedCell(Cell):
 
 
 class SafeCell(Cell):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        # Количество мин вокруг ячейки.
-        # Вычисляется в момент открытия ячейки.
-        # Обусловлено тем, что в момент создания
-        # ячейки ещё могут быть не созданы
-        # остальные ячейки на поле.
-        self.mined_around = None
-        self.neighbors = None
-
-    def set_final_status(self, user_won):
-        if self.status == CellStatus.CLOSED:
-            self.status = CellStatus.NUMBER
-            self.set_mined_around()
-        elif self.status in self.marked_statuses:
-            self.status = CellStatus.FALSE_MINE
-
-    def left_button_click(self):
-        if self.status != CellStatus.CLOSED:
+    def get_final_status(self, idx, status):
+        if status == CellStatus.CLOSED:
+            return CellStatus.NUMBER
+        if status in self.marked_statuses:
+            return CellStatus.FALSE_MINE
+        return status
+
+    def left_button_click(self, idx):
+        self.field.reveal((idx,))
+
+    def middle_button_click(self, idx):
+        state = self.field.state
+        if state.statuses[idx] != CellStatus.NUMBER:
             return
 
-        self.status = CellStatus.NUMBER
-        self.set_mined_around()
-        self.game_manager.safe_cell_opened()
-
-        if self.mined_around == 0:
-            for cell in self.neighbors:
-                cell.left_button_click()
-
-    def middle_button_click(self):
-        if self.status != CellStatus.NUMBER:
+        if self.field.get_flagged_around(idx) != state.mined_around[idx]:
             return
 
-        neighbors = self.field.get_neighbors(self.position)
-        marked_around = sum((
-            1 for cell in neighbors
-            if cell.status == CellStatus.MARKED_BY_FLAG
-        ))
-
-        if marked_around == self.mined_around:
-            for cell in neighbors:
-                cell.left_button_click()
+        neighbors = self.field.get_neighbors(idx)
+        closed_neighbors = tuple(
+            i for i in neighbors
+            if state.statuses[i] == CellStatus.CLOSED
+        )
+        for i in closed_neighbors:
+            if state.mines[i]:
+                self.field.get_cell(i).left_button_click(i)
+                return
+        self.field.reveal(closed_neighbors)
 
     def is_danger(self):
         return False
 
-    def set_mined_around(self):
-        self.neighbors = self.field.get_neighbors(self.position)
-        self.mined_around = sum(1 for cell in self.neighbors if cell.is_danger())
-
 
 class FakeCell(Cell):
-    def left_button_click(self):
-        self.field.generate(self.position)
+    def left_button_click(self, idx):
+        self.field.generate(self.field.get_position_by_idx(idx))
+        self.field.get_cell(idx).left_button_click(idx)
 
-    def middle_button_click(self):
+    def middle_button_click(self, idx):
         pass
 
     def is_danger(self):
         pass
 
-    def set_final_status(self, user_won):
-        pass
+    def get_final_status(self, idx, status):
+        return status
 
 
 _cell_types_map = dict(
@@ -178,7 +202,6 @@ _cell_types_map = dict(
 )
 
 
-def cell_fabric(
-        type_, position, field, game_manager, status=CellStatus.CLOSED):
+def cell_fabric(type_, field, game_manager):
     assert type_ in _cell_types_map, 'Incorrect cell-type "{}"!'.format(type_)
-    return _cell_types_map[type_](position, field, game_manager, status)
+    return _cell_types_map[type_](field, game_manager)
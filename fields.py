@@ -1,20 +1,234 @@
-from random import randrange
+from random import Random, randrange
 from abc import ABCMeta, abstractmethod
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from importlib import import_module
+from itertools import repeat
+from operator import add
 
 from api import abs_sub
-from cells import FakeCell, cell_fabric
-from renderers import RectangleRenderer
-from functools import partial
+from cells import Cell, CellStatus, FieldState, cell_fabric
+from tilings import build_voronoi_tiling, find_cell
+
+
+Adjacency = namedtuple('Adjacency', ('offsets', 'neighbors'))
+
+# Рендереры полей: класс поля -> путь к классу
+# рендерера вида 'модуль.Класс'. Модуль
+# импортируется только при подключении контекста
+# рисования, поэтому ядро игры не зависит от Tk
+# и Pillow.
+_renderers_map = {}
+
+
+def register_renderer(field_type, renderer_path):
+    _renderers_map[field_type] = renderer_path
+
+
+def get_renderer_type(field_type):
+    """
+    Возвращает класс рендерера поля field_type
+    или ближайшего из его предков.
+    """
+    for type_ in field_type.__mro__:
+        if type_ in _renderers_map:
+            module_name, _, class_name = (
+                _renderers_map[type_].rpartition('.'))
+            return getattr(import_module(module_name), class_name)
+    assert False, 'Renderer for "{}" is not registered!'.format(
+        field_type.__name__)
+
+
+@lru_cache(maxsize=4)
+def get_adjacency(field_type, width, height):
+    """
+    Возвращает таблицу соседства поля. Таблица
+    зависит только от геометрии и размеров поля,
+    поэтому кэшируется и переиспользуется новыми
+    играми того же уровня.
+
+    :param field_type: класс поля
+    """
+    return field_type.build_adjacency(width, height)
+
+
+def build_row_adjacency(compute_neighbors, width, height, period=1):
+    """
+    Строит ту же таблицу, что и
+    AbstractField.build_adjacency, но строками,
+    для полей, ячейки которых хранятся построчно.
+    Соседи всех ячеек строки отличаются от соседей
+    строки того же типа только сдвигом индексов, а
+    сдвиг применяется через map на C. Тип строки --
+    есть ли строки выше и ниже неё и её номер по
+    модулю period (для шестиугольного поля чётные
+    и нечётные строки устроены по-разному).
+
+    :param compute_neighbors: функция
+        compute_neighbors(width, height, idx) поля
+    """
+    row_patterns = {}
+
+    def get_row_pattern(row):
+        key = (row > 0, row < height - 1, row % period)
+        if key not in row_patterns:
+            # Шаблон строится для строки того же типа
+            # на маленьком поле и переносится на
+            # нулевую строку.
+            pattern_row = key[2]
+            if key[0] and not pattern_row:
+                pattern_row = period
+            base = pattern_row * width
+            pattern = array('i')
+            degrees = array('i')
+            for column in range(width):
+                cell_neighbors = compute_neighbors(
+                    width, pattern_row + 1 + key[1], base + column)
+                pattern.extend(idx - base for idx in cell_neighbors)
+                degrees.append(len(pattern))
+            row_patterns[key] = (pattern, degrees)
+        return row_patterns[key]
+
+    offsets = array('i', (0,))
+    neighbors = array('i')
+    for row in range(height):
+        pattern, degrees = get_row_pattern(row)
+        offsets.extend(map(add, degrees, repeat(len(neighbors))))
+        neighbors.extend(map(add, pattern, repeat(row * width)))
+    return Adjacency(offsets, neighbors)
+
+
+def count_mines_around(mines, width, height):
+    """
+    Считает количество мин вокруг всех ячеек
+    прямоугольной карты мин за один проход,
+    суммируя её сдвинутые копии.
+
+    Карта мин упаковывается в одно длинное
+    целое, по байту на ячейку, с нулевым
+    столбцом-разделителем после каждой строки.
+    Сдвиг на байт даёт соседа по строке, сдвиг
+    на строку -- соседа по столбцу. Сумма в
+    каждом байте не превышает 9, поэтому
+    переносов между ячейками не возникает, а
+    сама арифметика длинных целых выполняется
+    на C. Для ячеек с минами результат не
+    используется.
+
+    :param mines: карта мин, по байту на ячейку
+    :return: bytearray с количеством мин вокруг
+        каждой ячейки
+    """
+    stride = width + 1
+    padded = bytes(b'\0'.join(
+        mines[row_start:row_start+width]
+        for row_start in range(0, width * height, width)
+    ) + b'\0')
+    mask = (1 << (8 * len(padded))) - 1
+
+    center = int.from_bytes(padded, 'big')
+    rows = (center + (center << 8) + (center >> 8)) & mask
+    shift = 8 * stride
+    square = (rows + (rows << shift) + (rows >> shift)) & mask
+    counts = (square - center).to_bytes(len(padded), 'big')
+
+    return bytearray(b''.join(
+        counts[row_start:row_start+width]
+        for row_start in range(0, len(counts), stride)
+    ))
+
+
+def count_hex_mines_around(mines, width, height):
+    """
+    То же, что count_mines_around, для
+    шестиугольного поля (см. HexagonalField).
+
+    Строки укладываются в длинное целое со
+    сдвигом, переводящим их в осевые координаты:
+    строка row начинается на row // 2 байт
+    левее. Тогда у всех ячеек соседи лежат на
+    одних и тех же смещениях: +-1, +-stride и
+    +-(stride - 1), и хватает шести сдвигов.
+    """
+    indent = (height - 1) // 2
+    stride = indent + width + 1
+    padded = bytearray(stride * height)
+    for row in range(height):
+        start = row * stride + indent - row // 2
+        padded[start:start+width] = mines[row*width:(row+1)*width]
+    mask = (1 << (8 * len(padded))) - 1
+
+    center = int.from_bytes(padded, 'big')
+    counts = 0
+    for shift in (8, 8 * stride, 8 * (stride - 1)):
+        counts += (center << shift) + (center >> shift)
+    counts = (counts & mask).to_bytes(len(padded), 'big')
+
+    mined_around = bytearray(width * height)
+    for row in range(height):
+        start = row * stride + indent - row // 2
+        mined_around[row*width:(row+1)*width] = counts[start:start+width]
+    return mined_around
+
+
+def sample_mines(mines, mines_count, excluded, rng):
+    """
+    Ставит mines_count мин в ячейки, не
+    входящие в excluded.
+
+    Индексы выбираются random.sample из
+    диапазона допустимых ячеек, в котором
+    исключённые ячейки просто пропущены, поэтому
+    время работы O(mines_count) при любой
+    плотности мин.
+
+    :param mines: карта мин, заполняется на месте
+    :param excluded: отсортированные индексы
+        ячеек, в которых мин быть не должно
+    :param rng: экземпляр random.Random
+    """
+    eligible_count = len(mines) - len(excluded)
+    for idx in rng.sample(range(eligible_count), mines_count):
+        for excluded_idx in excluded:
+            if excluded_idx > idx:
+                break
+            idx += 1
+        mines[idx] = 1
 
 
 class AbstractField(metaclass=ABCMeta):
-    def __init__(self, field_params, game_manager):
+    # Наибольшее количество ячеек в безопасной
+    # зоне вокруг первого клика (сама ячейка
+    # и все её соседи).
+    safe_zone_size = 1
+
+    # Поля большего размера не строят таблицу
+    # соседства: она занимала бы слишком много
+    # памяти, и соседи вычисляются на лету.
+    adjacency_max_cells = 1 << 20
+
+    def __init__(self, field_params, game_manager, seed=None):
+        """
+        :param seed: зерно генератора мин. Если не
+            передано, выбирается случайно, но всё
+            равно сохраняется, чтобы поле можно
+            было воспроизвести.
+        """
         self.width = None
         self.height = None
         self.mines_count = None
+        self.seed = randrange(1 << 32) if seed is None else seed
 
         self.game_manager = game_manager
 
+        # Режим без угадывания, с которым создано
+        # поле: настройки менеджера игры могут
+        # смениться до первого клика (например,
+        # после загрузки сохранённой игры).
+        self.no_guess = game_manager.no_guess
+        self.no_guess_attempts = game_manager.no_guess_attempts
+
         # Общее количество ячеек
         self.cell_count = None
 
@@ -23,14 +237,53 @@ class AbstractField(metaclass=ABCMeta):
         self.safe_opened_count = None
         self.safe_count = None
 
-        # Коллекция ячеек
-        self.cells = None
+        # Таблица соседства (см. get_adjacency)
+        self.adjacency = None
+
+        # Состояние ячеек (см. cells.FieldState)
+        # и объекты, описывающие поведение ячеек
+        # каждого типа.
+        self.state = None
+        self.fake_cell = cell_fabric('fake', self, game_manager)
+        self.mined_cell = cell_fabric('mined', self, game_manager)
+        self.safe_cell = cell_fabric('safe', self, game_manager)
 
-        self.renderer = self.create_renderer(game_manager.render_context)
+        # Индексы ячеек, статус которых изменился
+        # с момента последней отрисовки. Если
+        # all_dirty истинно, поле перерисовывается
+        # целиком.
+        self.dirty_indices = set()
+        self.all_dirty = True
+
+        # Если не None -- словарь {индекс: статус до
+        # изменения}, в который set_status записывает
+        # каждую изменённую ячейку (см.
+        # GameManager.apply_actions).
+        self.changes = None
+
+        # Области нулевых ячеек вместе с их
+        # границей ("openings"), размечаются
+        # один раз при генерации поля. Номер
+        # области каждой ячейки хранится в
+        # state.opening_ids.
+        self.openings = None
+
+        # Окно просмотра (см. viewports.Viewport) и
+        # область ячеек, нарисованных в последний раз
+        # (см. get_region). Без окна рисуется всё поле.
+        self.viewport = game_manager.viewport
+        self.drawn_region = None
+
+        # Рендерер создаётся только при подключении
+        # контекста рисования, см. set_render_context.
+        self.renderer = None
+        if game_manager.render_context is not None:
+            self.set_render_context(game_manager.render_context)
         self.create_fake_field(field_params)
 
+    @staticmethod
     @abstractmethod
-    def get_cell_count(self, width, height):
+    def get_cell_count(width, height):
         return 0
 
     @abstractmethod
@@ -45,22 +298,63 @@ class AbstractField(metaclass=ABCMeta):
     def get_position_by_pixel(self, pixel):
         return 0
 
-    @staticmethod
     @abstractmethod
-    def create_renderer(render_context):
+    def get_region(self, margin):
+        """
+        Возвращает область ячеек, попадающих в окно
+        просмотра, с запасом margin ячеек.
+        """
+
+    @abstractmethod
+    def get_region_indices(self, region):
+        """
+        Возвращает индексы ячеек области region.
+        """
+
+    @abstractmethod
+    def region_contains(self, region, idx):
         pass
 
+    @abstractmethod
+    def region_covers(self, outer, inner):
+        """
+        Проверяет, что область inner целиком лежит
+        в области outer.
+        """
+
+    def get_canvas_pixel(self, pixel):
+        """
+        Переводит пиксель окна в пиксель рисунка
+        поля с учётом прокрутки.
+        """
+        if self.viewport is None:
+            return pixel
+        return self.viewport.to_canvas_pixel(pixel)
+
+    def set_render_context(self, render_context):
+        if self.renderer is None:
+            self.renderer = get_renderer_type(type(self))(render_context)
+        if self.renderer.context is None:
+            self.renderer.context = render_context
+
     def create_fake_field(self, field_params):
         self.width, self.height, self.mines_count = field_params
         self.cell_count = self.get_cell_count(
             self.width, self.height)
+        max_mines_count = (
+            self.cell_count - min(self.safe_zone_size, self.cell_count))
+        if not 0 <= self.mines_count <= max_mines_count:
+            raise ValueError(
+                'Передан неверный аргумент: mines_count={}! '
+                'На поле помещается не более {} мин.'.format(
+                    self.mines_count, max_mines_count))
         self.safe_count = self.cell_count - self.mines_count
         self.safe_opened_count = 0
 
-        self.cells = tuple(
-            FakeCell(self.get_position_by_idx(i), self, self.game_manager)
-            for i in range(self.cell_count)
-        )
+        self.state = FieldState(self.cell_count)
+        if self.cell_count <= self.adjacency_max_cells:
+            self.adjacency = get_adjacency(
+                type(self), self.width, self.height)
 
     @abstractmethod
     def generate(self, safe_position):
@@ -77,20 +371,383 @@ class AbstractField(metaclass=ABCMeta):
     def are_neighbors(self, position1, position2):
         return False
 
+    @staticmethod
     @abstractmethod
-    def get_neighbors(self, position):
+    def compute_neighbors(width, height, idx):
         """
-        Возвращает список всех ячеек, соседних с
-        position.
+        Вычисляет индексы всех ячеек, соседних с
+        ячейкой idx, на поле размером width*height.
 
-        :param position:
+        :param width:
+        :param height:
+        :param idx:
         :return:
         """
 
+    @classmethod
+    def build_adjacency(cls, width, height):
+        """
+        Строит таблицу соседства в формате CSR:
+        соседи ячейки idx -- это срез
+        neighbors[offsets[idx]:offsets[idx+1]].
+        """
+        offsets = array('i', (0,))
+        neighbors = array('i')
+        for idx in range(cls.get_cell_count(width, height)):
+            neighbors.extend(cls.compute_neighbors(width, height, idx))
+            offsets.append(len(neighbors))
+        return Adjacency(offsets, neighbors)
+
+    def get_neighbors(self, idx):
+        """
+        Возвращает индексы всех ячеек, соседних с
+        ячейкой idx.
+
+        :param idx:
+        :return:
+        """
+        adjacency = self.adjacency
+        if adjacency is None:
+            return self.compute_neighbors(self.width, self.height, idx)
+        offsets = adjacency.offsets
+        return adjacency.neighbors[offsets[idx]:offsets[idx+1]]
+
+    def get_safe_zone(self, safe_position):
+        """
+        Возвращает отсортированные индексы ячейки
+        safe_position и её соседей.
+        """
+        safe_idx = self.get_idx_by_position(safe_position)
+        return sorted(set(self.get_neighbors(safe_idx)) | {safe_idx})
+
+    def place_mines(self, safe_position, seed=None):
+        """
+        Расставляет mines_count мин так, чтобы в
+        ячейке safe_position и её соседях мин не
+        было.
+
+        :param safe_position:
+        :param seed: зерно генератора; по умолчанию
+            используется зерно поля. Переданное зерно
+            (например, подобранное в режиме без
+            угадывания) становится зерном поля: именно
+            его записывают результаты и сохранения, и
+            по нему поле воспроизводится.
+        """
+        excluded = self.get_safe_zone(safe_position)
+        eligible_count = self.cell_count - len(excluded)
+        if self.mines_count > eligible_count:
+            raise ValueError(
+                'Невозможно расставить {} мин вне безопасной '
+                'зоны: доступно только {} ячеек!'.format(
+                    self.mines_count, eligible_count))
+
+        mines = self.state.mines
+        mines[:] = bytes(self.cell_count)
+        if seed is not None:
+            self.seed = seed
+        sample_mines(mines, self.mines_count, excluded, Random(self.seed))
+
+    def choose_mines_seed(self, safe_position):
+        """
+        Возвращает зерно, которым нужно расставить
+        мины. В режиме без угадывания это зерно
+        первой подходящей попытки (см. solvers),
+        иначе -- зерно поля.
+        """
+        if not self.no_guess:
+            return self.seed
+
+        # Импорт здесь, чтобы не было циклического
+        # импорта: solvers использует функции
+        # этого модуля.
+        from solvers import find_no_guess_seed
+        return find_no_guess_seed(
+            type(self), self.width, self.height, self.mines_count,
+            self.get_idx_by_position(safe_position), self.seed,
+            self.no_guess_attempts, self.game_manager.no_guess_workers)
+
+    def get_cell(self, idx):
+        """
+        Возвращает объект, описывающий поведение
+        ячейки idx.
+        """
+        if not self.state.generated:
+            return self.fake_cell
+        if self.state.mines[idx]:
+            return self.mined_cell
+        return self.safe_cell
+
+    def set_status(self, idx, status):
+        statuses = self.state.statuses
+        old_status = statuses[idx]
+        if old_status != status:
+            if self.changes is not None:
+                self.changes.setdefault(idx, old_status)
+            statuses[idx] = status
+            self.dirty_indices.add(idx)
+            if status == CellStatus.MARKED_BY_FLAG:
+                self.update_flagged_around(idx, 1)
+            elif old_status == CellStatus.MARKED_BY_FLAG:
+                self.update_flagged_around(idx, -1)
+
+    def get_status(self, idx):
+        """
+        Возвращает статус, который показывает ячейка
+        idx. После окончания игры он вычисляется
+        здесь, а не записывается в state.statuses
+        заранее: тогда окончание игры стоит столько,
+        сколько перерисовка видимых ячеек, а не
+        проход по всему полю.
+        """
+        status = self.state.statuses[idx]
+        if self.game_manager.game_active:
+            return status
+        return self.get_cell(idx).get_final_status(idx, status)
+
+    def update_flagged_around(self, idx, delta):
+        flagged_around = self.state.flagged_around
+        for i in self.get_neighbors(idx):
+            flagged_around[i] += delta
+
+    def get_flagged_around(self, idx):
+        return self.state.flagged_around[idx]
+
+    def count_flagged_around(self):
+        """
+        Пересчитывает state.flagged_around с нуля,
+        например после загрузки статусов.
+        """
+        statuses = self.state.statuses
+        self.state.flagged_around = bytearray(self.cell_count)
+        idx = statuses.find(CellStatus.MARKED_BY_FLAG)
+        while idx != -1:
+            self.update_flagged_around(idx, 1)
+            idx = statuses.find(CellStatus.MARKED_BY_FLAG, idx + 1)
+
+    def get_stored_indices(self):
+        """
+        Возвращает индексы ячеек, состояние которых
+        хранится в памяти. Для обычных полей это
+        все ячейки.
+        """
+        return range(self.cell_count)
+
+    def count_mined_around(self):
+        """
+        Считает количество мин вокруг каждой
+        безопасной ячейки.
+        """
+        mines = self.state.mines
+        mined_around = self.state.mined_around
+        for idx in range(self.cell_count):
+            if not mines[idx]:
+                mined_around[idx] = sum(
+                    mines[i] for i in self.get_neighbors(idx))
+
+    def label_openings(self):
+        """
+        Размечает области нулевых ячеек. Должен
+        вызываться после того, как посчитано
+        state.mined_around.
+        """
+        mines = self.state.mines
+        mined_around = self.state.mined_around
+        opening_ids = self.state.opening_ids
+        self.openings = []
+
+        # Перебираются только нулевые ячейки: их
+        # ищет bytearray.find, без цикла по всему
+        # полю.
+        start_idx = -1
+        while True:
+            start_idx = mined_around.find(0, start_idx + 1)
+            if start_idx == -1:
+                break
+            if mines[start_idx] or opening_ids[start_idx] != -1:
+                continue
+
+            opening_id = len(self.openings)
+            opening_ids[start_idx] = opening_id
+            opening = [start_idx]
+            border = set()
+            queue = deque((start_idx,))
+            while queue:
+                for idx in self.get_neighbors(queue.popleft()):
+                    if mined_around[idx] != 0:
+                        border.add(idx)
+                    elif opening_ids[idx] == -1:
+                        opening_ids[idx] = opening_id
+                        opening.append(idx)
+                        queue.append(idx)
+
+            opening.extend(border)
+            self.openings.append(tuple(opening))
+
+    def count_3bv(self):
+        """
+        Считает 3BV поля -- наименьшее количество
+        кликов, которым его можно пройти: по клику
+        на каждую область нулевых ячеек и на каждую
+        безопасную ячейку, не граничащую ни с одной
+        такой областью. Области обходятся заново, а
+        не берутся из openings: после загрузки
+        сохранённой игры они не размечены.
+
+        :return: 3BV или None, если мины ещё не
+            расставлены
+        """
+        if not self.state.generated:
+            return None
+        mined_around = self.state.mined_around
+        # Мины и уже учтённые ячейки.
+        covered = bytearray(self.state.mines)
+        clicks = 0
+        start_idx = mined_around.find(0)
+        while start_idx != -1:
+            if not covered[start_idx]:
+                clicks += 1
+                covered[start_idx] = 1
+                queue = deque((start_idx,))
+                while queue:
+                    for idx in self.get_neighbors(queue.popleft()):
+                        if covered[idx]:
+                            continue
+                        covered[idx] = 1
+                        if mined_around[idx] == 0:
+                            queue.append(idx)
+            start_idx = mined_around.find(0, start_idx + 1)
+        return clicks + covered.count(0)
+
+    def reveal(self, indices):
+        """
+        Открывает безопасные ячейки indices. Если
+        открыта нулевая ячейка, открываются и все
+        её соседи -- обход идёт в ширину по явной
+        очереди, без рекурсии. Если область нулевой
+        ячейки ещё не тронута пользователем, она
+        открывается целиком по заранее
+        размеченному opening.
+
+        Менеджер игры уведомляется один раз на
+        всю пачку открытых ячеек.
+
+        :param indices: индексы безопасных ячеек
+        """
+        statuses = self.state.statuses
+        mined_around = self.state.mined_around
+        opened_count = 0
+        queue = deque(indices)
+        while queue:
+            idx = queue.popleft()
+            if statuses[idx] != CellStatus.CLOSED:
+                continue
+
+            self.set_status(idx, CellStatus.NUMBER)
+            opened_count += 1
+            if mined_around[idx] != 0:
+                continue
+
+            opening = self.get_opening(idx)
+            if opening is None:
+                queue.extend(self.get_neighbors(idx))
+                continue
+
+            for i in opening:
+                if statuses[i] == CellStatus.CLOSED:
+                    self.set_status(i, CellStatus.NUMBER)
+                    opened_count += 1
+
+        if opened_count:
+            self.game_manager.safe_cell_opened(opened_count)
+
+    def get_opening(self, idx):
+        """
+        Возвращает размеченную область нулевой
+        ячейки idx, если её можно открыть целиком,
+        т.е. ни одна ячейка в ней не помечена.
+        Иначе возвращает None.
+        """
+        opening_id = self.state.opening_ids[idx]
+        if opening_id == -1:
+            return None
+        opening = self.openings[opening_id]
+        statuses = self.state.statuses
+        if any(statuses[i] in Cell.marked_statuses for i in opening):
+            return None
+        return opening
+
+    def invalidate(self):
+        """
+        Помечает поле для полной перерисовки,
+        например после смены контекста рисования.
+        """
+        self.all_dirty = True
+        self.dirty_indices.clear()
+        self.drawn_region = None
+
     def render(self):
-        self.renderer.clear()
-        for cell in self.cells:
-            self.renderer.render(cell)
+        """
+        Отрисовывает ячейки, изменившиеся с
+        момента предыдущей отрисовки. Полная
+        перерисовка выполняется только для
+        нового поля или после invalidate.
+        """
+        if self.renderer is None or self.renderer.context is None:
+            # Рисовать некуда. При подключении контекста
+            # поле всё равно перерисуется целиком.
+            self.dirty_indices.clear()
+            return
+
+        if self.viewport is not None:
+            self.render_viewport()
+        elif self.all_dirty:
+            self.renderer.clear()
+            for idx in self.get_stored_indices():
+                self.renderer.render(self, idx)
+            self.all_dirty = False
+        else:
+            for idx in self.dirty_indices:
+                self.renderer.render(self, idx)
+        self.dirty_indices.clear()
+        self.renderer.context.flush()
+
+    def render_viewport(self):
+        """
+        Отрисовывает только ячейки окна просмотра
+        с запасом viewport.margin. Пока окно
+        прокручивается в пределах нарисованной
+        области, рисуются лишь изменившиеся ячейки;
+        когда выходит за неё -- ячейки, ушедшие из
+        области, удаляются, а новые дорисовываются.
+        """
+        renderer = self.renderer
+        drawn = self.drawn_region
+        if self.all_dirty or drawn is None:
+            renderer.clear()
+            drawn = self.get_region(self.viewport.margin)
+            for idx in self.get_region_indices(drawn):
+                renderer.render(self, idx)
+            self.all_dirty = False
+        elif not self.region_covers(drawn, self.get_region(0)):
+            region = self.get_region(self.viewport.margin)
+            for idx in self.get_region_indices(drawn):
+                if not self.region_contains(region, idx):
+                    renderer.remove(idx)
+            for idx in self.get_region_indices(region):
+                if not self.region_contains(drawn, idx):
+                    renderer.render(self, idx)
+            for idx in self.dirty_indices:
+                if (self.region_contains(drawn, idx)
+                        and self.region_contains(region, idx)):
+                    renderer.render(self, idx)
+            drawn = region
+        else:
+            for idx in self.dirty_indices:
+                if self.region_contains(drawn, idx):
+                    renderer.render(self, idx)
+        self.drawn_region = drawn
+        renderer.context.set_view(self.viewport.x, self.viewport.y)
 
     def get_canvas_size(self):
         return (self.width*self.renderer.cell_size[0],
@@ -101,11 +758,10 @@ class RectangleField(AbstractField):
     """
     Класс, описывающий прямоугольное минное поле
     """
-    @staticmethod
-    def create_renderer(render_context):
-        return RectangleRenderer(render_context)
+    safe_zone_size = 9
 
-    def get_cell_count(self, width, height):
+    @staticmethod
+    def get_cell_count(width, height):
         return width * height
 
     def get_position_by_idx(self, idx):
@@ -115,61 +771,617 @@ class RectangleField(AbstractField):
         return position[0] * self.width + position[1]
 
     def get_position_by_pixel(self, pixel):
-        column = pixel[0] // self.renderer.cell_size[0]
-        row = pixel[1] // self.renderer.cell_size[1]
+        x, y = self.get_canvas_pixel(pixel)
+        column = x // self.renderer.cell_size[0]
+        row = y // self.renderer.cell_size[1]
         return row, column
 
-    def get_cell_by_position(self, position):
-        idx = self.get_idx_by_position(position)
-        return self.cells[idx]
+    def get_region(self, margin):
+        """
+        Область -- пара диапазонов строк и столбцов.
+        """
+        viewport = self.viewport
+        cell_width, cell_height = self.renderer.cell_size
+        rows = range(
+            max(viewport.y // cell_height - margin, 0),
+            min((viewport.y + viewport.height - 1) // cell_height
+                + 1 + margin, self.height))
+        columns = range(
+            max(viewport.x // cell_width - margin, 0),
+            min((viewport.x + viewport.width - 1) // cell_width
+                + 1 + margin, self.width))
+        return rows, columns
+
+    def get_region_indices(self, region):
+        rows, columns = region
+        for row in rows:
+            row_start = row * self.width
+            yield from range(
+                row_start + columns.start, row_start + columns.stop)
+
+    def region_contains(self, region, idx):
+        rows, columns = region
+        row, column = divmod(idx, self.width)
+        return row in rows and column in columns
+
+    def region_covers(self, outer, inner):
+        return all(
+            outer_range.start <= inner_range.start
+            and inner_range.stop <= outer_range.stop
+            for outer_range, inner_range in zip(outer, inner)
+        )
 
     def generate(self, safe_position):
-        mined_cells = set()
-        mined_count = 0
-        while mined_count < self.mines_count:
-            idx = randrange(self.cell_count)
-            position = self.get_position_by_idx(idx)
-            if (idx in mined_cells
-                    or self.are_neighbors(position, safe_position)):
-                continue
+        self.place_mines(
+            safe_position, self.choose_mines_seed(safe_position))
+        self.count_mined_around()
+        self.label_openings()
+        self.state.generated = True
+
+    def count_mined_around(self):
+        self.state.mined_around = count_mines_around(
+            self.state.mines, self.width, self.height)
 
-            mined_cells.add(idx)
-            mined_count += 1
+    def valid_position(self, position):
+        return (0 <= position[0] < self.height and
+                0 <= position[1] < self.width)
 
-        partial_cell_fabric = partial(
-            cell_fabric, field=self, game_manager=self.game_manager)
+    def are_neighbors(self, position1, position2):
+        return max(map(abs_sub, position1, position2)) <= 1
 
-        new_cells = tuple(
-            partial_cell_fabric(
-                type_=('mined' if i in mined_cells else 'safe'),
-                position=self.get_position_by_idx(i),
-                status=self.cells[i].status
-            )
-            for i in range(self.cell_count)
+    @staticmethod
+    def compute_neighbors(width, height, idx):
+        row, column = divmod(idx, width)
+        rows = range(max(row - 1, 0), min(row + 2, height))
+        columns = range(max(column - 1, 0), min(column + 2, width))
+        return tuple(
+            r * width + c
+            for r in rows
+            for c in columns
+            if r != row or c != column
         )
-        self.cells = new_cells
-        self.cells[self.get_idx_by_position(safe_position)].left_button_click()
+
+    @classmethod
+    def build_adjacency(cls, width, height):
+        return build_row_adjacency(cls.compute_neighbors, width, height)
+
+
+register_renderer(RectangleField, 'renderers.RectangleRenderer')
+
+
+class HexagonalField(AbstractField):
+    """
+    Минное поле из шестиугольников ("острым
+    углом вверх"), в целом имеющее форму
+    прямоугольника: строки по width ячеек,
+    нечётные строки сдвинуты на полъячейки вправо.
+
+    Позиция ячейки -- осевые координаты (r, q):
+    r -- номер строки, q -- осевой столбец, равный
+    номеру ячейки в строке минус r // 2. В осевых
+    координатах у всех ячеек одни и те же шесть
+    соседей: (r, q +- 1), (r - 1, q), (r - 1, q + 1),
+    (r + 1, q - 1) и (r + 1, q).
+
+    В памяти ячейки хранятся построчно, как у
+    RectangleField.
+    """
+    safe_zone_size = 7
+
+    neighbor_offsets = ((0, -1), (0, 1), (-1, 0), (-1, 1), (1, -1), (1, 0))
+
+    @staticmethod
+    def get_cell_count(width, height):
+        return width * height
+
+    def get_position_by_idx(self, idx):
+        row, column = divmod(idx, self.width)
+        return row, column - row // 2
+
+    def get_idx_by_position(self, position):
+        row, q = position
+        return row * self.width + q + row // 2
+
+    def get_position_by_pixel(self, pixel):
+        """
+        Переводит пиксель в дробные осевые
+        координаты и округляет их до ближайшей
+        ячейки (округление кубических координат).
+        Центр ячейки (r, q) лежит в точке
+        ((q + r/2) * W + W/2, r * 3H/4 + H/2), где
+        W и H -- ширина и высота шестиугольника.
+        """
+        x, y = self.get_canvas_pixel(pixel)
+        cell_width, cell_height = self.renderer.cell_size
+        # Берётся центр пикселя, чтобы пиксели на
+        # границе ячеек не попадали точно на неё.
+        fraction_r = (y + 0.5 - cell_height / 2) / (cell_height * 3 / 4)
+        fraction_q = (
+            (x + 0.5 - cell_width / 2) / cell_width - fraction_r / 2)
+        fraction_s = -fraction_q - fraction_r
+
+        q = round(fraction_q)
+        r = round(fraction_r)
+        s = round(fraction_s)
+        q_diff = abs(q - fraction_q)
+        r_diff = abs(r - fraction_r)
+        s_diff = abs(s - fraction_s)
+        if q_diff > r_diff and q_diff > s_diff:
+            q = -r - s
+        elif r_diff > s_diff:
+            r = -q - s
+        return r, q
+
+    def get_region(self, margin):
+        """
+        Область -- пара диапазонов строк и номеров
+        ячеек в строке.
+        """
+        viewport = self.viewport
+        cell_width, cell_height = self.renderer.cell_size
+        row_height = cell_height * 3 // 4
+        rows = range(
+            max(viewport.y // row_height - 1 - margin, 0),
+            min((viewport.y + viewport.height - 1) // row_height
+                + 1 + margin, self.height))
+        columns = range(
+            max(viewport.x // cell_width - 1 - margin, 0),
+            min((viewport.x + viewport.width - 1) // cell_width
+                + 1 + margin, self.width))
+        return rows, columns
+
+    # Ячейки хранятся построчно, поэтому области
+    # устроены так же, как у RectangleField.
+    get_region_indices = RectangleField.get_region_indices
+    region_contains = RectangleField.region_contains
+    region_covers = RectangleField.region_covers
+
+    def get_canvas_size(self):
+        cell_width, cell_height = self.renderer.cell_size
+        return (
+            self.width * cell_width + (cell_width // 2
+                                       if self.height > 1 else 0),
+            (self.height - 1) * (cell_height * 3 // 4) + cell_height,
+        )
+
+    def generate(self, safe_position):
+        self.place_mines(
+            safe_position, self.choose_mines_seed(safe_position))
+        self.count_mined_around()
+        self.label_openings()
+        self.state.generated = True
+
+    def count_mined_around(self):
+        self.state.mined_around = count_hex_mines_around(
+            self.state.mines, self.width, self.height)
+
+    def valid_position(self, position):
+        row, q = position
+        return (0 <= row < self.height and
+                0 <= q + row // 2 < self.width)
+
+    def are_neighbors(self, position1, position2):
+        dr = position2[0] - position1[0]
+        dq = position2[1] - position1[1]
+        return abs(dr) + abs(dq) + abs(dr + dq) <= 2
+
+    @classmethod
+    def compute_neighbors(cls, width, height, idx):
+        row, column = divmod(idx, width)
+        q = column - row // 2
+        neighbors = []
+        for dr, dq in cls.neighbor_offsets:
+            neighbor_row = row + dr
+            neighbor_column = q + dq + neighbor_row // 2
+            if (0 <= neighbor_row < height
+                    and 0 <= neighbor_column < width):
+                neighbors.append(neighbor_row * width + neighbor_column)
+        return tuple(sorted(neighbors))
+
+    @classmethod
+    def build_adjacency(cls, width, height):
+        return build_row_adjacency(
+            cls.compute_neighbors, width, height, period=2)
+
+
+register_renderer(HexagonalField, 'renderers.HexagonalRenderer')
+
+
+class VoronoiField(AbstractField):
+    """
+    Минное поле из случайных ячеек Вороного (см.
+    tilings). Позиция ячейки (row, column) -- это
+    квадрат сетки, в котором лежит её центр;
+    хранятся ячейки построчно.
+    """
+    # Разбиение зависит только от размеров поля и
+    # этого зерна, поэтому оно, как и таблица
+    # соседства, кэшируется между играми.
+    tiling_seed = 0
+
+    @staticmethod
+    def get_cell_count(width, height):
+        return width * height
+
+    @property
+    def tiling(self):
+        return build_voronoi_tiling(self.width, self.height, self.tiling_seed)
+
+    @property
+    def safe_zone_size(self):
+        # Количество соседей ячейки Вороного заранее
+        # не ограничено, поэтому берётся наибольшее
+        # в разбиении этого поля.
+        return self.tiling.max_degree + 1
+
+    def get_position_by_idx(self, idx):
+        return divmod(idx, self.width)
+
+    def get_idx_by_position(self, position):
+        return position[0] * self.width + position[1]
+
+    def get_position_by_pixel(self, pixel):
+        """
+        Ищет ячейку по сетке центров (см.
+        tilings.find_cell) за O(1). Для пикселя вне
+        поля возвращает недопустимую позицию.
+        """
+        x, y = self.get_canvas_pixel(pixel)
+        side = self.renderer.cell_size[0]
+        idx = find_cell(self.tiling, (x + 0.5) / side, (y + 0.5) / side)
+        if idx is None:
+            return -1, -1
+        return self.get_position_by_idx(idx)
+
+    def get_region(self, margin):
+        """
+        Область -- пара диапазонов строк и столбцов
+        сетки. Ячейка выступает за свой квадрат
+        сетки не больше чем на два квадрата, поэтому
+        область расширяется на два квадрата.
+        """
+        viewport = self.viewport
+        side = self.renderer.cell_size[0]
+        margin += 2
+        rows = range(
+            max(viewport.y // side - margin, 0),
+            min((viewport.y + viewport.height - 1) // side
+                + 1 + margin, self.height))
+        columns = range(
+            max(viewport.x // side - margin, 0),
+            min((viewport.x + viewport.width - 1) // side
+                + 1 + margin, self.width))
+        return rows, columns
+
+    get_region_indices = RectangleField.get_region_indices
+    region_contains = RectangleField.region_contains
+    region_covers = RectangleField.region_covers
+
+    def generate(self, safe_position):
+        self.place_mines(
+            safe_position, self.choose_mines_seed(safe_position))
+        self.count_mined_around()
+        self.label_openings()
+        self.state.generated = True
 
     def valid_position(self, position):
         return (0 <= position[0] < self.height and
                 0 <= position[1] < self.width)
 
     def are_neighbors(self, position1, position2):
-        return max(map(abs_sub, position1, position2)) <= 1
+        return self.get_idx_by_position(position2) in self.get_neighbors(
+            self.get_idx_by_position(position1))
+
+    @classmethod
+    def compute_neighbors(cls, width, height, idx):
+        return build_voronoi_tiling(
+            width, height, cls.tiling_seed).neighbors[idx]
+
+    @classmethod
+    def build_adjacency(cls, width, height):
+        tiling = build_voronoi_tiling(width, height, cls.tiling_seed)
+        offsets = array('i', (0,))
+        neighbors = array('i')
+        for cell_neighbors in tiling.neighbors:
+            neighbors.extend(cell_neighbors)
+            offsets.append(len(neighbors))
+        return Adjacency(offsets, neighbors)
+
+
+register_renderer(VoronoiField, 'renderers.VoronoiRenderer')
+
+
+class Chunk:
+    """
+    Квадратный участок chunked-поля со стороной
+    ChunkedField.chunk_side.
+    """
+    def __init__(self, cell_count):
+        self.statuses = bytearray((CellStatus.CLOSED,)) * cell_count
+
+        # Карта мин и количество мин вокруг ячеек.
+        # Заполняются при первом обращении к чанку
+        # после генерации поля.
+        self.mines = None
+        self.mined_around = None
+
+        # Количество ячеек, статус которых отличается
+        # от CLOSED. Чанк, в котором таких ячеек нет,
+        # можно выгрузить: его мины всегда можно
+        # сгенерировать заново.
+        self.touched_count = 0
+
+
+class ChunkedArray:
+    """
+    Массив значений ячеек chunked-поля, хранящийся
+    по чанкам. Поддерживает только обращение по
+    индексу -- этого достаточно для AbstractField
+    и ячеек.
+    """
+    def __init__(self, field, name):
+        self.field = field
+        self.name = name
+
+    def __getitem__(self, idx):
+        chunk, local_idx = self.field.locate(idx)
+        values = getattr(chunk, self.name)
+        return 0 if values is None else values[local_idx]
+
+    def __setitem__(self, idx, value):
+        chunk, local_idx = self.field.locate(idx)
+        getattr(chunk, self.name)[local_idx] = value
 
-    def get_neighbors(self, position):
-        column_offset = (1, 1, 1, 0, -1, -1, -1, 0)
-        row_offset = (-1, 0, 1, 1, 1, 0, -1, -1)
-        neighbors_count = len(column_offset)
-        assert neighbors_count == len(row_offset)
 
-        checking_positions = (
-            (position[0] + row_offset[i], position[1] + column_offset[i])
-            for i in range(neighbors_count)
+class ChunkedStatuses(ChunkedArray):
+    def __init__(self, field):
+        super().__init__(field, 'statuses')
+
+    def __setitem__(self, idx, value):
+        chunk, local_idx = self.field.locate(idx)
+        was_touched = chunk.statuses[local_idx] != CellStatus.CLOSED
+        chunk.statuses[local_idx] = value
+        chunk.touched_count += (value != CellStatus.CLOSED) - was_touched
+
+
+class ChunkedFieldState:
+    """
+    Аналог cells.FieldState для chunked-поля.
+    """
+    def __init__(self, field):
+        self.cell_count = field.cell_count
+        self.mines = ChunkedArray(field, 'mines')
+        self.statuses = ChunkedStatuses(field)
+        self.mined_around = ChunkedArray(field, 'mined_around')
+        self.generated = False
+
+
+class ChunkedField(RectangleField):
+    """
+    Прямоугольное поле, которое хранится и
+    генерируется по чанкам. Мины чанка
+    расставляются при первом обращении к нему и
+    зависят только от зерна поля и координат
+    чанка, поэтому нетронутые чанки можно
+    выгружать и генерировать заново.
+
+    Память расходуется пропорционально
+    исследованной части поля, что позволяет
+    играть на полях 100000x100000 и "бесконечных"
+    полях.
+
+    Ширина и высота поля должны быть кратны
+    chunk_side. Мины распределяются по чанкам
+    поровну (с точностью до одной), поэтому
+    общее их количество точно равно mines_count.
+    Области нулевых ячеек заранее не
+    размечаются.
+    """
+    chunk_side = 32
+
+    # Сколько чанков держать в памяти, прежде чем
+    # начать выгружать нетронутые.
+    max_loaded_chunks = 4096
+
+    def create_fake_field(self, field_params):
+        self.width, self.height, self.mines_count = field_params
+        side = self.chunk_side
+        if self.width % side or self.height % side:
+            raise ValueError(
+                'Размеры поля {}x{} должны быть кратны {}!'.format(
+                    self.width, self.height, side))
+
+        self.cell_count = self.get_cell_count(self.width, self.height)
+        self.chunk_cell_count = side * side
+        self.chunk_rows = self.height // side
+        self.chunk_columns = self.width // side
+        self.chunk_count = self.chunk_rows * self.chunk_columns
+
+        # Каждому чанку достаётся не больше
+        # ceil(mines_count / chunk_count) мин, и
+        # они должны помещаться вне безопасной зоны.
+        max_mines_count = self.chunk_count * (
+            self.chunk_cell_count - self.safe_zone_size)
+        if not 0 <= self.mines_count <= max_mines_count:
+            raise ValueError(
+                'Передан неверный аргумент: mines_count={}! '
+                'На поле помещается не более {} мин.'.format(
+                    self.mines_count, max_mines_count))
+        self.safe_count = self.cell_count - self.mines_count
+        self.safe_opened_count = 0
+
+        self.chunks = OrderedDict()
+        self.mine_chunks = OrderedDict()
+        self.safe_zone = frozenset()
+        self.state = ChunkedFieldState(self)
+
+    def generate(self, safe_position):
+        safe_idx = self.get_idx_by_position(safe_position)
+        self.safe_zone = frozenset(self.get_neighbors(safe_idx)) | {safe_idx}
+        self.mine_chunks.clear()
+        for chunk in self.chunks.values():
+            chunk.mines = None
+            chunk.mined_around = None
+        self.state.generated = True
+
+    def get_chunk_mines_count(self, chunk_coords):
+        """
+        Количество мин в чанке. Мины делятся
+        между чанками (в порядке их номеров)
+        так, что в сумме их ровно mines_count.
+        """
+        number = chunk_coords[0] * self.chunk_columns + chunk_coords[1]
+        return (self.mines_count * (number + 1) // self.chunk_count -
+                self.mines_count * number // self.chunk_count)
+
+    def get_chunk_origin(self, chunk_coords):
+        """
+        Индекс левой верхней ячейки чанка.
+        """
+        side = self.chunk_side
+        return chunk_coords[0] * side * self.width + chunk_coords[1] * side
+
+    def get_chunk_indices(self, chunk_coords):
+        origin = self.get_chunk_origin(chunk_coords)
+        side = self.chunk_side
+        for local_row in range(side):
+            row_start = origin + local_row * self.width
+            yield from range(row_start, row_start + side)
+
+    def get_chunk_mines(self, chunk_coords):
+        """
+        Возвращает карту мин чанка, генерируя её
+        при необходимости. Результат зависит только
+        от зерна поля, координат чанка и безопасной
+        зоны первого клика.
+        """
+        mines = self.mine_chunks.get(chunk_coords)
+        if mines is not None:
+            self.mine_chunks.move_to_end(chunk_coords)
+            return mines
+
+        excluded = sorted(
+            local_idx
+            for local_idx, idx in enumerate(
+                self.get_chunk_indices(chunk_coords))
+            if idx in self.safe_zone
         )
-        
-        return tuple(
-            self.get_cell_by_position(position)
-            for position in checking_positions
-            if self.valid_position(position)
+        mines = bytearray(self.chunk_cell_count)
+        sample_mines(
+            mines, self.get_chunk_mines_count(chunk_coords), excluded,
+            Random('{}:{}:{}'.format(self.seed, *chunk_coords)))
+
+        self.mine_chunks[chunk_coords] = mines
+        if len(self.mine_chunks) > self.max_loaded_chunks:
+            self.mine_chunks.popitem(last=False)
+        return mines
+
+    def count_chunk_mined_around(self, chunk_coords):
+        """
+        Считает количество мин вокруг ячеек чанка.
+        Для этого карта мин чанка дополняется
+        рамкой шириной в одну ячейку из соседних
+        чанков.
+        """
+        side = self.chunk_side
+        padded_side = side + 2
+        padded = bytearray(padded_side * padded_side)
+        # Какие строки (или столбцы) соседнего чанка
+        # попадают в рамку в зависимости от сдвига.
+        spans = {-1: (side - 1, side), 0: (0, side), 1: (0, 1)}
+        for row_shift in (-1, 0, 1):
+            chunk_row = chunk_coords[0] + row_shift
+            if not 0 <= chunk_row < self.chunk_rows:
+                continue
+            for column_shift in (-1, 0, 1):
+                chunk_column = chunk_coords[1] + column_shift
+                if not 0 <= chunk_column < self.chunk_columns:
+                    continue
+                mines = self.get_chunk_mines((chunk_row, chunk_column))
+                column_start, column_stop = spans[column_shift]
+                padded_column = column_start + 1 + column_shift * side
+                for row in range(*spans[row_shift]):
+                    padded_row = row + 1 + row_shift * side
+                    padded_start = padded_row * padded_side + padded_column
+                    padded[padded_start:
+                           padded_start + column_stop - column_start] = (
+                        mines[row * side + column_start:
+                              row * side + column_stop])
+
+        counts = count_mines_around(padded, padded_side, padded_side)
+        return bytearray(b''.join(
+            counts[row * padded_side + 1:row * padded_side + 1 + side]
+            for row in range(1, side + 1)
+        ))
+
+    def get_chunk(self, chunk_coords):
+        chunk = self.chunks.get(chunk_coords)
+        if chunk is None:
+            chunk = Chunk(self.chunk_cell_count)
+            self.chunks[chunk_coords] = chunk
+            if len(self.chunks) > self.max_loaded_chunks:
+                self.evict_chunks()
+        else:
+            self.chunks.move_to_end(chunk_coords)
+
+        if self.state.generated and chunk.mines is None:
+            chunk.mines = self.get_chunk_mines(chunk_coords)
+            chunk.mined_around = self.count_chunk_mined_around(chunk_coords)
+        return chunk
+
+    def evict_chunks(self):
+        """
+        Выгружает давно не использовавшиеся чанки,
+        в которых все ячейки закрыты и не помечены.
+        Выгружает с запасом, чтобы не просматривать
+        чанки при каждой загрузке нового.
+        """
+        target_count = self.max_loaded_chunks * 3 // 4
+        # Последний чанк только что загружен.
+        for chunk_coords in tuple(self.chunks)[:-1]:
+            if len(self.chunks) <= target_count:
+                break
+            if self.chunks[chunk_coords].touched_count == 0:
+                del self.chunks[chunk_coords]
+
+    def locate(self, idx):
+        """
+        Возвращает чанк, в котором лежит ячейка
+        idx, и индекс ячейки внутри чанка.
+        """
+        side = self.chunk_side
+        row, column = divmod(idx, self.width)
+        chunk_row, local_row = divmod(row, side)
+        chunk_column, local_column = divmod(column, side)
+        chunk = self.get_chunk((chunk_row, chunk_column))
+        return chunk, local_row * side + local_column
+
+    def get_stored_indices(self):
+        indices = []
+        for chunk_coords in tuple(self.chunks):
+            indices.extend(self.get_chunk_indices(chunk_coords))
+        return indices
+
+    def get_opening(self, idx):
+        return None
+
+    def count_3bv(self):
+        # Для подсчёта пришлось бы сгенерировать
+        # все чанки поля.
+        return None
+
+    # Количество флагов вокруг ячеек не хранится:
+    # соседи ячейки бывают в соседнем чанке, который
+    # может быть выгружен, а счётчик в нём потерян.
+    def update_flagged_around(self, idx, delta):
+        pass
+
+    def get_flagged_around(self, idx):
+        statuses = self.state.statuses
+        return sum(
+            1 for i in self.get_neighbors(idx)
+            if statuses[i] == CellStatus.MARKED_BY_FLAG
         )
+
+    def count_flagged_around(self):
+        pass
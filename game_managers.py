@@ -3,8 +3,12 @@
 import time
 from enum import IntEnum, auto
 
-from fields import RectangleField
-from api import FieldParams
+from fields import (
+    ChunkedField, HexagonalField, RectangleField, VoronoiField)
+from api import CellChange, FieldParams, GameRecord
+from cells import CellStatus
+from history import History
+from timers import CountdownTimer, GameTimer
 
 
 class LevelEnum(IntEnum):
@@ -12,88 +16,389 @@ class LevelEnum(IntEnum):
     VETERAN = auto()
     WARRIOR = auto()
     CUSTOM = auto()
+    HUGE = auto()
+    ENDLESS = auto()
+
+
+# Сторона "бесконечного" поля. Память под
+# поле расходуется только на исследованные
+# чанки, поэтому размер ограничен лишь
+# разумным диапазоном координат.
+ENDLESS_SIZE = ChunkedField.chunk_side << 26
 
 
 class GameManager:
     """
     Хранит текущее состояние игры, а также управляет им.
     """
-    def __init__(self):
-        self.button_method_map = {
-            1: 'left_button_click',
-            2: 'middle_button_click',
-            3: 'right_button_click'
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: функция, возвращающая текущее
+            время в секундах. Подменяется, например,
+            в симуляциях, чтобы игры не зависели от
+            реального времени.
+        """
+        self.clock = clock
+
+        # Действия над ячейками и методы ячеек,
+        # которые их выполняют.
+        self.action_method_map = {
+            'reveal': 'left_button_click',
+            'chord': 'middle_button_click',
+            'flag': 'right_button_click',
+        }
+        self.button_action_map = {
+            1: 'reveal',
+            2: 'chord',
+            3: 'flag',
         }
 
         self.level_field_map = {
             LevelEnum.ROOKIE: FieldParams(10, 10, 10),
             LevelEnum.VETERAN: FieldParams(16, 16, 40),
             LevelEnum.WARRIOR: FieldParams(30, 16, 99),
+            LevelEnum.HUGE: FieldParams(
+                100000, 100000, 100000 * 100000 * 40 // 256),
+            LevelEnum.ENDLESS: FieldParams(
+                ENDLESS_SIZE, ENDLESS_SIZE, ENDLESS_SIZE**2 * 40 // 256),
+        }
+
+        # Уровни, поля которых генерируются по
+        # чанкам. Для остальных тип поля выбирается
+        # по геометрии (geometry).
+        self.level_field_types = {
+            LevelEnum.HUGE: ChunkedField,
+            LevelEnum.ENDLESS: ChunkedField,
+        }
+
+        self.geometry_field_types = {
+            'rectangle': RectangleField,
+            'hexagonal': HexagonalField,
+            'voronoi': VoronoiField,
         }
+        self.geometry = 'rectangle'
 
         self.level_names = {
             LevelEnum.ROOKIE: 'Rookie',
             LevelEnum.VETERAN: 'Veteran',
             LevelEnum.WARRIOR: 'Warrior',
             LevelEnum.CUSTOM: 'Custom',
+            LevelEnum.HUGE: 'Huge',
+            LevelEnum.ENDLESS: 'Endless',
         }
 
         self.default_field_params = FieldParams(
             width=10, height=10, mines_count=10)
+
+        # Режим без угадывания: поле генерируется
+        # заново, пока его нельзя решить от первого
+        # клика без догадок. no_guess_workers --
+        # количество процессов для параллельного
+        # перебора кандидатов (0 -- в этом процессе).
+        self.no_guess = False
+        self.no_guess_attempts = 10000
+        self.no_guess_workers = 0
         self.render_context = None
+        self.viewport = None
+
+        # Журнал ходов (например, saves.Autosave):
+        # объект с методами record(action, idx,
+        # elapsed), который вызывается перед каждым
+        # ходом, и reset(), который вызывается при
+        # новой игре.
+        self.move_log = None
+
+        # Сколько последних ходов можно отменить (см.
+        # undo); 0 -- история не ведётся. Применяется
+        # с новой игры.
+        self.undo_depth = 0
+
+        # Время на игру в секундах для режима
+        # обратного отсчёта: когда оно истекает,
+        # взрываются все мины. 0 -- обычный таймер.
+        # Применяется с новой игры.
+        self.countdown = 0
+
+        # Профайлер (см. enable_profiling) или None.
+        self.profiler = None
+
+        # Хранилище результатов (например,
+        # results.ResultsStore): объект с методом
+        # add(record), которому при окончании игры
+        # передаётся её итог (см. get_result). player
+        # -- кто играет: 'human' или, в симуляциях,
+        # имя стратегии.
+        self.results = None
+        self.player = 'human'
+
+        self.level = LevelEnum.CUSTOM
         self._reset_game_state()
 
-    def _reset_game_state(self, field_params=None):
+    def _reset_game_state(self, field_params=None, seed=None,
+                          field_type=RectangleField):
         if field_params is None:
             self.field_params = self.default_field_params
         else:
             self.field_params = field_params
-        self.field = RectangleField(
-            self.field_params, self)
+        self.field = field_type(
+            self.field_params, self, seed)
 
         self.user_won = False
         self.game_active = True
 
-        self.game_start_clock = None
-        self.game_finish_clock = None
+        # Истинно, если игра проиграна, потому что
+        # истекло время обратного отсчёта.
+        self.detonated = False
+
+        if self.countdown:
+            self.timer = CountdownTimer(self.countdown, self.clock)
+        else:
+            self.timer = GameTimer(self.clock)
 
         self.mark_count = 0
+        self.moves_count = 0
         self.safe_opened_count = 0
         self.safe_count = self.field.cell_count - self.field_params.mines_count
 
+        self.history = None
+        if self.undo_depth:
+            self.history = History(self, self.undo_depth)
+
+        if self.profiler is not None:
+            self.profiler.attach_field(self.field)
+
+    def enable_profiling(self, profiler=None):
+        """
+        Включает сбор времени фаз и счётчиков (см.
+        profiling.Profiler).
+
+        :return: подключённый профайлер
+        """
+        self.disable_profiling()
+        if profiler is None:
+            # Импорт здесь: профайлер нужен редко, а
+            # тянет за собой json и tracemalloc.
+            from profiling import Profiler
+            profiler = Profiler()
+        self.profiler = profiler
+        self.profiler.attach(self)
+        return self.profiler
+
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.detach()
+            self.profiler = None
+
     def set_render_context(self, render_context):
-        render_context.resize(
-            *self.field.get_canvas_size())
         self.render_context = render_context
-        if self.field.renderer.context is None:
-            self.field.renderer.context = render_context
+        self.field.set_render_context(render_context)
+        if self.profiler is not None:
+            # Обернуть методы нового контекста и
+            # рендерера.
+            self.profiler.attach(self)
+        self.resize_render_context()
+        self.field.invalidate()
         self.field.render()
 
-    def new_game(self, level, custom_params):
-        self._reset_game_state(self.level_field_map.get(level, custom_params))
+    def set_viewport(self, viewport):
+        """
+        Включает окно просмотра: рисуется только
+        видимая часть поля, а поле можно прокручивать
+        (scroll) и масштабировать (zoom).
+
+        :type viewport: viewports.Viewport
+        """
+        self.viewport = viewport
+        self.field.viewport = viewport
         if self.render_context is not None:
-            self.render_context.resize(*self.field.get_canvas_size())
+            self.resize_render_context()
+            self.field.invalidate()
+            self.field.render()
+
+    def resize_render_context(self):
+        canvas_size = self.field.get_canvas_size()
+        if self.viewport is not None:
+            self.viewport.move_to(
+                self.viewport.x, self.viewport.y, canvas_size)
+            canvas_size = self.viewport.get_view_size(canvas_size)
+        self.render_context.resize(*canvas_size)
+
+    def scroll(self, dx, dy):
+        """
+        Прокручивает окно просмотра на (dx, dy)
+        пикселей.
+        """
+        if self.viewport is None:
+            return
+        self.viewport.move_to(
+            self.viewport.x + dx, self.viewport.y + dy,
+            self.field.get_canvas_size())
         self.field.render()
 
-    def mouse_click(self, event):
-        if not self.game_active:
+    def zoom(self, cell_side, pixel=(0, 0)):
+        """
+        Меняет размер ячеек на cell_side пикселей,
+        оставляя точку поля под пикселем окна pixel
+        на месте.
+        """
+        renderer = self.field.renderer
+        if renderer is None or renderer.cell_size[0] == cell_side:
             return
+        x, y = self.field.get_canvas_pixel(pixel)
+        scale = cell_side / renderer.cell_size[0]
+        renderer.set_cell_side(cell_side)
+        if self.viewport is not None:
+            self.viewport.x = int(x * scale) - pixel[0]
+            self.viewport.y = int(y * scale) - pixel[1]
+        self.resize_render_context()
+        self.field.invalidate()
+        self.field.render()
+
+    def new_game(self, level, custom_params, seed=None):
+        """
+        :param seed: зерно генератора мин, позволяет
+            воспроизвести поле (например, для
+            бенчмарков и отчётов об ошибках).
+        """
+        self._create_game(level, custom_params, seed)
+        self.field.render()
+        if self.move_log is not None:
+            self.move_log.reset()
 
+    def _create_game(self, level, custom_params, seed):
+        """
+        Создаёт новое поле, но не отрисовывает его.
+        """
+        field_type = self.level_field_types.get(
+            level, self.geometry_field_types[self.geometry])
+        self.level = level
+        self._reset_game_state(
+            self.level_field_map.get(level, custom_params), seed, field_type)
+        if self.viewport is not None:
+            self.viewport.x = self.viewport.y = 0
+        if self.render_context is not None:
+            self.resize_render_context()
+
+    def mouse_click(self, event):
         position = self.field.get_position_by_pixel((event.x, event.y))
-        if self.field.valid_position(position):
-            idx = self.field.get_idx_by_position(position)
-            getattr(
-                self.field.cells[idx],
-                self.button_method_map[event.num]
-            )()
+        self.act(self.button_action_map[event.num], position)
+
+    def act(self, action, position):
+        """
+        Выполняет действие над ячейкой. Позволяет
+        играть программно, без событий Tk.
+
+        :param action: 'reveal', 'chord' или 'flag'
+        :param position: позиция ячейки
+        """
+        if self._apply_action(action, position):
             self.field.render()
 
-    def safe_cell_opened(self):
-        self.safe_opened_count += 1
+    def apply_actions(self, actions):
+        """
+        Выполняет пачку действий и отрисовывает
+        поле один раз в конце. Действия после
+        окончания игры игнорируются.
+
+        :param actions: последовательность пар
+            (действие, позиция), см. act
+        :return: список CellChange для ячеек, статус
+            которых изменился, в порядке индексов.
+            Ячейки, статус которых изменился только
+            из-за окончания игры, сюда не попадают:
+            их итоговые статусы вычисляются по запросу
+            (см. AbstractField.get_status).
+        """
+        field = self.field
+        field.changes = changes = {}
+        try:
+            for action, position in actions:
+                self._apply_action(action, position)
+        finally:
+            field.changes = None
+        field.render()
+
+        mined_around = field.state.mined_around
+        diff = []
+        for idx in sorted(changes):
+            status = field.get_status(idx)
+            if status == changes[idx]:
+                continue
+            diff.append(CellChange(
+                field.get_position_by_idx(idx),
+                CellStatus(status),
+                mined_around[idx] if status == CellStatus.NUMBER else None,
+            ))
+        return diff
+
+    def _apply_action(self, action, position):
+        """
+        Выполняет действие без отрисовки. Возвращает
+        False, если действие не выполнено.
+        """
+        self.update_timer()
+        if not self.game_active or not self.field.valid_position(position):
+            return False
+
+        idx = self.field.get_idx_by_position(position)
+        if self.move_log is not None:
+            self.move_log.record(action, idx, self.get_elapsed_time())
+        if self.history is None:
+            self._act_on_cell(action, idx)
+        else:
+            self.history.run(self._act_on_cell, action, idx)
+        return True
+
+    def _act_on_cell(self, action, idx):
+        # Ход считается до того, как выполнен:
+        # последний ход заканчивает игру, и в её
+        # итоге (см. get_result) он уже учтён.
+        self.moves_count += 1
+        getattr(
+            self.field.get_cell(idx),
+            self.action_method_map[action]
+        )(idx)
+
+    def undo(self):
+        """
+        Отменяет последний ход, включая окончание
+        игры, если ход к нему привёл. Мины при этом
+        остаются на месте. Возвращает False, если
+        отменять нечего.
+        """
+        game_active = self.game_active
+        if self.history is None or not self.history.undo():
+            return False
+        self._history_changed(game_active)
+        return True
+
+    def redo(self):
+        """
+        Повторяет последний отменённый ход.
+        Возвращает False, если повторять нечего.
+        """
+        game_active = self.game_active
+        if self.history is None or not self.history.redo():
+            return False
+        self._history_changed(game_active)
+        return True
+
+    def _history_changed(self, game_active):
+        if game_active != self.game_active:
+            # Итоговые статусы ячеек появляются или
+            # исчезают все сразу.
+            self.field.invalidate()
+        self.field.render()
+        if self.move_log is not None:
+            # Журнал ходов не умеет отменять ходы,
+            # поэтому сохраняется новый снимок.
+            self.move_log.reset()
+
+    def safe_cell_opened(self, count=1):
+        self.safe_opened_count += count
         if self.safe_opened_count == self.safe_count:
             self.all_safe_opened()
-        if self.game_start_clock is None:
-            self.game_start_clock = time.time()
+        self.timer.start()
 
     def mined_cell_opened(self):
         self.finish_game(False)
@@ -101,12 +406,44 @@ class GameManager:
     def add_mark(self, mark_count):
         self.mark_count += mark_count
 
+    def get_elapsed_time(self):
+        """
+        Возвращает время игры в секундах.
+        """
+        return self.timer.get_elapsed()
+
     def get_time_info(self):
-        if self.game_start_clock is None:
-            return 0
-        if self.game_finish_clock is None:
-            return int(0.5 + time.time() - self.game_start_clock)
-        return int(0.5 + self.game_finish_clock - self.game_start_clock)
+        return self.timer.get_display()
+
+    def get_time_info_delay(self):
+        """
+        Возвращает, через сколько секунд изменится
+        get_time_info, или None, если время стоит.
+        """
+        return self.timer.get_display_delay()
+
+    def update_timer(self):
+        """
+        Заканчивает игру, если истекло время
+        обратного отсчёта: все мины взрываются.
+        Проверка выполняется перед каждым ходом,
+        а интерфейс вызывает её, когда на табло
+        заканчивается время, поэтому в простое
+        таймер ничего не стоит.
+
+        :return: True, если игра закончилась
+        """
+        if not self.game_active or not self.timer.is_expired():
+            return False
+        if self.history is None:
+            self._detonate()
+        else:
+            self.history.run(self._detonate)
+        return True
+
+    def _detonate(self):
+        self.detonated = True
+        self.finish_game(False)
 
     def get_mines_info(self):
         return self.field_params.mines_count - self.mark_count
@@ -117,7 +454,41 @@ class GameManager:
     def finish_game(self, user_won):
         self.user_won = user_won
         self.game_active = False
-        self.game_finish_clock = time.time()
-        for cell in self.field.cells:
-            cell.set_final_status(user_won)
+        self.timer.stop()
+        if self.results is not None and self.history is None:
+            # В режиме тренировки ходы можно отменять,
+            # и такие результаты несравнимы с
+            # остальными.
+            self.results.add(self.get_result())
+        # Итоговые статусы ячеек вычисляются при
+        # отрисовке (см. AbstractField.get_status),
+        # поэтому перерисовываются только видимые.
+        self.field.invalidate()
         self.field.render()
+
+    def get_result(self):
+        """
+        Возвращает итог игры (api.GameRecord).
+        """
+        return GameRecord(
+            self.level, self.get_geometry(), *self.field_params,
+            seed=self.field.seed,
+            won=self.user_won,
+            elapsed=self.get_elapsed_time(),
+            moves=self.moves_count,
+            bbbv=self.field.count_3bv(),
+            player=self.player,
+            finished=time.time(),
+        )
+
+    def get_geometry(self):
+        """
+        Возвращает геометрию поля текущей игры. Она
+        определяется типом поля, а не атрибутом
+        geometry, который применяется только с новой
+        игры; огромные поля прямоугольные.
+        """
+        for geometry, field_type in self.geometry_field_types.items():
+            if isinstance(self.field, field_type):
+                return geometry
+        return 'rectangle'
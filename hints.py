@@ -0,0 +1,390 @@
+"""
+Подсказки: точная вероятность мины в каждой
+закрытой ячейке по тому, что видит игрок, и
+самый безопасный ход.
+"""
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from math import exp, lgamma
+
+from cells import CellStatus, FieldState
+
+
+Hint = namedtuple('Hint', ('probabilities', 'safest_idx', 'safest_probability'))
+Hint.__doc__ = """
+probabilities -- словарь {индекс ячейки: вероятность мины}
+для ячеек фронта (закрытых ячеек рядом с открытыми
+числами); для остальных закрытых ячеек вероятность
+одна и та же и хранится под ключом None.
+"""
+
+ComponentCounts = namedtuple('ComponentCounts', ('cells', 'totals', 'mined'))
+ComponentCounts.__doc__ = """
+Результат перебора одной компоненты фронта:
+cells -- ячейки компоненты;
+totals -- {k: количество расстановок с k минами};
+mined -- для каждой ячейки {k: количество расстановок
+с k минами, в которых ячейка заминирована}.
+"""
+
+
+def supports_hints(field):
+    """
+    Подсказки считаются по копии всего поля,
+    поэтому доступны только полям, хранящим
+    состояние в FieldState, -- не огромным полям
+    из чанков.
+    """
+    return isinstance(field.state, FieldState)
+
+
+class FieldSnapshot:
+    """
+    Копия видимого игроку состояния поля. Снимается
+    в потоке Tk и дальше читается фоновым потоком,
+    поэтому не ссылается на изменяемые массивы поля.
+    """
+    def __init__(self, field):
+        if not supports_hints(field):
+            raise TypeError(
+                'Подсказки поддерживаются только для полей, '
+                'хранящих состояние в FieldState!')
+        self.field_id = id(field)
+        self.cell_count = field.cell_count
+        self.mines_count = field.mines_count
+        self.statuses = bytes(field.state.statuses)
+        self.mined_around = bytes(field.state.mined_around)
+        self.get_neighbors = field.get_neighbors
+
+
+def get_constraints(snapshot):
+    """
+    Возвращает ограничения фронта: для каждой
+    открытой ячейки с числом -- кортеж её закрытых
+    соседей и количество мин среди них. Флаги
+    игрока не учитываются: они могут быть ошибочны.
+    """
+    statuses = snapshot.statuses
+    constraints = []
+    start = 0
+    number = bytes((CellStatus.NUMBER,))
+    while True:
+        idx = statuses.find(number, start)
+        if idx == -1:
+            break
+        start = idx + 1
+        if snapshot.mined_around[idx] == 0:
+            continue
+        closed = tuple(
+            neighbor for neighbor in snapshot.get_neighbors(idx)
+            if statuses[neighbor] != CellStatus.NUMBER
+        )
+        if closed:
+            constraints.append((closed, snapshot.mined_around[idx]))
+    return constraints
+
+
+def split_components(constraints):
+    """
+    Разбивает ограничения на независимые
+    компоненты -- группы, не имеющие общих ячеек.
+    """
+    parents = {}
+
+    def find(cell):
+        root = cell
+        while parents[root] != root:
+            root = parents[root]
+        while parents[cell] != root:
+            parents[cell], cell = root, parents[cell]
+        return root
+
+    for cells, _ in constraints:
+        for cell in cells:
+            parents.setdefault(cell, cell)
+        root = find(cells[0])
+        for cell in cells[1:]:
+            parents[find(cell)] = root
+
+    components = defaultdict(list)
+    for constraint in constraints:
+        components[find(constraint[0][0])].append(constraint)
+    return [tuple(sorted(component)) for component in components.values()]
+
+
+def count_component(constraints):
+    """
+    Перебирает все расстановки мин в компоненте
+    динамикой по ячейкам. Состояние -- остаток
+    мин в каждом ограничении; одинаковые состояния
+    склеиваются, поэтому перебор не экспоненциален
+    по длине фронта, а ограничен числом
+    одновременно "открытых" ограничений.
+
+    Прямой проход считает количество способов
+    дойти до состояния, обратный -- количество
+    способов закончить из него; их произведение
+    даёт число расстановок, в которых ячейка
+    заминирована.
+    """
+    cells = sorted({cell for cell_group, _ in constraints
+                    for cell in cell_group})
+    positions = {cell: i for i, cell in enumerate(cells)}
+    cell_constraints = [[] for _ in cells]
+    for constraint_idx, (cell_group, _) in enumerate(constraints):
+        for cell in cell_group:
+            cell_constraints[positions[cell]].append(constraint_idx)
+
+    # Сколько ячеек ограничения лежит на позициях
+    # не раньше данной.
+    cells_ahead = [[0] * len(constraints)]
+    for position in range(len(cells) - 1, -1, -1):
+        ahead = list(cells_ahead[-1])
+        for constraint_idx in cell_constraints[position]:
+            ahead[constraint_idx] += 1
+        cells_ahead.append(ahead)
+    cells_ahead.reverse()
+
+    def step(position, state, mine):
+        new_state = list(state)
+        ahead = cells_ahead[position + 1]
+        for constraint_idx in cell_constraints[position]:
+            left = new_state[constraint_idx] - mine
+            if left < 0 or left > ahead[constraint_idx]:
+                return None
+            new_state[constraint_idx] = left
+        return tuple(new_state)
+
+    initial = tuple(count for _, count in constraints)
+    forward = [{initial: {0: 1}}]
+    for position in range(len(cells)):
+        layer = defaultdict(lambda: defaultdict(int))
+        for state, ways in forward[-1].items():
+            for mine in (0, 1):
+                new_state = step(position, state, mine)
+                if new_state is None:
+                    continue
+                for mines, count in ways.items():
+                    layer[new_state][mines + mine] += count
+        forward.append(layer)
+
+    backward = {state: {0: 1} for state in forward[-1]}
+    mined = [None] * len(cells)
+    for position in range(len(cells) - 1, -1, -1):
+        layer = {}
+        cell_mined = defaultdict(int)
+        for state, ways in forward[position].items():
+            completions = defaultdict(int)
+            for mine in (0, 1):
+                new_state = step(position, state, mine)
+                if new_state is None:
+                    continue
+                for mines, count in backward[new_state].items():
+                    completions[mines + mine] += count
+                    if mine:
+                        for before, before_count in ways.items():
+                            cell_mined[before + mines + 1] += (
+                                before_count * count)
+            layer[state] = completions
+        backward = layer
+        mined[position] = dict(cell_mined)
+
+    return ComponentCounts(
+        tuple(cells), dict(backward.get(initial, {})), mined)
+
+
+def convolve(first, second):
+    result = defaultdict(int)
+    for first_mines, first_count in first.items():
+        for second_mines, second_count in second.items():
+            result[first_mines + second_mines] += first_count * second_count
+    return result
+
+
+def get_log_comb(n, k):
+    return lgamma(n + 1) - lgamma(k + 1) - lgamma(n - k + 1)
+
+
+def combine(components, free_count, mines_count):
+    """
+    Сводит компоненты вместе с учётом того,
+    что оставшиеся мины распределяются по
+    free_count ячейкам вне фронта:
+    расстановка с t минами на фронте имеет вес
+    C(free_count, mines_count - t).
+
+    Веса считаются в логарифмах относительно
+    максимального, чтобы не работать с огромными
+    биномиальными коэффициентами на больших полях.
+    """
+    def get_log_weight(frontier_mines):
+        free_mines = mines_count - frontier_mines
+        if not 0 <= free_mines <= free_count:
+            return None
+        return get_log_comb(free_count, free_mines)
+
+    # Свёртки всех компонент, кроме i-й,
+    # через префиксы и суффиксы.
+    prefixes = [{0: 1}]
+    for component in components:
+        prefixes.append(convolve(prefixes[-1], component.totals))
+    suffixes = [{0: 1}]
+    for component in reversed(components):
+        suffixes.append(convolve(suffixes[-1], component.totals))
+    suffixes.reverse()
+
+    log_weights = {
+        mines: get_log_weight(mines)
+        for mines in range(max(prefixes[-1]) + 1)
+    }
+    valid_logs = [log for log in log_weights.values() if log is not None]
+    if not valid_logs:
+        return {}
+    max_log = max(valid_logs)
+    weights = {
+        mines: (0.0 if log is None else exp(log - max_log))
+        for mines, log in log_weights.items()
+    }
+
+    def get_weight(frontier_mines):
+        return weights.get(frontier_mines, 0.0)
+
+    total = sum(
+        count * get_weight(mines) for mines, count in prefixes[-1].items())
+    if not total:
+        return {}
+
+    probabilities = {}
+    for i, component in enumerate(components):
+        others = convolve(prefixes[i], suffixes[i + 1])
+        for position, cell in enumerate(component.cells):
+            weight = 0.0
+            for mines, count in component.mined[position].items():
+                for other_mines, other_count in others.items():
+                    weight += count * other_count * get_weight(
+                        mines + other_mines)
+            probabilities[cell] = weight / total
+
+    if free_count:
+        free_weight = sum(
+            count * get_weight(mines) * (mines_count - mines) / free_count
+            for mines, count in prefixes[-1].items()
+        )
+        probabilities[None] = free_weight / total
+    return probabilities
+
+
+class HintCalculator:
+    """
+    Считает подсказки, запоминая результаты
+    перебора компонент. Компонента, ограничения
+    которой не изменились с прошлого хода, не
+    пересчитывается.
+    """
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.field_id = None
+
+    def get_component_counts(self, constraints):
+        counts = self.cache.get(constraints)
+        if counts is None:
+            counts = count_component(constraints)
+            self.cache[constraints] = counts
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(constraints)
+        return counts
+
+    def calculate(self, snapshot):
+        if snapshot.field_id != self.field_id:
+            self.cache.clear()
+            self.field_id = snapshot.field_id
+
+        components = [
+            self.get_component_counts(constraints)
+            for constraints in split_components(get_constraints(snapshot))
+        ]
+        frontier = set()
+        for component in components:
+            frontier.update(component.cells)
+
+        statuses = snapshot.statuses
+        closed = [
+            idx for idx in range(snapshot.cell_count)
+            if statuses[idx] != CellStatus.NUMBER
+        ]
+        free_count = len(closed) - len(frontier)
+        probabilities = combine(
+            components, free_count, snapshot.mines_count)
+        if not probabilities:
+            return Hint({}, None, None)
+
+        free_probability = probabilities.get(None)
+        safest_idx = None
+        safest_probability = 2.0
+        for idx in closed:
+            probability = probabilities.get(idx, free_probability)
+            if probability < safest_probability:
+                safest_idx = idx
+                safest_probability = probability
+        return Hint(probabilities, safest_idx, safest_probability)
+
+
+class HintEngine:
+    """
+    Считает подсказки в фоновом потоке, не
+    блокируя главный цикл Tk.
+
+    request() можно вызывать сколь угодно часто:
+    если поток ещё занят, ожидающий запрос просто
+    заменяется новым. Готовая подсказка передаётся
+    в publish из фонового потока, поэтому publish
+    не должен трогать виджеты напрямую (см.
+    TkWindow.publish_hint).
+    """
+    def __init__(self, publish):
+        self.publish = publish
+        self.calculator = HintCalculator()
+        self.condition = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self._run, name='hints', daemon=True)
+        self.thread.start()
+
+    def request(self, field):
+        snapshot = FieldSnapshot(field)
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def is_busy(self):
+        """
+        Истинно, пока есть запрос, подсказка по
+        которому ещё не опубликована.
+        """
+        with self.condition:
+            return self.busy or self.pending is not None
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                snapshot, self.pending = self.pending, None
+                self.busy = True
+            try:
+                self.publish(snapshot, self.calculator.calculate(snapshot))
+            finally:
+                with self.condition:
+                    self.busy = False
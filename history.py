@@ -0,0 +1,121 @@
+"""
+История ходов для отмены (undo) и повтора
+(redo).
+
+Вместо копий поля хранится журнал: для каждого
+хода -- индексы ячеек, статус которых он
+изменил, их старые и новые статусы и счётчики
+менеджера игры до и после хода. Поэтому отмена
+и повтор хода стоят столько же, сколько сам ход,
+а память ограничена глубиной истории.
+"""
+from array import array
+from collections import deque, namedtuple
+
+
+JournalEntry = namedtuple(
+    'JournalEntry',
+    ('indices', 'old_statuses', 'new_statuses', 'old_counters',
+     'new_counters'))
+JournalEntry.__doc__ = """
+Изменения одного хода. indices -- array('q')
+индексов ячеек, old_statuses и new_statuses --
+bytes статусов этих ячеек, счётчики -- значения
+атрибутов менеджера игры из History.counters и
+состояние таймера.
+"""
+
+
+class History:
+    # Атрибуты менеджера игры, которые меняются
+    # при ходах и восстанавливаются при отмене,
+    # вместе с состоянием таймера.
+    counters = (
+        'mark_count', 'moves_count', 'safe_opened_count', 'game_active',
+        'user_won', 'detonated',
+    )
+
+    def __init__(self, game_manager, depth):
+        """
+        :param depth: сколько последних ходов можно
+            отменить; более старые забываются
+        """
+        self.game_manager = game_manager
+        self.undo_entries = deque(maxlen=depth)
+        self.redo_entries = []
+
+    def get_counters(self):
+        return tuple(
+            getattr(self.game_manager, name) for name in self.counters
+        ) + (self.game_manager.timer.get_state(),)
+
+    def set_counters(self, values):
+        for name, value in zip(self.counters, values):
+            setattr(self.game_manager, name, value)
+        self.game_manager.timer.set_state(values[-1])
+
+    def run(self, function, *args):
+        """
+        Выполняет ход function(*args), записывая
+        изменения статусов через field.changes.
+        Ход, после которого и статусы всех ячеек, и
+        счётчики остались прежними, в историю не
+        попадает; ход, изменивший только счётчики
+        (например, взрыв по истечении времени),
+        попадает.
+        Новый ход очищает список отменённых ходов.
+        """
+        field = self.game_manager.field
+        old_counters = self.get_counters()
+        outer_changes = field.changes
+        field.changes = changes = {}
+        try:
+            function(*args)
+        finally:
+            field.changes = outer_changes
+            if outer_changes is not None:
+                # Изменения нужны и тому, кто собирал
+                # их снаружи (GameManager.apply_actions).
+                for idx, status in changes.items():
+                    outer_changes.setdefault(idx, status)
+
+        indices = array('q', changes)
+        old_statuses = bytes(changes.values())
+        new_statuses = bytes(map(field.state.statuses.__getitem__, indices))
+        new_counters = self.get_counters()
+        if old_statuses == new_statuses and old_counters == new_counters:
+            return
+        self.undo_entries.append(JournalEntry(
+            indices, old_statuses, new_statuses,
+            old_counters, new_counters))
+        self.redo_entries.clear()
+
+    def undo(self):
+        """
+        Отменяет последний ход. Возвращает False,
+        если отменять нечего.
+        """
+        if not self.undo_entries:
+            return False
+        entry = self.undo_entries.pop()
+        self.apply(entry.indices, entry.old_statuses, entry.old_counters)
+        self.redo_entries.append(entry)
+        return True
+
+    def redo(self):
+        """
+        Повторяет последний отменённый ход.
+        Возвращает False, если повторять нечего.
+        """
+        if not self.redo_entries:
+            return False
+        entry = self.redo_entries.pop()
+        self.apply(entry.indices, entry.new_statuses, entry.new_counters)
+        self.undo_entries.append(entry)
+        return True
+
+    def apply(self, indices, statuses, counters):
+        set_status = self.game_manager.field.set_status
+        for idx, status in zip(indices, statuses):
+            set_status(idx, status)
+        self.set_counters(counters)
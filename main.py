@@ -1,15 +1,52 @@
+import argparse
+
 from ui import TkWindow
 from game_managers import GameManager
 from fields import RectangleField
+from results import ResultsStore
+from saves import start_autosave
 
 
 def main():
-    main_window = TkWindow()
+    parser = argparse.ArgumentParser(description='Mines')
+    parser.add_argument(
+        '--compositing', action='store_true',
+        help='рисовать поле одним изображением, а не '
+             'отдельным элементом канвы на каждую ячейку')
+    parser.add_argument(
+        '--autosave', metavar='PATH',
+        help='продолжить игру, сохранённую в PATH, и '
+             'сохранять её туда после каждого хода')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='профилировать игру и при выходе записать '
+             'статистику в PATH в формате JSON')
+    parser.add_argument(
+        '--results', metavar='PATH',
+        help='записывать результаты игр в базу SQLite PATH '
+             '(таблица рекордов)')
+    args = parser.parse_args()
+
+    main_window = TkWindow(args.compositing)
     manager = GameManager()
     main_window.bind_manager(manager)
     manager.set_render_context(
         main_window.get_render_context())
+    if args.results:
+        manager.results = ResultsStore(args.results)
+    autosave = None
+    if args.autosave:
+        autosave = start_autosave(manager, args.autosave)
+    profiler = None
+    if args.profile:
+        profiler = manager.enable_profiling()
     main_window.run()
+    if autosave is not None:
+        autosave.close()
+    if profiler is not None:
+        profiler.dump(args.profile)
+    if manager.results is not None:
+        manager.results.close()
 
 
 if __name__ == '__main__':
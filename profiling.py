@@ -0,0 +1,365 @@
+"""
+Профилирование игры: время фаз (генерация поля,
+открытие ячеек, отрисовка...), счётчики
+(открытые ячейки, элементы канвы, запросы
+соседей), гистограмма задержки от клика до
+отрисовки и отчёт о памяти по размерам поля.
+
+Профайлер подключается к менеджеру игры
+(GameManager.enable_profiling) и оборачивает
+методы конкретных объектов -- менеджера, поля,
+рендерера и контекста рисования -- атрибутами
+экземпляров. Классы не меняются, поэтому, пока
+профайлер выключен, игра не платит за него
+ничего.
+
+Пример запуска отчёта:
+
+    python profiling.py --sizes 100x100x1000 1000x1000x150000 \\
+        --output profile.json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+
+from api import FieldParams
+
+
+class Profiler:
+    # Верхние границы корзин гистограммы задержки,
+    # в секундах; последняя корзина -- всё, что
+    # дольше.
+    latency_bounds = (
+        0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+    # Методы, время которых замеряется: имя метода
+    # и название фазы. Фазы вложены друг в друга:
+    # время reveal входит во время action.
+    manager_phases = (
+        ('_apply_action', 'action'),
+        ('finish_game', 'finish_game'),
+    )
+    field_phases = (
+        ('generate', 'generate'),
+        ('count_mined_around', 'count_mined_around'),
+        ('label_openings', 'label_openings'),
+        ('reveal', 'reveal'),
+        ('render', 'render'),
+    )
+    context_phases = (
+        ('flush', 'flush'),
+    )
+
+    # Методы, вызовы которых считаются: имя метода
+    # и название счётчика.
+    field_counters = (
+        ('get_neighbors', 'neighbor_queries'),
+        ('set_status', 'status_changes'),
+    )
+    renderer_counters = (
+        ('render', 'cells_rendered'),
+        ('remove', 'cells_removed'),
+    )
+    context_counters = (
+        ('draw_image', 'canvas_items'),
+        ('place_image', 'canvas_items'),
+    )
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.latencies = [0] * (len(self.latency_bounds) + 1)
+
+        # Обёрнутые методы: (объект, имя атрибута).
+        # Методы поля и рендерера оборачиваются
+        # заново для каждого нового поля.
+        self.manager_patches = []
+        self.field_patches = []
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+        self.latencies = [0] * (len(self.latency_bounds) + 1)
+
+    def add_time(self, phase, elapsed):
+        # [количество вызовов, суммарное время,
+        # наибольшее время]
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def record_latency(self, elapsed):
+        """
+        Добавляет в гистограмму задержку от клика до
+        отрисовки в секундах.
+        """
+        self.latencies[bisect_left(self.latency_bounds, elapsed)] += 1
+
+    def get_latency_percentile(self, fraction):
+        """
+        Возвращает верхнюю границу корзины, в
+        которую попадает доля fraction задержек
+        (None -- последняя, неограниченная корзина
+        или задержек не было).
+        """
+        total = sum(self.latencies)
+        if not total:
+            return None
+        accumulated = 0
+        for bound, count in zip(self.latency_bounds, self.latencies):
+            accumulated += count
+            if accumulated >= fraction * total:
+                return bound
+        return None
+
+    def timed(self, phase, method):
+        clock = self.clock
+        add_time = self.add_time
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                add_time(phase, clock() - start)
+        return wrapper
+
+    def counted(self, counter, method):
+        counters = self.counters
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            counters[counter] = counters.get(counter, 0) + 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def patch(self, patches, obj, name, wrapper):
+        setattr(obj, name, wrapper(getattr(obj, name)))
+        patches.append((obj, name))
+
+    def patch_all(self, patches, obj, phases, counters):
+        for name, phase in phases:
+            self.patch(patches, obj, name, lambda m, p=phase: self.timed(p, m))
+        for name, counter in counters:
+            self.patch(
+                patches, obj, name, lambda m, c=counter: self.counted(c, m))
+
+    @staticmethod
+    def unpatch(patches):
+        # Удаление атрибута экземпляра снова
+        # открывает метод класса.
+        for obj, name in reversed(patches):
+            delattr(obj, name)
+        patches.clear()
+
+    def attach(self, game_manager):
+        self.detach()
+        patches = self.manager_patches
+        self.patch_all(patches, game_manager, self.manager_phases, ())
+
+        def count_opened(method):
+            @wraps(method)
+            def wrapper(count=1):
+                self.count('cells_revealed', count)
+                return method(count)
+            return wrapper
+        self.patch(patches, game_manager, 'safe_cell_opened', count_opened)
+
+        if game_manager.render_context is not None:
+            self.patch_all(
+                patches, game_manager.render_context,
+                self.context_phases, self.context_counters)
+        self.attach_field(game_manager.field)
+
+    def attach_field(self, field):
+        """
+        Оборачивает методы нового поля, сняв обёртки
+        с предыдущего.
+        """
+        self.unpatch(self.field_patches)
+        self.patch_all(
+            self.field_patches, field, self.field_phases, self.field_counters)
+        if field.renderer is not None:
+            self.patch_all(
+                self.field_patches, field.renderer, (),
+                self.renderer_counters)
+
+    def detach(self):
+        self.unpatch(self.field_patches)
+        self.unpatch(self.manager_patches)
+
+    def get_stats(self):
+        """
+        Возвращает собранную статистику в виде,
+        пригодном для JSON.
+        """
+        return OrderedDict((
+            ('phases', OrderedDict(
+                (phase, OrderedDict((
+                    ('count', count),
+                    ('total', total),
+                    ('mean', total / count),
+                    ('max', maximum),
+                )))
+                for phase, (count, total, maximum) in self.phases.items()
+            )),
+            ('counters', OrderedDict(self.counters)),
+            ('latency', OrderedDict((
+                ('bounds', self.latency_bounds),
+                ('histogram', self.latencies),
+                ('p50', self.get_latency_percentile(0.5)),
+                ('p99', self.get_latency_percentile(0.99)),
+            ))),
+        ))
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.get_stats(), output, indent=2)
+
+    def format_summary(self):
+        """
+        Возвращает краткую сводку для отладочного
+        оверлея.
+        """
+        lines = [
+            '{}: {} x {:.1f} ms (max {:.1f})'.format(
+                phase, count, 1000 * total / count, 1000 * maximum)
+            for phase, (count, total, maximum) in self.phases.items()
+        ]
+        lines.extend(
+            '{}: {}'.format(counter, value)
+            for counter, value in self.counters.items())
+        if sum(self.latencies):
+            lines.append('click-to-paint: p50 <= {} ms, p99 <= {} ms'.format(
+                *(format_bound(self.get_latency_percentile(fraction))
+                  for fraction in (0.5, 0.99))))
+        return '\n'.join(lines)
+
+
+def format_bound(bound):
+    return 'inf' if bound is None else '{:g}'.format(1000 * bound)
+
+
+def measure_memory(game_manager, level, field_params, seed=0, top=5):
+    """
+    Замеряет память, выделенную при создании
+    поля и при первом клике в его центр.
+
+    :param top: сколько мест в коде, выделивших
+        больше всего памяти, включить в отчёт
+    """
+    # Таблица соседства кэшируется между играми;
+    # без сброса кэша она не попала бы в отчёт.
+    from fields import get_adjacency
+    get_adjacency.cache_clear()
+
+    tracemalloc.start()
+    try:
+        game_manager.new_game(level, field_params, seed)
+        after_new_game = tracemalloc.get_traced_memory()[0]
+        field = game_manager.field
+        center = field.cell_count // 2 + field.width // 2
+        game_manager.act('reveal', field.get_position_by_idx(center))
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+    finally:
+        tracemalloc.stop()
+
+    return OrderedDict((
+        ('new_game', after_new_game),
+        ('after_first_click', current),
+        ('peak', peak),
+        ('bytes_per_cell', current / field.cell_count),
+        ('top', [
+            OrderedDict((
+                ('location', '{}:{}'.format(
+                    stat.traceback[0].filename, stat.traceback[0].lineno)),
+                ('size', stat.size),
+                ('count', stat.count),
+            ))
+            for stat in statistics[:top]
+        ]),
+    ))
+
+
+def parse_size(text):
+    try:
+        width, height, mines_count = map(int, text.split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Размер поля задаётся как ШИРИНАxВЫСОТАxМИНЫ: {}'.format(text))
+    return FieldParams(width, height, mines_count)
+
+
+def main(argv=None):
+    from game_managers import GameManager, LevelEnum
+    from renderers import NullRenderContext
+
+    parser = argparse.ArgumentParser(
+        description='Профиль и отчёт о памяти по размерам поля')
+    parser.add_argument(
+        '--sizes', nargs='+', type=parse_size,
+        default=(FieldParams(100, 100, 1000),
+                 FieldParams(1000, 1000, 150000)),
+        help='размеры полей вида 100x100x1000')
+    parser.add_argument(
+        '--geometry', default='rectangle',
+        choices=('rectangle', 'hexagonal', 'voronoi'))
+    parser.add_argument(
+        '--seed', type=int, default=0, help='зерно генератора мин')
+    parser.add_argument(
+        '--output', help='файл для результатов в формате JSON')
+    args = parser.parse_args(argv)
+
+    report = OrderedDict()
+    for field_params in args.sizes:
+        name = '{}x{}x{}'.format(*field_params)
+        manager = GameManager()
+        manager.geometry = args.geometry
+        memory = measure_memory(
+            manager, LevelEnum.CUSTOM, field_params, args.seed)
+
+        # Профиль снимается отдельной игрой: обёртки
+        # профайлера исказили бы отчёт о памяти.
+        manager = GameManager()
+        manager.geometry = args.geometry
+        manager.set_render_context(NullRenderContext())
+        profiler = manager.enable_profiling()
+        manager.new_game(LevelEnum.CUSTOM, field_params, args.seed)
+        field = manager.field
+        center = field.cell_count // 2 + field.width // 2
+        start = time.perf_counter()
+        manager.act('reveal', field.get_position_by_idx(center))
+        profiler.record_latency(time.perf_counter() - start)
+        manager.finish_game(False)
+        manager.disable_profiling()
+
+        report[name] = OrderedDict((
+            ('memory', memory),
+            ('profile', profiler.get_stats()),
+        ))
+        print('{}: {:.1f} bytes per cell, peak {:.1f} MB'.format(
+            name, memory['bytes_per_cell'], memory['peak'] / 2**20))
+        print(profiler.format_summary())
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
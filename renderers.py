@@ -1,13 +1,15 @@
-import os.path
 from copy import copy
 from abc import abstractmethod
-
-import tkinter as tk
-from PIL import Image, ImageTk
+from collections import OrderedDict
+from math import sqrt
 
 from api import SingletonAbcMeta
 from cells import CellStatus
 
+# PIL и атлас спрайтов импортируются там, где
+# нужны: безголовые контексты (NullRenderContext,
+# RecordingRenderContext) от них не зависят.
+
 
 class AbstractRenderContext(metaclass=SingletonAbcMeta):
     """
@@ -18,6 +20,38 @@ class AbstractRenderContext(metaclass=SingletonAbcMeta):
     def draw_image(self, position, image):
         pass
 
+    @abstractmethod
+    def create_image(self, image):
+        """
+        Преобразует PIL-изображение в объект,
+        который можно передавать в draw_image
+        и place_image этого контекста.
+        """
+
+    @abstractmethod
+    def place_image(self, key, position, image):
+        """
+        Рисует изображение, привязанное к ключу key.
+        Повторный вызов с тем же ключом заменяет
+        ранее нарисованное изображение, не создавая
+        новый примитив.
+        """
+
+    @abstractmethod
+    def remove_image(self, key):
+        """
+        Удаляет изображение, нарисованное через
+        place_image с ключом key.
+        """
+
+    @abstractmethod
+    def set_view(self, x, y):
+        """
+        Показывает область рисунка, левый верхний
+        угол которой -- пиксель (x, y). Размер
+        области задаётся через resize.
+        """
+
     @abstractmethod
     def draw_rectangle(self, position, size):
         pass
@@ -34,18 +68,72 @@ class AbstractRenderContext(metaclass=SingletonAbcMeta):
     def clear(self):
         pass
 
+    def flush(self):
+        """
+        Вызывается в конце отрисовки кадра.
+        Контексты, которые копят изменения,
+        выводят их здесь.
+        """
+
 
 class TkRenderContext(AbstractRenderContext):
+    """
+    Рисует на канве Tk. Модули Tk импортируются
+    здесь, а не на уровне модуля, чтобы безголовые
+    контексты не зависели от них.
+    """
     def __init__(self, canvas=None):
         """
         :type canvas: tkinter.Canvas
         """
         self.canvas = canvas
 
+        # Элементы канвы, созданные через place_image,
+        # и изображения, которые в них показаны.
+        self.items = {}
+        self.item_images = {}
+        self.size = None
+        self.view = None
+
+    def create_image(self, image):
+        from PIL import ImageTk
+        return ImageTk.PhotoImage(image)
+
     def draw_image(self, position, image):
+        import tkinter as tk
+        from PIL import ImageTk
         assert isinstance(image, (tk.PhotoImage, ImageTk.PhotoImage)), \
                'Image must be tkinter.PhotoImage or ImageTk.PhotoImage!'
-        self.canvas.create_image(position, image=image, anchor=tk.NW)
+        return self.canvas.create_image(position, image=image, anchor=tk.NW)
+
+    def place_image(self, key, position, image):
+        item = self.items.get(key)
+        if item is None:
+            self.items[key] = self.draw_image(position, image)
+        elif self.item_images[key] is not image:
+            self.canvas.itemconfigure(item, image=image)
+        self.item_images[key] = image
+
+    def remove_image(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.canvas.delete(item)
+            del self.item_images[key]
+
+    def set_view(self, x, y):
+        """
+        Канва прокручивается через scrollregion,
+        совпадающую с видимой областью, поэтому
+        изображения остаются в координатах рисунка
+        поля и при прокрутке не перемещаются.
+        """
+        if self.view == (x, y):
+            return
+        self.view = (x, y)
+        width, height = self.size
+        self.canvas.configure(scrollregion=(x, y, x + width, y + height))
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
 
     def draw_rectangle(self, position, size):
         bbox = (
@@ -66,6 +154,8 @@ class TkRenderContext(AbstractRenderContext):
         self.canvas = canvas
 
     def resize(self, width, height):
+        self.size = (width, height)
+        self.view = None
         self.canvas.configure(
             width=width,
             height=height
@@ -73,6 +163,241 @@ class TkRenderContext(AbstractRenderContext):
 
     def clear(self):
         self.canvas.delete('all')
+        self.items.clear()
+        self.item_images.clear()
+
+
+class CompositingRenderContext(TkRenderContext):
+    """
+    Рисует всё видимое поле в один буфер Pillow
+    и показывает его одним изображением на канве.
+    place_image только копирует тайл в буфер, а
+    flush выводит в PhotoImage прямоугольник,
+    охватывающий изменения кадра. Количество
+    элементов канвы не зависит от размера поля.
+    """
+    background = (192, 192, 192)
+
+    def __init__(self, canvas=None):
+        super().__init__(canvas)
+        # Изображения, нарисованные через place_image:
+        # ключ -> (позиция, изображение). Нужны, чтобы
+        # собрать буфер заново при прокрутке.
+        self.tiles = {}
+
+        # Пиксель рисунка поля в левом верхнем углу
+        # буфера, сам буфер и изменённая с последнего
+        # flush область буфера (left, top, right, bottom).
+        self.origin = (0, 0)
+        self.buffer = None
+        self.dirty_box = None
+
+        self.photo = None
+        self.photo_item = None
+
+    def create_image(self, image):
+        if image.mode == 'RGBA' and image.getextrema()[3][0] < 255:
+            # Спрайты с прозрачными краями (например,
+            # шестиугольники) вклеиваются по маске.
+            return image
+        return image.convert('RGB')
+
+    def draw_image(self, position, image):
+        self._paste(position, image)
+
+    def place_image(self, key, position, image):
+        tile = self.tiles.get(key)
+        if (tile is not None and tile[1] is image
+                and tile[0] == position):
+            return
+        self.tiles[key] = (position, image)
+        self._paste(position, image)
+
+    def remove_image(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is not None:
+            position, image = tile
+            self._paste(position, self.background, image.size)
+
+    def _paste(self, position, image, size=None):
+        """
+        Копирует изображение (или заливает цветом
+        прямоугольник size) в буфер, обрезая его по
+        границам буфера.
+        """
+        if self.buffer is None:
+            return
+        if size is None:
+            size = image.size
+        left = position[0] - self.origin[0]
+        top = position[1] - self.origin[1]
+        right = left + size[0]
+        bottom = top + size[1]
+        width, height = self.buffer.size
+        if right <= 0 or bottom <= 0 or left >= width or top >= height:
+            return
+        if isinstance(image, tuple):
+            self.buffer.paste(image, (left, top, right, bottom))
+        elif image.mode == 'RGBA':
+            self.buffer.paste(image, (left, top), image)
+        else:
+            self.buffer.paste(image, (left, top))
+        self._extend_dirty_box((
+            max(left, 0), max(top, 0),
+            min(right, width), min(bottom, height)))
+
+    def _extend_dirty_box(self, box):
+        if self.dirty_box is None:
+            self.dirty_box = box
+        else:
+            self.dirty_box = (
+                min(self.dirty_box[0], box[0]),
+                min(self.dirty_box[1], box[1]),
+                max(self.dirty_box[2], box[2]),
+                max(self.dirty_box[3], box[3]),
+            )
+
+    def recomposite(self):
+        """
+        Собирает буфер заново из запомненных тайлов.
+        """
+        self.buffer.paste(self.background, (0, 0) + self.buffer.size)
+        self.dirty_box = (0, 0) + self.buffer.size
+        for position, image in self.tiles.values():
+            self._paste(position, image)
+
+    def set_view(self, x, y):
+        if self.view == (x, y):
+            return
+        super().set_view(x, y)
+        self.origin = (x, y)
+        if self.photo_item is not None:
+            self.canvas.coords(self.photo_item, x, y)
+        self.recomposite()
+
+    def resize(self, width, height):
+        from PIL import Image, ImageTk
+        super().resize(width, height)
+        self.buffer = Image.new('RGB', (width, height), self.background)
+        self.photo = ImageTk.PhotoImage(self.buffer)
+        if self.photo_item is not None:
+            self.canvas.itemconfigure(self.photo_item, image=self.photo)
+        self.recomposite()
+
+    def clear(self):
+        super().clear()
+        self.photo_item = None
+        self.tiles.clear()
+        if self.buffer is not None:
+            self.recomposite()
+
+    def flush(self):
+        """
+        Выводит изменённую область буфера. Весь
+        буфер копируется в PhotoImage напрямую, а
+        его часть -- через промежуточное изображение
+        и команду Tk "copy -to".
+        """
+        import tkinter as tk
+        from PIL import ImageTk
+        if self.photo_item is None and self.photo is not None:
+            self.photo_item = self.canvas.create_image(
+                self.origin, image=self.photo, anchor=tk.NW)
+        box = self.dirty_box
+        if box is None or box[0] >= box[2] or box[1] >= box[3]:
+            return
+        self.dirty_box = None
+        if box == (0, 0) + self.buffer.size:
+            self.photo.paste(self.buffer)
+            return
+        patch = ImageTk.PhotoImage(self.buffer.crop(box))
+        self.photo.tk.call(
+            str(self.photo), 'copy', str(patch), '-to', box[0], box[1])
+
+
+class NullRenderContext(AbstractRenderContext):
+    """
+    Контекст, который ничего не рисует. Позволяет
+    играть и измерять производительность без Tk.
+    """
+    def create_image(self, image):
+        return image
+
+    def draw_image(self, position, image):
+        pass
+
+    def place_image(self, key, position, image):
+        pass
+
+    def remove_image(self, key):
+        pass
+
+    def set_view(self, x, y):
+        pass
+
+    def draw_rectangle(self, position, size):
+        pass
+
+    def draw_text(self, position, text, font):
+        pass
+
+    def resize(self, width, height):
+        pass
+
+    def clear(self):
+        pass
+
+
+class RecordingRenderContext(AbstractRenderContext):
+    """
+    Контекст, который запоминает все вызовы
+    рисования в calls, а содержимое, нарисованное
+    через place_image, -- в items. Предназначен
+    для проверки рендереров без Tk.
+    """
+    def __init__(self):
+        self.calls = []
+        self.items = {}
+        self.size = None
+        self.view = None
+
+    def reset(self):
+        self.calls.clear()
+        self.items.clear()
+        self.size = None
+        self.view = None
+
+    def create_image(self, image):
+        return image
+
+    def draw_image(self, position, image):
+        self.calls.append(('draw_image', position, image))
+
+    def place_image(self, key, position, image):
+        self.calls.append(('place_image', key, position, image))
+        self.items[key] = (position, image)
+
+    def remove_image(self, key):
+        self.calls.append(('remove_image', key))
+        del self.items[key]
+
+    def set_view(self, x, y):
+        self.calls.append(('set_view', x, y))
+        self.view = (x, y)
+
+    def draw_rectangle(self, position, size):
+        self.calls.append(('draw_rectangle', position, size))
+
+    def draw_text(self, position, text, font):
+        self.calls.append(('draw_text', position, text, font))
+
+    def resize(self, width, height):
+        self.calls.append(('resize', width, height))
+        self.size = (width, height)
+
+    def clear(self):
+        self.calls.append(('clear',))
+        self.items.clear()
 
 
 class AbstractRenderer(metaclass=SingletonAbcMeta):
@@ -80,9 +405,12 @@ class AbstractRenderer(metaclass=SingletonAbcMeta):
         self.context = context
 
     @abstractmethod
-    def render(self, cell):
+    def render(self, field, idx):
         pass
 
+    def remove(self, idx):
+        self.context.remove_image(idx)
+
     @abstractmethod
     def clear(self):
         pass
@@ -91,33 +419,37 @@ class AbstractRenderer(metaclass=SingletonAbcMeta):
 class RectangleRenderer(AbstractRenderer):
     def __init__(self, context):
         super().__init__(context)
+        # Спрайты в виде PIL-изображений
+        self.number_sprites = None
+        self.status_sprites = None
+
+        # Те же спрайты, подготовленные контекстом
+        # рисования images_context.
         self.images = None
         self.numbers = None
-        self.images_are_got = False
+        self.images_context = None
         self.cell_size = None
-        self.get_images()
+        self.load_sprites()
 
-    def get_images(self):
-        def get_sprite(idx):
-            return ImageTk.PhotoImage(sprite.crop((
-                0, idx * width,
-                width, (idx+1) * width
-            )))
-        path_to_curren_module = os.path.abspath(__file__)
-        path_to_sprite = os.path.join(
-            os.path.dirname(path_to_curren_module),
-            'res',
-            'sprite.jpg'
-        )
-        sprite = Image.open(path_to_sprite)
-        width = sprite.size[0]
+    def load_sprites(self, side=None):
+        """
+        Берёт спрайты ячеек из атласа. Не требует
+        контекста рисования, поэтому поле можно
+        создать без Tk.
 
-        self.cell_size = (width, width)
+        :param side: сторона ячейки в пикселях;
+            None -- исходный размер спрайта
+        """
+        from sprites import get_atlas
+        atlas = get_atlas()
+        tiles = atlas.get_tiles(side)
+        side = tiles[0].size[0]
+        self.cell_size = (side, side)
 
         numbers_range = range(8, -1, -1)
         ids_range = range(7, 16)
-        self.numbers = {
-            number: get_sprite(sprite_idx)
+        self.number_sprites = {
+            number: tiles[sprite_idx]
             for number, sprite_idx
             in zip(numbers_range, ids_range)
         }
@@ -131,37 +463,233 @@ class RectangleRenderer(AbstractRenderer):
             CellStatus.PASSIVE_MINE
         )
         ids_range = range(len(statuses))
-        self.images = {
-            status: get_sprite(sprite_idx)
+        self.status_sprites = {
+            status: tiles[sprite_idx]
             for status, sprite_idx
             in zip(statuses, ids_range)
         }
-        self.images_are_got = True
 
-    def render(self, cell):
+    def set_cell_side(self, side):
+        """
+        Меняет масштаб: ячейки рисуются квадратами
+        со стороной side пикселей. Поле после этого
+        нужно перерисовать целиком.
+        """
+        self.load_sprites(side)
+        self.images_context = None
+
+    def get_images(self):
+        create_image = self.context.create_image
+        self.numbers = {
+            number: create_image(sprite)
+            for number, sprite in self.number_sprites.items()
+        }
+        self.images = {
+            status: create_image(sprite)
+            for status, sprite in self.status_sprites.items()
+        }
+        self.images_context = self.context
+
+    def render(self, field, idx):
         if self.context is None:
             return
 
-        if not self.images_are_got:
+        if self.images_context is not self.context:
             self.get_images()
 
-        if cell.status == CellStatus.NUMBER:
-            sprite = self.numbers[cell.mined_around]
+        status = field.get_status(idx)
+        if status == CellStatus.NUMBER:
+            sprite = self.numbers[field.state.mined_around[idx]]
         else:
-            sprite = self.images[cell.status]
+            sprite = self.images[status]
+
+        self.context.place_image(
+            idx, self.get_cell_position(field, idx), sprite)
 
-        position = (
+    def get_cell_position(self, field, idx):
+        """
+        Возвращает левый верхний пиксель ячейки
+        idx на рисунке поля.
+        """
+        row, column = field.get_position_by_idx(idx)
+        return (
             # ширину ячейки умножаем на номер столбца
-            self.cell_size[0] * cell.position[1],
+            self.cell_size[0] * column,
 
             # высоту ячейки умножаем на номер строки
-            self.cell_size[1] * cell.position[0],
+            self.cell_size[1] * row,
         )
-        self.context.draw_image(position, sprite)
+
+    def get_cell_box(self, field, idx):
+        """
+        Возвращает прямоугольник (left, top, right,
+        bottom), в который вписана ячейка idx.
+        """
+        left, top = self.get_cell_position(field, idx)
+        return (left, top,
+                left + self.cell_size[0], top + self.cell_size[1])
 
     def clear(self):
         self.context.clear()
 
 
-class HexagonalRenderer(AbstractRenderer):
-    pass
+class HexagonalRenderer(RectangleRenderer):
+    """
+    Рисует HexagonalField. Спрайты -- те же, что
+    у прямоугольного поля, обрезанные маской
+    шестиугольника шириной W и высотой H. Высота
+    кратна четырём, чтобы шаг между строками, 3H/4,
+    был целым числом пикселей.
+    """
+    def load_sprites(self, side=None):
+        from PIL import Image, ImageDraw
+        super().load_sprites(side)
+        width = self.cell_size[0]
+        height = max(4, 4 * round(width * 2 / sqrt(3) / 4))
+        self.cell_size = (width, height)
+
+        mask = Image.new('L', self.cell_size, 0)
+        ImageDraw.Draw(mask).polygon((
+            (width / 2, 0), (width, height / 4),
+            (width, height * 3 / 4), (width / 2, height),
+            (0, height * 3 / 4), (0, height / 4),
+        ), fill=255)
+
+        def cut(sprite):
+            sprite = sprite.resize(self.cell_size, Image.LANCZOS)
+            sprite.putalpha(mask)
+            return sprite
+
+        self.number_sprites = {
+            number: cut(sprite)
+            for number, sprite in self.number_sprites.items()
+        }
+        self.status_sprites = {
+            status: cut(sprite)
+            for status, sprite in self.status_sprites.items()
+        }
+
+    def get_cell_position(self, field, idx):
+        row, column = divmod(idx, field.width)
+        width, height = self.cell_size
+        return (
+            width * column + (width // 2 if row & 1 else 0),
+            height * 3 // 4 * row,
+        )
+
+
+class VoronoiRenderer(RectangleRenderer):
+    """
+    Рисует VoronoiField. Изображение ячейки --
+    многоугольник, залитый средним цветом спрайта,
+    со спрайтом по центру ячейки. Готовые
+    изображения кэшируются по форме и спрайту, с
+    ограничением на их количество. Маски
+    многоугольников не кэшируются: на разбиении
+    со случайными центрами формы ячеек почти не
+    повторяются.
+    """
+    max_cell_images = 8192
+    outline = (96, 96, 96, 255)
+
+    def __init__(self, context):
+        self.cell_images = OrderedDict()
+        self.colors = None
+        super().__init__(context)
+
+    def load_sprites(self, side=None):
+        """
+        cell_size -- сторона квадрата сетки центров;
+        спрайты берутся чуть меньше, чтобы помещаться
+        в ячейку.
+        """
+        from PIL import Image
+        from sprites import get_atlas
+        if side is None:
+            side = get_atlas().tile_side
+        super().load_sprites(max(4, side * 3 // 4))
+        self.cell_size = (side, side)
+
+        def get_color(sprite):
+            return sprite.convert('RGBA').resize((1, 1), Image.BOX).getpixel(
+                (0, 0))
+        self.colors = {
+            id(sprite): get_color(sprite)
+            for sprite in tuple(self.number_sprites.values())
+            + tuple(self.status_sprites.values())
+        }
+        self.cell_images.clear()
+
+    def get_images(self):
+        # Изображения ячеек создаются по мере
+        # отрисовки, см. get_cell_image.
+        self.cell_images.clear()
+        self.images_context = self.context
+
+    def get_cell_shape(self, field, idx):
+        """
+        Возвращает левый верхний пиксель ячейки и
+        её форму: размер, вершины и центр
+        относительно этого пикселя.
+        """
+        side = self.cell_size[0]
+        tiling = field.tiling
+        polygon = [(x * side, y * side) for x, y in tiling.polygons[idx]]
+        left = int(min(x for x, _ in polygon))
+        top = int(min(y for _, y in polygon))
+        right = int(max(x for x, _ in polygon)) + 1
+        bottom = int(max(y for _, y in polygon)) + 1
+        point = tiling.points[idx]
+        shape = (
+            (right - left, bottom - top),
+            tuple((round(x - left), round(y - top)) for x, y in polygon),
+            (round(point[0] * side - left), round(point[1] * side - top)),
+        )
+        return (left, top), shape
+
+    def get_cell_image(self, shape, sprite):
+        key = (shape, id(sprite))
+        image = self.cell_images.get(key)
+        if image is not None:
+            self.cell_images.move_to_end(key)
+            return image
+
+        from PIL import Image, ImageDraw
+        size, vertices, center = shape
+        cell = Image.new('RGBA', size, self.colors[id(sprite)])
+        cell.paste(sprite, (center[0] - sprite.size[0] // 2,
+                            center[1] - sprite.size[1] // 2))
+        ImageDraw.Draw(cell).polygon(vertices, outline=self.outline)
+        mask = Image.new('L', size, 0)
+        ImageDraw.Draw(mask).polygon(vertices, fill=255)
+        cell.putalpha(mask)
+
+        image = self.context.create_image(cell)
+        self.cell_images[key] = image
+        if len(self.cell_images) > self.max_cell_images:
+            self.cell_images.popitem(last=False)
+        return image
+
+    def render(self, field, idx):
+        if self.context is None:
+            return
+
+        if self.images_context is not self.context:
+            self.get_images()
+
+        status = field.get_status(idx)
+        if status == CellStatus.NUMBER:
+            sprite = self.number_sprites[field.state.mined_around[idx]]
+        else:
+            sprite = self.status_sprites[status]
+
+        position, shape = self.get_cell_shape(field, idx)
+        self.context.place_image(
+            idx, position, self.get_cell_image(shape, sprite))
+
+    def get_cell_position(self, field, idx):
+        return self.get_cell_shape(field, idx)[0]
+
+    def get_cell_box(self, field, idx):
+        (left, top), shape = self.get_cell_shape(field, idx)
+        return left, top, left + shape[0][0], top + shape[0][1]
@@ -0,0 +1,219 @@
+"""
+Хранилище результатов игр в SQLite: таблица
+рекордов по уровням и статистика, в том числе
+по симуляциям.
+
+Результаты записывает фоновый поток: add
+только кладёт запись в очередь, а поток
+забирает из неё всё накопившееся (не больше
+batch_size записей) и вставляет одной
+транзакцией. Игра и симуляция не ждут диска, а
+при наплыве результатов пачки становятся
+крупнее, и транзакций на запись приходится
+меньше.
+
+Запросы выполняются через отдельное
+соединение. База работает в режиме WAL, так
+что чтение не ждёт записи. Рекорды и
+статистика читаются по индексам, не трогая
+саму таблицу.
+
+Пример подключения к игре:
+
+    store = ResultsStore('results.sqlite')
+    game_manager.results = store
+    ...
+    store.get_leaderboard(LevelEnum.WARRIOR, FieldParams(30, 16, 99))
+    store.close()
+"""
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+
+from api import GameRecord
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    level INTEGER NOT NULL,
+    geometry TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mines_count INTEGER NOT NULL,
+    seed INTEGER,
+    won INTEGER NOT NULL,
+    elapsed REAL NOT NULL,
+    moves INTEGER NOT NULL,
+    bbbv INTEGER,
+    player TEXT NOT NULL,
+    finished REAL NOT NULL
+);
+
+-- Рекорды: только выигранные игры, внутри
+-- каждого поля упорядоченные по времени.
+CREATE INDEX IF NOT EXISTS games_leaderboard ON games (
+    player, level, geometry, width, height, mines_count, elapsed
+) WHERE won;
+
+-- Статистика: покрывающий индекс в порядке
+-- группировки.
+CREATE INDEX IF NOT EXISTS games_statistics ON games (
+    player, level, geometry, width, height, mines_count,
+    won, elapsed, moves, bbbv
+);
+"""
+
+COLUMNS = ', '.join(GameRecord._fields)
+
+INSERT = 'INSERT INTO games ({}) VALUES ({})'.format(
+    COLUMNS, ', '.join('?' * len(GameRecord._fields)))
+
+LEADERBOARD = """
+SELECT {} FROM games
+WHERE won AND player = ? AND level = ? AND geometry = ?
+    AND width = ? AND height = ? AND mines_count = ?
+ORDER BY elapsed
+LIMIT ?
+""".format(COLUMNS)
+
+STATISTICS = """
+SELECT level, geometry, width, height, mines_count,
+    count(*), sum(won),
+    min(CASE WHEN won THEN elapsed END),
+    avg(CASE WHEN won THEN elapsed END),
+    avg(moves), avg(bbbv)
+FROM games
+WHERE player = ?
+GROUP BY level, geometry, width, height, mines_count
+"""
+
+FieldStatistics = namedtuple(
+    'FieldStatistics',
+    ('level', 'geometry', 'width', 'height', 'mines_count', 'games',
+     'wins', 'best_elapsed', 'mean_elapsed', 'mean_moves', 'mean_bbbv')
+)
+FieldStatistics.__doc__ = """
+Статистика игр на одном поле. Время (лучшее и
+среднее) считается только по выигранным играм,
+ходы и 3BV -- по всем.
+"""
+
+
+class ResultsStore:
+    """
+    Подключается к менеджеру игры через
+    GameManager.results.
+    """
+    def __init__(self, path, batch_size=10000):
+        """
+        :param path: файл базы. База в памяти
+            (':memory:') не подходит: у потока записи
+            своё соединение.
+        :param batch_size: наибольшее количество
+            записей в одной транзакции
+        """
+        self.path = path
+        self.batch_size = batch_size
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+        # Ошибка, на которой остановился поток
+        # записи; пробрасывается из flush.
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(
+            target=self.write_loop, name='ResultsStore', daemon=True)
+        self.writer.start()
+
+    def add(self, record):
+        """
+        Ставит результат игры (api.GameRecord) в
+        очередь на запись.
+        """
+        self.queue.put(record)
+
+    def write_loop(self):
+        connection = sqlite3.connect(self.path)
+        # В режиме WAL этого достаточно, чтобы база
+        # не повредилась при сбое; потерять можно
+        # лишь последние транзакции.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    self.queue.task_done()
+                    return
+                batch = [record]
+                stop = False
+                while len(batch) < self.batch_size:
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        stop = True
+                        break
+                    batch.append(record)
+                try:
+                    if self.error is None:
+                        with connection:
+                            connection.executemany(INSERT, batch)
+                except sqlite3.Error as error:
+                    self.error = error
+                finally:
+                    for _ in range(len(batch) + stop):
+                        self.queue.task_done()
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Ждёт, пока все поставленные в очередь
+        результаты будут записаны.
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Записывает оставшиеся результаты и
+        закрывает базу.
+        """
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.connection.close()
+        if self.error is not None:
+            raise self.error
+
+    def get_leaderboard(self, level, field_params, geometry='rectangle',
+                        player='human', limit=10):
+        """
+        Возвращает limit лучших по времени
+        выигранных игр на поле с параметрами
+        field_params в виде списка api.GameRecord.
+        Результаты, которые ещё в очереди, не
+        учитываются (см. flush).
+        """
+        rows = self.connection.execute(
+            LEADERBOARD,
+            (player, level, geometry) + tuple(field_params) + (limit,))
+        return [GameRecord._make(row) for row in rows]
+
+    def get_statistics(self, player='human'):
+        """
+        Возвращает статистику игр player по всем
+        полям в виде списка FieldStatistics.
+        """
+        rows = self.connection.execute(STATISTICS, (player,))
+        return [FieldStatistics._make(row) for row in rows]
@@ -0,0 +1,476 @@
+"""
+Сохранение, загрузка и повтор игр.
+
+Снимок (snapshot) -- двоичный файл с
+заголовком SNAPSHOT_HEADER, за которым идут
+состояния ячеек:
+ * для обычных полей -- карта мин, по биту на
+   ячейку, и статусы, по 4 бита на ячейку;
+ * для chunked-полей -- безопасная зона первого
+   клика и статусы тронутых чанков. Мины чанков
+   не сохраняются: они однозначно получаются из
+   зерна поля и безопасной зоны.
+Количество мин вокруг ячеек пересчитывается при
+загрузке. Секции упаковываются и распаковываются
+целиком через bytes.translate и длинные целые,
+без цикла по ячейкам на Python, а сам файл
+читается через mmap, поэтому снимок поля в 1M
+ячеек загружается за десятки миллисекунд.
+
+Журнал ходов (move log) -- файл, в который
+дописываются ходы, сделанные после снимка.
+Ходы детерминированы: их повтор на восстановленном
+снимке даёт то же состояние, поэтому автосохранение
+(Autosave) после каждого хода дописывает только
+одну запись, а снимок переписывает лишь изредка.
+"""
+import mmap
+import os
+import struct
+
+from api import FieldParams
+from cells import CellStatus
+from fields import ChunkedField
+
+
+SNAPSHOT_MAGIC = b'MSAV'
+SNAPSHOT_VERSION = 2
+
+# Сигнатура, версия, уровень, флаги (см.
+# SNAPSHOT_FLAGS), геометрия, ширина, высота,
+# количество мин, зерно, количество попыток
+# режима без угадывания, время игры и время на
+# игру в режиме обратного отсчёта в секундах,
+# количество пометок, ходов и открытых
+# безопасных ячеек.
+SNAPSHOT_HEADER = struct.Struct('<4sHBB16sqqqqIddqqq')
+
+# Биты поля флагов в заголовке снимка.
+SNAPSHOT_FLAGS = ('generated', 'started', 'game_active', 'user_won',
+                  'no_guess', 'detonated')
+
+# Безопасная зона chunked-поля: количество
+# ячеек, затем их индексы. Потом количество
+# сохранённых чанков и для каждого -- его
+# координаты и статусы.
+COUNT = struct.Struct('<Q')
+INDEX = struct.Struct('<q')
+CHUNK_COORDS = struct.Struct('<qq')
+
+LOG_MAGIC = b'MLOG'
+LOG_VERSION = 1
+
+# Сигнатура, версия, количество ходов и зерно
+# поля в снимке, к которому относится журнал.
+LOG_HEADER = struct.Struct('<4sHqq')
+
+# Ход: номер действия в MOVE_ACTIONS, индекс
+# ячейки и время игры перед ходом.
+MOVE_RECORD = struct.Struct('<Bqd')
+MOVE_ACTIONS = ('reveal', 'chord', 'flag')
+MOVE_ACTION_CODES = {action: code for code, action in enumerate(MOVE_ACTIONS)}
+
+# Таблицы для bytes.translate: упаковка значения
+# 0 или 1 в k-й бит байта (старший бит -- первая
+# ячейка) и обратно, и сдвиг полубайта.
+BIT_PACK_TABLES = tuple(
+    bytes((value & 1) << (7 - k) for value in range(256)) for k in range(8))
+BIT_UNPACK_TABLES = tuple(
+    bytes((value >> (7 - k)) & 1 for value in range(256)) for k in range(8))
+HIGH_NIBBLE_PACK_TABLE = bytes((value << 4) & 0xFF for value in range(256))
+HIGH_NIBBLE_TABLE = bytes(value >> 4 for value in range(256))
+LOW_NIBBLE_TABLE = bytes(value & 0x0F for value in range(256))
+
+
+def pack_bits(values):
+    """
+    Упаковывает массив нулей и единиц по 8
+    значений в байт.
+    """
+    values = bytes(values) + bytes(-len(values) % 8)
+    packed_size = len(values) // 8
+    packed = 0
+    for k in range(8):
+        # Биты разных k не пересекаются.
+        packed |= int.from_bytes(
+            values[k::8].translate(BIT_PACK_TABLES[k]), 'big')
+    return packed.to_bytes(packed_size, 'big')
+
+
+def unpack_bits(packed, count):
+    values = bytearray(8 * len(packed))
+    for k in range(8):
+        values[k::8] = packed.translate(BIT_UNPACK_TABLES[k])
+    del values[count:]
+    return values
+
+
+def pack_nibbles(values):
+    """
+    Упаковывает массив значений меньше 16 по
+    два значения в байт.
+    """
+    values = bytes(values) + bytes(len(values) % 2)
+    high = values[0::2].translate(HIGH_NIBBLE_PACK_TABLE)
+    packed = int.from_bytes(high, 'big') | int.from_bytes(values[1::2], 'big')
+    return packed.to_bytes(len(high), 'big')
+
+
+def unpack_nibbles(packed, count):
+    values = bytearray(2 * len(packed))
+    values[0::2] = packed.translate(HIGH_NIBBLE_TABLE)
+    values[1::2] = packed.translate(LOW_NIBBLE_TABLE)
+    del values[count:]
+    return values
+
+
+def write_atomic(path, chunks):
+    """
+    Записывает файл через временный, чтобы при
+    сбое на диске остался старый файл целиком.
+    """
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as output:
+        for chunk in chunks:
+            output.write(chunk)
+    os.replace(temp_path, path)
+
+
+def write_snapshot(game_manager, path):
+    """
+    Сохраняет текущую игру в файл path.
+    """
+    field = game_manager.field
+    flags = {
+        'generated': field.state.generated,
+        'started': game_manager.timer.started,
+        'game_active': game_manager.game_active,
+        'user_won': game_manager.user_won,
+        'no_guess': field.no_guess,
+        'detonated': game_manager.detonated,
+    }
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+        game_manager.level,
+        sum(1 << bit for bit, name in enumerate(SNAPSHOT_FLAGS)
+            if flags[name]),
+        game_manager.get_geometry().encode('ascii'),
+        field.width, field.height, field.mines_count, field.seed,
+        field.no_guess_attempts,
+        game_manager.get_elapsed_time(),
+        game_manager.timer.limit,
+        game_manager.mark_count,
+        game_manager.moves_count,
+        game_manager.safe_opened_count,
+    )
+    if isinstance(field, ChunkedField):
+        body = get_chunked_body(field)
+    else:
+        body = (pack_bits(field.state.mines),
+                pack_nibbles(field.state.statuses))
+    write_atomic(path, (header,) + tuple(body))
+
+
+def get_chunked_body(field):
+    yield COUNT.pack(len(field.safe_zone))
+    for idx in sorted(field.safe_zone):
+        yield INDEX.pack(idx)
+
+    # Нетронутые чанки совпадают с только что
+    # сгенерированными, их сохранять не нужно.
+    touched = [
+        (chunk_coords, chunk)
+        for chunk_coords, chunk in field.chunks.items()
+        if chunk.touched_count
+    ]
+    yield COUNT.pack(len(touched))
+    for chunk_coords, chunk in touched:
+        yield CHUNK_COORDS.pack(*chunk_coords)
+        yield pack_nibbles(chunk.statuses)
+
+
+def read_snapshot(path):
+    """
+    Читает снимок. Возвращает словарь полей
+    заголовка и тело снимка.
+    """
+    with open(path, 'rb') as snapshot_file, mmap.mmap(
+            snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            values = SNAPSHOT_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError(
+                'Файл {} не является сохранённой игрой!'.format(path))
+        (magic, version, level, flags, geometry, width, height, mines_count,
+         seed, no_guess_attempts, elapsed, countdown, mark_count,
+         moves_count, safe_opened_count) = values
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(
+                'Файл {} не является сохранённой игрой!'.format(path))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(
+                'Неподдерживаемая версия сохранения: {}!'.format(version))
+        header = dict(
+            level=level,
+            geometry=geometry.rstrip(b'\0').decode('ascii'),
+            field_params=FieldParams(width, height, mines_count),
+            seed=seed,
+            no_guess_attempts=no_guess_attempts,
+            elapsed=elapsed,
+            countdown=countdown,
+            mark_count=mark_count,
+            moves_count=moves_count,
+            safe_opened_count=safe_opened_count,
+        )
+        for bit, name in enumerate(SNAPSHOT_FLAGS):
+            header[name] = bool(flags & (1 << bit))
+        # Срез mmap копирует только тело, без
+        # промежуточного чтения всего файла.
+        body = data[SNAPSHOT_HEADER.size:]
+    return header, body
+
+
+def restore_dense_body(field, body):
+    cell_count = field.cell_count
+    mines_size = (cell_count + 7) // 8
+    statuses_size = (cell_count + 1) // 2
+    if len(body) != mines_size + statuses_size:
+        raise ValueError('Сохранение повреждено: неверный размер поля!')
+
+    state = field.state
+    state.mines[:] = unpack_bits(body[:mines_size], cell_count)
+    state.statuses[:] = unpack_nibbles(body[mines_size:], cell_count)
+    field.count_flagged_around()
+    if state.generated:
+        field.count_mined_around()
+        # Области нулевых ячеек не размечаются:
+        # для 1M ячеек это заметно дольше самой
+        # загрузки, а reveal без них открывает
+        # нулевые ячейки обходом в ширину.
+        field.openings = []
+
+
+def restore_chunked_body(field, body):
+    offset = 0
+
+    def read(record):
+        nonlocal offset
+        values = record.unpack_from(body, offset)
+        offset += record.size
+        return values
+
+    try:
+        safe_zone_size, = read(COUNT)
+        field.safe_zone = frozenset(
+            read(INDEX)[0] for _ in range(safe_zone_size))
+        chunks_count, = read(COUNT)
+        statuses_size = (field.chunk_cell_count + 1) // 2
+        for _ in range(chunks_count):
+            chunk = field.get_chunk(read(CHUNK_COORDS))
+            statuses = body[offset:offset + statuses_size]
+            if len(statuses) != statuses_size:
+                raise struct.error
+            offset += statuses_size
+            chunk.statuses[:] = unpack_nibbles(
+                statuses, field.chunk_cell_count)
+            chunk.touched_count = (
+                field.chunk_cell_count - chunk.statuses.count(
+                    CellStatus.CLOSED))
+    except struct.error:
+        raise ValueError('Сохранение повреждено: неверный размер поля!')
+
+
+class ReplayClock:
+    """
+    Часы, которые при повторе ходов показывают
+    записанное время игры, а не настоящее.
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def replay_moves(game_manager, moves):
+    """
+    Повторяет ходы без отрисовки.
+
+    :param moves: последовательность троек
+        (действие, индекс ячейки, время игры
+        перед ходом), см. read_moves
+    """
+    timer = game_manager.timer
+    clock = timer.clock
+    # Время в replay_clock отсчитывается от начала
+    # игры, а не от эпохи.
+    replay_clock = timer.clock = ReplayClock(timer.get_elapsed())
+    timer.set_elapsed(replay_clock.now, timer.started, timer.running)
+    try:
+        field = game_manager.field
+        for action, idx, elapsed in moves:
+            replay_clock.now = elapsed
+            game_manager._apply_action(
+                action, field.get_position_by_idx(idx))
+        elapsed = timer.get_elapsed()
+    finally:
+        timer.clock = clock
+    timer.set_elapsed(elapsed, timer.started, timer.running)
+
+
+def load_game(game_manager, path):
+    """
+    Загружает игру из снимка path и повторяет
+    ходы из его журнала (см. Autosave).
+    """
+    header, body = read_snapshot(path)
+    moves = read_moves(path + Autosave.log_suffix, header)
+
+    # На время повтора ходов автосохранение
+    # отключается, иначе ходы записались бы в
+    # журнал повторно, а результаты -- в
+    # хранилище результатов.
+    move_log, game_manager.move_log = game_manager.move_log, None
+    results, game_manager.results = game_manager.results, None
+    try:
+        # Поле и таймер запоминают настройки, с
+        # которыми созданы, поэтому настройки
+        # сохранённой игры нужны только на время
+        # _create_game. Следующие новые игры
+        # создаются с настройками игрока.
+        settings = {
+            name: getattr(game_manager, name)
+            for name in ('no_guess', 'no_guess_attempts', 'geometry',
+                         'countdown')
+        }
+        try:
+            for name in settings:
+                setattr(game_manager, name, header[name])
+            game_manager._create_game(
+                header['level'], header['field_params'], header['seed'])
+        finally:
+            for name, value in settings.items():
+                setattr(game_manager, name, value)
+
+        field = game_manager.field
+        field.state.generated = header['generated']
+        if isinstance(field, ChunkedField):
+            restore_chunked_body(field, body)
+        else:
+            restore_dense_body(field, body)
+
+        game_manager.mark_count = header['mark_count']
+        game_manager.moves_count = header['moves_count']
+        game_manager.safe_opened_count = header['safe_opened_count']
+        game_manager.game_active = header['game_active']
+        game_manager.user_won = header['user_won']
+        game_manager.detonated = header['detonated']
+        game_manager.timer.set_elapsed(
+            header['elapsed'], header['started'], header['game_active'])
+
+        replay_moves(game_manager, moves)
+    finally:
+        game_manager.move_log = move_log
+        game_manager.results = results
+
+    field.invalidate()
+    field.render()
+    if move_log is not None:
+        move_log.reset()
+
+
+def read_moves(log_path, snapshot_header):
+    """
+    Читает ходы из журнала. Журнал, который
+    относится не к этому снимку, пропускается, как
+    и недописанная при сбое последняя запись.
+    """
+    try:
+        with open(log_path, 'rb') as log_file:
+            data = log_file.read()
+        magic, version, moves_count, seed = LOG_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return []
+    if (magic != LOG_MAGIC or version != LOG_VERSION
+            or moves_count != snapshot_header['moves_count']
+            or seed != snapshot_header['seed']):
+        return []
+
+    records_size = (
+        (len(data) - LOG_HEADER.size)
+        // MOVE_RECORD.size * MOVE_RECORD.size)
+    return [
+        (MOVE_ACTIONS[code], idx, elapsed)
+        for code, idx, elapsed in MOVE_RECORD.iter_unpack(
+            data[LOG_HEADER.size:LOG_HEADER.size + records_size])
+    ]
+
+
+class Autosave:
+    """
+    Автосохранение игры в файл path. Каждый ход
+    дописывается в журнал path + log_suffix, а
+    снимок переписывается только при новой игре и
+    каждые snapshot_interval ходов, после чего
+    журнал начинается заново.
+
+    Подключается к менеджеру игры через
+    GameManager.move_log.
+    """
+    log_suffix = '.log'
+
+    def __init__(self, game_manager, path, snapshot_interval=4096):
+        self.game_manager = game_manager
+        self.path = path
+        self.log_path = path + self.log_suffix
+        self.snapshot_interval = snapshot_interval
+        self.log_file = None
+        self.logged_count = 0
+
+    def reset(self):
+        """
+        Сохраняет снимок текущей игры и начинает
+        журнал ходов заново.
+        """
+        self.close()
+        write_snapshot(self.game_manager, self.path)
+        self.log_file = open(self.log_path, 'wb')
+        self.log_file.write(LOG_HEADER.pack(
+            LOG_MAGIC, LOG_VERSION,
+            self.game_manager.moves_count, self.game_manager.field.seed))
+        self.log_file.flush()
+        self.logged_count = 0
+
+    def record(self, action, idx, elapsed):
+        """
+        Вызывается менеджером игры перед каждым
+        ходом.
+        """
+        if (self.log_file is None
+                or self.logged_count >= self.snapshot_interval):
+            # Ход ещё не выполнен, поэтому снимок не
+            # содержит его, и ход попадает в новый
+            # журнал.
+            self.reset()
+        self.log_file.write(MOVE_RECORD.pack(
+            MOVE_ACTION_CODES[action], idx, elapsed))
+        self.log_file.flush()
+        self.logged_count += 1
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+def start_autosave(game_manager, path, **kwargs):
+    """
+    Продолжает игру, сохранённую в path, если она
+    есть, и включает автосохранение в path.
+    """
+    autosave = Autosave(game_manager, path, **kwargs)
+    if os.path.exists(path):
+        load_game(game_manager, path)
+    game_manager.move_log = autosave
+    autosave.reset()
+    return autosave
@@ -0,0 +1,699 @@
+"""
+Игровой сервер: один процесс asyncio держит
+много игр (GameManager без контекста рисования)
+и принимает действия от тонких клиентов и
+ботов по TCP или unix-сокету.
+
+Протокол двоичный. Каждое сообщение -- кадр:
+длина (FRAME) и тело. Тело запроса начинается
+с REQUEST (код запроса и номер игры):
+
+    NEW    NEW_GAME -- параметры новой игры
+           (номер игры в запросе не важен);
+    ACT    пачка ACTION -- действия над ячейками;
+    CLOSE  пусто -- игра удаляется.
+
+Тело ответа начинается с RESPONSE (код ответа и
+номер игры). При ошибке за ним следует текст
+ошибки в UTF-8. На NEW отвечают FIELD_INFO и
+GAME_STATE, на ACT -- GAME_STATE и по CHANGE на
+каждую изменившуюся ячейку (см.
+GameManager.apply_actions): клиент получает
+только разницу, а не всё поле.
+
+Игры, к которым долго не обращались, выгружаются
+на диск снимком (см. saves.write_snapshot) и
+загружаются обратно при следующем запросе, а
+совсем заброшенные удаляются. Выгруженные игры
+и номера игр переживают перезапуск сервера.
+
+Пример запуска сервера и нагрузочного клиента:
+
+    python server.py serve --port 8765 --directory games
+    python server.py load --port 8765 --connections 20 --games 2000
+"""
+import argparse
+import asyncio
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from random import Random
+
+from api import CellChange, FieldParams
+from cells import CellStatus
+from game_managers import GameManager, LevelEnum
+from saves import (
+    MOVE_ACTION_CODES, MOVE_ACTIONS, load_game, write_atomic, write_snapshot)
+
+
+# Длина тела кадра.
+FRAME = struct.Struct('<I')
+
+# Код запроса, номер игры.
+REQUEST = struct.Struct('<BI')
+REQUEST_NEW, REQUEST_ACT, REQUEST_CLOSE = range(3)
+
+# Уровень, номер геометрии в GEOMETRIES,
+# ширина, высота и количество мин (для уровня
+# CUSTOM), зерно (отрицательное -- случайное),
+# режим без угадывания.
+NEW_GAME = struct.Struct('<BBqqqqB')
+GEOMETRIES = ('rectangle', 'hexagonal', 'voronoi')
+
+# Номер действия в saves.MOVE_ACTIONS, позиция
+# ячейки. Координаты позиций не больше
+# POSITION_MAX: этого хватает и "бесконечному"
+# полю (game_managers.ENDLESS_SIZE), а поля, в
+# которые позиции не помещаются, сервер не
+# создаёт.
+ACTION = struct.Struct('<Bii')
+POSITION_MAX = (1 << 31) - 1
+
+# Код ответа, номер игры.
+RESPONSE = struct.Struct('<BI')
+RESPONSE_OK, RESPONSE_ERROR = range(2)
+
+# Ширина, высота и количество мин поля.
+FIELD_INFO = struct.Struct('<qqq')
+
+# Идёт ли игра, выиграна ли, время игры в
+# секундах, количество изменений.
+GAME_STATE = struct.Struct('<BBdI')
+
+# Позиция ячейки, статус, количество мин вокруг
+# (NO_NUMBER, если ячейка не открыта).
+CHANGE = struct.Struct('<iiBB')
+NO_NUMBER = 0xff
+
+
+def pack_frame(*chunks):
+    body = b''.join(chunks)
+    return FRAME.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Читает тело кадра. Возвращает None, если
+    соединение закрыто.
+    """
+    try:
+        header = await reader.readexactly(FRAME.size)
+        return await reader.readexactly(FRAME.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class GameServer:
+    # Наибольшее количество ячеек поля уровня
+    # CUSTOM для каждой геометрии: разбиение
+    # Вороного строится намного дольше остальных.
+    max_cells = {
+        'rectangle': 1 << 20,
+        'hexagonal': 1 << 20,
+        'voronoi': 1 << 14,
+    }
+
+    # Попыток найти поле без угадывания (см.
+    # GameManager.no_guess_attempts).
+    no_guess_attempts = 100
+
+    # Игры с полями больше этого, а также новые
+    # игры на разбиении Вороного или без угадывания
+    # и первые клики в играх без угадывания
+    # (генерация поля решателем) выполняются в пуле
+    # потоков, чтобы не задерживать остальные игры.
+    # Маленькие поля генерируются быстрее, чем
+    # передаются в пул.
+    inline_max_cells = 1 << 12
+
+    # Номера игр резервируются пачками: верхняя
+    # граница пачки сохраняется в файл, поэтому
+    # после перезапуска номера не повторяются.
+    game_ids_file = 'next_game_id'
+    game_ids_reserve = 4096
+
+    # Сколько игр выгружается (и сколько
+    # выгруженных удаляется) за один проход
+    # evict_loop; если этого не хватило, следующий
+    # проход -- через evict_retry_delay секунд.
+    evict_batch = 256
+    evict_retry_delay = 1.0
+
+    def __init__(self, directory, idle_timeout=60.0, evicted_ttl=86400.0,
+                 clock=time.monotonic):
+        """
+        :param directory: каталог для выгруженных игр
+        :param idle_timeout: через сколько секунд
+            без запросов игра выгружается на диск
+        :param evicted_ttl: через сколько секунд
+            выгруженная игра удаляется совсем
+            (например, если клиент отключился, не
+            закрыв её)
+        """
+        self.directory = directory
+        self.idle_timeout = idle_timeout
+        self.evicted_ttl = evicted_ttl
+        self.clock = clock
+
+        # Игры в памяти: {номер: [менеджер игры,
+        # время последнего запроса]}, от давно не
+        # использованных к недавним.
+        self.games = OrderedDict()
+        # Игры, выгруженные на диск: {номер: время
+        # выгрузки по time.time()}, от старых к новым.
+        self.evicted = OrderedDict()
+        # Блокировки всех игр, в памяти и на диске:
+        # запросы к одной игре выполняются по одному.
+        self.locks = {}
+
+        self.next_game_id = 1
+        self.reserved_game_id = 1
+
+        self.handlers = {
+            REQUEST_NEW: self.new_game,
+            REQUEST_ACT: self.act,
+            REQUEST_CLOSE: self.close_game,
+        }
+
+    def get_path(self, game_id):
+        return os.path.join(self.directory, '{}.sav'.format(game_id))
+
+    def open(self):
+        """
+        Подхватывает игры, выгруженные до
+        перезапуска сервера, и номер следующей игры.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        saved = []
+        for name in os.listdir(self.directory):
+            game_id, extension = os.path.splitext(name)
+            if extension == '.sav' and game_id.isdigit():
+                path = os.path.join(self.directory, name)
+                saved.append((os.path.getmtime(path), int(game_id)))
+        for evicted_time, game_id in sorted(saved):
+            self.evicted[game_id] = evicted_time
+            self.locks[game_id] = asyncio.Lock()
+
+        try:
+            with open(os.path.join(
+                    self.directory, self.game_ids_file)) as ids_file:
+                reserved_game_id = int(ids_file.read())
+        except (OSError, ValueError):
+            reserved_game_id = 1
+        self.next_game_id = self.reserved_game_id = max(
+            [reserved_game_id] + [game_id + 1 for _, game_id in saved])
+
+    def allocate_game_id(self):
+        game_id = self.next_game_id
+        if game_id >= self.reserved_game_id:
+            self.reserved_game_id = game_id + self.game_ids_reserve
+            write_atomic(
+                os.path.join(self.directory, self.game_ids_file),
+                (str(self.reserved_game_id).encode('ascii'),))
+        self.next_game_id += 1
+        return game_id
+
+    def get_lock(self, game_id):
+        lock = self.locks.get(game_id)
+        if lock is None:
+            raise ValueError('Нет игры с номером {}'.format(game_id))
+        return lock
+
+    async def get_game(self, game_id):
+        """
+        Возвращает менеджер игры, при необходимости
+        загрузив её с диска. Вызывается под
+        блокировкой игры.
+        """
+        entry = self.games.get(game_id)
+        if entry is not None:
+            self.games.move_to_end(game_id)
+            entry[1] = self.clock()
+            return entry[0]
+        if game_id not in self.evicted:
+            # Игру закрыли, пока запрос ждал
+            # блокировки.
+            raise ValueError('Нет игры с номером {}'.format(game_id))
+
+        game_manager = GameManager()
+        path = self.get_path(game_id)
+        await asyncio.get_event_loop().run_in_executor(
+            None, load_game, game_manager, path)
+        os.remove(path)
+        del self.evicted[game_id]
+        self.games[game_id] = [game_manager, self.clock()]
+        return game_manager
+
+    async def evict_idle(self):
+        """
+        Выгружает на диск игры, к которым не было
+        запросов дольше idle_timeout, но не больше
+        evict_batch за раз. Снимки пишутся в пуле
+        потоков под блокировкой игры, так что
+        остальные игры не ждут диска, а запрос к
+        выгружаемой игре дождётся конца записи и
+        загрузит её обратно.
+
+        :return: количество выгруженных игр
+        """
+        deadline = self.clock() - self.idle_timeout
+        candidates = []
+        for game_id, (_, last_used) in self.games.items():
+            if last_used > deadline or len(candidates) >= self.evict_batch:
+                break
+            if not self.locks[game_id].locked():
+                candidates.append(game_id)
+
+        loop = asyncio.get_event_loop()
+        evicted_count = 0
+        for game_id in candidates:
+            lock = self.locks.get(game_id)
+            if lock is None or lock.locked():
+                continue
+            async with lock:
+                entry = self.games.get(game_id)
+                # Пока писались предыдущие снимки, к игре
+                # могли обратиться или закрыть её.
+                if entry is None or entry[1] > deadline:
+                    continue
+                await loop.run_in_executor(
+                    None, write_snapshot, entry[0], self.get_path(game_id))
+                del self.games[game_id]
+                self.evicted[game_id] = time.time()
+                evicted_count += 1
+        return evicted_count
+
+    def expire_evicted(self):
+        """
+        Удаляет выгруженные игры, к которым не было
+        запросов дольше evicted_ttl, но не больше
+        evict_batch за раз.
+
+        :return: количество удалённых игр
+        """
+        deadline = time.time() - self.evicted_ttl
+        expired_count = 0
+        while self.evicted and expired_count < self.evict_batch:
+            game_id, evicted_time = next(iter(self.evicted.items()))
+            if evicted_time > deadline or self.locks[game_id].locked():
+                break
+            self.remove_evicted(game_id)
+            expired_count += 1
+        return expired_count
+
+    def remove_evicted(self, game_id):
+        del self.evicted[game_id]
+        del self.locks[game_id]
+        try:
+            os.remove(self.get_path(game_id))
+        except FileNotFoundError:
+            pass
+
+    async def evict_loop(self):
+        delay = self.idle_timeout / 2
+        while True:
+            await asyncio.sleep(delay)
+            evicted_count = await self.evict_idle()
+            expired_count = self.expire_evicted()
+            # Если выгружено или удалено сколько можно
+            # за раз, остальное доделывается вскоре, а
+            # не через половину idle_timeout.
+            if max(evicted_count, expired_count) >= self.evict_batch:
+                delay = min(self.evict_retry_delay, self.idle_timeout / 2)
+            else:
+                delay = self.idle_timeout / 2
+
+    async def handle(self, body):
+        """
+        Выполняет запрос и возвращает тело ответа.
+        Любая ошибка возвращается клиенту, а не
+        закрывает соединение: в его очереди могут
+        быть запросы к другим играм.
+        """
+        game_id = 0
+        try:
+            code, game_id = REQUEST.unpack_from(body)
+            handler = self.handlers.get(code)
+            if handler is None:
+                raise ValueError('Неизвестный запрос {}'.format(code))
+            return await handler(game_id, body[REQUEST.size:])
+        except Exception as error:
+            return RESPONSE.pack(RESPONSE_ERROR, game_id) + str(
+                error).encode('utf-8')
+
+    async def run(self, heavy, function, *args):
+        """
+        Выполняет function(*args) в пуле потоков,
+        если heavy, иначе -- сразу.
+        """
+        if not heavy:
+            return function(*args)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(function, *args))
+
+    async def new_game(self, game_id, payload):
+        (level, geometry, width, height, mines_count, seed,
+         no_guess) = NEW_GAME.unpack(payload)
+        level = LevelEnum(level)
+        if geometry >= len(GEOMETRIES):
+            raise ValueError('Неизвестная геометрия {}'.format(geometry))
+        geometry = GEOMETRIES[geometry]
+
+        game_manager = GameManager()
+        game_manager.geometry = geometry
+        game_manager.no_guess = bool(no_guess)
+        game_manager.no_guess_attempts = self.no_guess_attempts
+        field_params = game_manager.level_field_map.get(
+            level, FieldParams(width, height, mines_count))
+        if max(field_params.width, field_params.height) - 1 > POSITION_MAX:
+            raise ValueError(
+                'Позиции ячеек поля {}x{} не помещаются в '
+                'протокол!'.format(field_params.width, field_params.height))
+        cell_count = field_params.width * field_params.height
+        if (level == LevelEnum.CUSTOM
+                and cell_count > self.max_cells[geometry]):
+            raise ValueError(
+                'Поле {}x{} слишком большое: допускается не более {} '
+                'ячеек!'.format(width, height, self.max_cells[geometry]))
+
+        await self.run(
+            no_guess or geometry == 'voronoi'
+            or cell_count > self.inline_max_cells,
+            game_manager.new_game, level, field_params,
+            seed if seed >= 0 else None)
+
+        # Игра регистрируется, только когда ответ
+        # готов: номер игры, о которой клиент не
+        # узнал, остался бы занятым навсегда.
+        body = b''.join((
+            FIELD_INFO.pack(*game_manager.field_params),
+            self.pack_game_state(game_manager, ()),
+        ))
+        game_id = self.allocate_game_id()
+        self.games[game_id] = [game_manager, self.clock()]
+        self.locks[game_id] = asyncio.Lock()
+        return RESPONSE.pack(RESPONSE_OK, game_id) + body
+
+    async def act(self, game_id, payload):
+        actions = []
+        for code, row, column in ACTION.iter_unpack(payload):
+            if code >= len(MOVE_ACTIONS):
+                raise ValueError('Неизвестное действие {}'.format(code))
+            actions.append((MOVE_ACTIONS[code], (row, column)))
+
+        async with self.get_lock(game_id):
+            game_manager = await self.get_game(game_id)
+            field = game_manager.field
+            diff = await self.run(
+                field.cell_count > self.inline_max_cells
+                or not field.state.generated and field.no_guess,
+                game_manager.apply_actions, actions)
+            return b''.join((
+                RESPONSE.pack(RESPONSE_OK, game_id),
+                self.pack_game_state(game_manager, diff),
+            ))
+
+    async def close_game(self, game_id, payload):
+        async with self.get_lock(game_id):
+            if game_id in self.games:
+                del self.games[game_id]
+                del self.locks[game_id]
+            elif game_id in self.evicted:
+                self.remove_evicted(game_id)
+            else:
+                raise ValueError('Нет игры с номером {}'.format(game_id))
+        return RESPONSE.pack(RESPONSE_OK, game_id)
+
+    @staticmethod
+    def pack_game_state(game_manager, diff):
+        chunks = [GAME_STATE.pack(
+            game_manager.game_active, game_manager.user_won,
+            game_manager.get_elapsed_time(), len(diff))]
+        for position, status, number in diff:
+            chunks.append(CHANGE.pack(
+                position[0], position[1], status,
+                NO_NUMBER if number is None else number))
+        return b''.join(chunks)
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                body = await read_frame(reader)
+                if body is None:
+                    break
+                writer.write(pack_frame(await self.handle(body)))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        self.open()
+        if unix_path is None:
+            server = await asyncio.start_server(self.serve_client, host, port)
+        else:
+            server = await asyncio.start_unix_server(
+                self.serve_client, unix_path)
+        evict_task = asyncio.ensure_future(self.evict_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evict_task.cancel()
+
+
+class GameClient:
+    """
+    Клиент игрового сервера. Запросы можно
+    отправлять из нескольких задач сразу, не
+    дожидаясь ответов: сервер отвечает на запросы
+    соединения по порядку, поэтому ответы
+    раздаются ожидающим в порядке отправки.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8765, unix_path=None):
+        if unix_path is None:
+            streams = await asyncio.open_connection(host, port)
+        else:
+            streams = await asyncio.open_unix_connection(unix_path)
+        return cls(*streams)
+
+    async def read_loop(self):
+        try:
+            while True:
+                body = await read_frame(self.reader)
+                if body is None:
+                    break
+                self.pending.popleft().set_result(body)
+        finally:
+            while self.pending:
+                self.pending.popleft().set_exception(
+                    ConnectionError('Сервер закрыл соединение'))
+
+    async def request(self, code, game_id, payload=b''):
+        """
+        :return: номер игры и остаток тела ответа
+        """
+        response = asyncio.get_event_loop().create_future()
+        self.pending.append(response)
+        self.writer.write(pack_frame(REQUEST.pack(code, game_id), payload))
+        body = await response
+        status, game_id = RESPONSE.unpack_from(body)
+        if status != RESPONSE_OK:
+            raise ValueError(body[RESPONSE.size:].decode('utf-8'))
+        return game_id, body[RESPONSE.size:]
+
+    async def new_game(self, level, field_params=FieldParams(0, 0, 0),
+                       geometry='rectangle', seed=None, no_guess=False):
+        """
+        :return: номер игры и параметры поля
+        """
+        game_id, body = await self.request(REQUEST_NEW, 0, NEW_GAME.pack(
+            level, GEOMETRIES.index(geometry), *field_params,
+            -1 if seed is None else seed, no_guess))
+        return game_id, FieldParams(*FIELD_INFO.unpack_from(body))
+
+    async def act(self, game_id, actions):
+        """
+        :param actions: последовательность пар
+            (действие, позиция), см. GameManager.act
+        :return: идёт ли игра, выиграна ли и список
+            CellChange
+        """
+        _, body = await self.request(REQUEST_ACT, game_id, b''.join(
+            ACTION.pack(MOVE_ACTION_CODES[action], *position)
+            for action, position in actions))
+        game_active, user_won, _, _ = GAME_STATE.unpack_from(body)
+        diff = [
+            CellChange(
+                (row, column), CellStatus(status),
+                None if number == NO_NUMBER else number)
+            for row, column, status, number in CHANGE.iter_unpack(
+                body[GAME_STATE.size:])
+        ]
+        return bool(game_active), bool(user_won), diff
+
+    async def close_game(self, game_id):
+        await self.request(REQUEST_CLOSE, game_id)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self.read_task
+
+
+async def play_random(client, rng, level, latencies, deadline):
+    """
+    Играет партии случайными открытиями ячеек до
+    deadline, добавляя в latencies задержку
+    каждого действия.
+
+    :return: количество сыгранных партий
+    """
+    games_count = 0
+    while time.monotonic() < deadline:
+        game_id, (width, height, _) = await client.new_game(level)
+        closed = [(row, column)
+                  for row in range(height) for column in range(width)]
+        # Индексы закрытых ячеек в closed: открытая
+        # ячейка заменяется последней, чтобы клиент
+        # не тратил на каждое действие время,
+        # пропорциональное размеру поля, -- он делит
+        # процессор с сервером.
+        closed_idx = {position: idx for idx, position in enumerate(closed)}
+        game_active = True
+        while game_active and time.monotonic() < deadline:
+            position = closed[rng.randrange(len(closed))]
+            start = time.perf_counter()
+            game_active, _, diff = await client.act(
+                game_id, (('reveal', position),))
+            latencies.append(time.perf_counter() - start)
+            for change in diff:
+                idx = closed_idx.pop(change.position, None)
+                if idx is None:
+                    continue
+                last = closed.pop()
+                if idx < len(closed):
+                    closed[idx] = last
+                    closed_idx[last] = idx
+        await client.close_game(game_id)
+        games_count += 1
+    return games_count
+
+
+async def run_load(host='127.0.0.1', port=8765, unix_path=None,
+                   connections=10, games=1000, duration=10.0,
+                   level=LevelEnum.WARRIOR, seed=0):
+    """
+    Нагрузочный клиент: games одновременных
+    партий на connections соединениях в течение
+    duration секунд.
+
+    :return: сводка: количество действий и партий,
+        действий в секунду, p50 и p99 задержки в
+        секундах
+    """
+    clients = [
+        await GameClient.connect(host, port, unix_path)
+        for _ in range(connections)
+    ]
+    latencies = []
+    start = time.monotonic()
+    deadline = start + duration
+    games_counts = await asyncio.gather(*(
+        play_random(
+            clients[game_idx % connections],
+            Random('{}:{}'.format(seed, game_idx)),
+            level, latencies, deadline)
+        for game_idx in range(games)
+    ))
+    elapsed = time.monotonic() - start
+    for client in clients:
+        await client.close()
+
+    latencies.sort()
+    return OrderedDict((
+        ('actions', len(latencies)),
+        ('games', sum(games_counts)),
+        ('actions_per_second', len(latencies) / elapsed),
+        ('p50', get_percentile(latencies, 0.5)),
+        ('p99', get_percentile(latencies, 0.99)),
+    ))
+
+
+def get_percentile(values, fraction):
+    """
+    :param values: отсортированный список
+    """
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Игровой сервер')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='запустить сервер')
+    load_parser = commands.add_parser(
+        'load', help='нагрузочный клиент')
+    for command_parser in (serve_parser, load_parser):
+        command_parser.add_argument('--host', default='127.0.0.1')
+        command_parser.add_argument('--port', type=int, default=8765)
+        command_parser.add_argument(
+            '--unix', metavar='PATH',
+            help='unix-сокет вместо TCP')
+
+    serve_parser.add_argument(
+        '--directory', default='games',
+        help='каталог для выгруженных игр')
+    serve_parser.add_argument(
+        '--idle-timeout', type=float, default=60.0,
+        help='через сколько секунд простоя выгружать игру')
+    serve_parser.add_argument(
+        '--evicted-ttl', type=float, default=86400.0,
+        help='через сколько секунд удалять выгруженную игру')
+
+    load_parser.add_argument('--connections', type=int, default=10)
+    load_parser.add_argument(
+        '--games', type=int, default=1000,
+        help='количество одновременных партий')
+    load_parser.add_argument('--duration', type=float, default=10.0)
+    load_parser.add_argument(
+        '--level', choices=('rookie', 'veteran', 'warrior'),
+        default='warrior')
+    load_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = GameServer(
+            args.directory, args.idle_timeout, args.evicted_ttl)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+        return server
+
+    report = asyncio.run(run_load(
+        args.host, args.port, args.unix, args.connections, args.games,
+        args.duration, LevelEnum[args.level.upper()], args.seed))
+    print('actions: {}, games: {}, actions per second: {:.0f}, '
+          'p50: {:.2f} ms, p99: {:.2f} ms'.format(
+              report['actions'], report['games'],
+              report['actions_per_second'],
+              1000 * (report['p50'] or 0), 1000 * (report['p99'] or 0)))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+Безголовый симулятор: автоигроки играют много
+партий параллельно в нескольких процессах, а
+симулятор печатает сводную статистику по мере
+готовности результатов.
+
+Пример запуска:
+
+    python simulation.py --games 100000 --workers 8 --strategy simple
+"""
+import argparse
+import sys
+import time
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from random import Random
+
+from cells import CellStatus
+from game_managers import GameManager, LevelEnum
+from hints import FieldSnapshot, HintCalculator
+from results import ResultsStore
+
+
+class Strategy(metaclass=ABCMeta):
+    """
+    Автоигрок. Видит поле так же, как игрок:
+    статусы ячеек и числа в открытых ячейках.
+    """
+    def __init__(self, rng):
+        """
+        :param rng: экземпляр random.Random для
+            случайных ходов
+        """
+        self.rng = rng
+
+    @abstractmethod
+    def choose_action(self, manager):
+        """
+        Возвращает следующий ход: пару
+        (действие, позиция), см. GameManager.act.
+        """
+
+    def reveal_center(self, field):
+        return 'reveal', field.get_position_by_idx(
+            field.cell_count // 2 + field.width // 2)
+
+    def reveal_random(self, field):
+        statuses = field.state.statuses
+        closed = [
+            idx for idx in range(field.cell_count)
+            if statuses[idx] == CellStatus.CLOSED
+        ]
+        return 'reveal', field.get_position_by_idx(self.rng.choice(closed))
+
+
+class RandomStrategy(Strategy):
+    """
+    Открывает случайную закрытую ячейку.
+    """
+    def choose_action(self, manager):
+        return self.reveal_random(manager.field)
+
+
+class SimpleStrategy(Strategy):
+    """
+    Применяет простые правила к каждому числу:
+    если вокруг уже стоит столько флагов, сколько
+    мин, -- открывает остальных соседей аккордом;
+    если закрытых соседей ровно столько, сколько
+    мин, -- ставит флаг. Иначе открывает случайную
+    ячейку.
+    """
+    def __init__(self, rng):
+        super().__init__(rng)
+        # Поле текущей партии и отметки чисел, вокруг
+        # которых не осталось закрытых ячеек: их
+        # правила больше ничего не дадут, и
+        # повторно они не проверяются.
+        self.field = None
+        self.done = None
+
+    def choose_action(self, manager):
+        field = manager.field
+        if not field.state.generated:
+            return self.reveal_center(field)
+        if field is not self.field:
+            self.field = field
+            self.done = bytearray(field.cell_count)
+
+        statuses = field.state.statuses
+        mined_around = field.state.mined_around
+        done = self.done
+        number = bytes((CellStatus.NUMBER,))
+        idx = statuses.find(number)
+        while idx != -1:
+            if done[idx]:
+                idx = statuses.find(number, idx + 1)
+                continue
+            closed = []
+            flags_count = 0
+            for neighbor in field.get_neighbors(idx):
+                status = statuses[neighbor]
+                if status == CellStatus.CLOSED:
+                    closed.append(neighbor)
+                elif status == CellStatus.MARKED_BY_FLAG:
+                    flags_count += 1
+            if closed:
+                if mined_around[idx] == flags_count:
+                    return 'chord', field.get_position_by_idx(idx)
+                if mined_around[idx] == flags_count + len(closed):
+                    return 'flag', field.get_position_by_idx(closed[0])
+            else:
+                done[idx] = 1
+            idx = statuses.find(number, idx + 1)
+        return self.reveal_random(field)
+
+
+class ProbabilityStrategy(Strategy):
+    """
+    Открывает ячейку с наименьшей вероятностью
+    мины (см. hints).
+    """
+    def __init__(self, rng):
+        super().__init__(rng)
+        self.calculator = HintCalculator()
+
+    def choose_action(self, manager):
+        field = manager.field
+        if not field.state.generated:
+            return self.reveal_center(field)
+        hint = self.calculator.calculate(FieldSnapshot(field))
+        if hint.safest_idx is None:
+            return self.reveal_random(field)
+        return 'reveal', field.get_position_by_idx(hint.safest_idx)
+
+
+strategies = dict(
+    random=RandomStrategy,
+    simple=SimpleStrategy,
+    probability=ProbabilityStrategy,
+)
+
+
+def play_game(manager, strategy, level, custom_params, seed):
+    manager.new_game(level, custom_params, seed)
+    while manager.game_active:
+        manager.act(*strategy.choose_action(manager))
+    return manager.get_result()
+
+
+def play_games(strategy_name, level, custom_params, worker_seed,
+               games_count, geometry='rectangle'):
+    """
+    Играет games_count партий в текущем процессе.
+    Зёрна партий и случайных ходов выводятся из
+    worker_seed, поэтому результат воспроизводим
+    и не зависит от того, какой процесс его
+    посчитал. Зёрна партий -- целые числа, как и
+    у обычных игр: их можно сохранить (см.
+    saves.write_snapshot) и записать в хранилище
+    результатов.
+    """
+    manager = GameManager(clock=lambda: 0)
+    manager.geometry = geometry
+    manager.player = strategy_name
+    seeds = Random(worker_seed)
+    strategy = strategies[strategy_name](Random(seeds.getrandbits(63)))
+    return [
+        play_game(manager, strategy, level, custom_params,
+                  seeds.getrandbits(63))
+        for _ in range(games_count)
+    ]
+
+
+class Statistics:
+    def __init__(self):
+        self.games_count = 0
+        self.wins_count = 0
+        self.moves_count = 0
+        self.start_clock = time.perf_counter()
+
+    def add(self, results):
+        for result in results:
+            self.games_count += 1
+            self.wins_count += result.won
+            self.moves_count += result.moves
+
+    def get_report(self):
+        elapsed = time.perf_counter() - self.start_clock
+        return (
+            'games: {}, win rate: {:.2%}, moves per game: {:.1f}, '
+            'games per second: {:.1f}'.format(
+                self.games_count,
+                self.wins_count / max(self.games_count, 1),
+                self.moves_count / max(self.games_count, 1),
+                self.games_count / elapsed if elapsed else 0.0,
+            )
+        )
+
+
+def simulate(strategy_name, level, custom_params, games_count,
+             workers=0, seed=0, batch_size=100, report=print,
+             geometry='rectangle', results=None):
+    """
+    Играет games_count партий пачками по
+    batch_size, распределяя пачки по workers
+    процессам (0 -- в текущем процессе). После
+    каждой пачки передаёт в report сводку.
+
+    :param results: хранилище результатов (см.
+        results.ResultsStore), куда записываются
+        все партии, или None
+    """
+    statistics = Statistics()
+
+    def add(batch_results):
+        statistics.add(batch_results)
+        if results is not None:
+            for record in batch_results:
+                results.add(record)
+        report(statistics.get_report())
+    seeds = Random(seed)
+    batches = [
+        (seeds.getrandbits(63), min(batch_size, games_count - start))
+        for start in range(0, games_count, batch_size)
+    ]
+
+    if not workers:
+        for worker_seed, count in batches:
+            add(play_games(
+                strategy_name, level, custom_params, worker_seed, count,
+                geometry))
+        return statistics
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(
+                play_games, strategy_name, level, custom_params,
+                worker_seed, count, geometry)
+            for worker_seed, count in batches
+        ]
+        for future in as_completed(futures):
+            add(future.result())
+    return statistics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Симуляция партий')
+    parser.add_argument(
+        '--strategy', choices=tuple(strategies), default='simple')
+    parser.add_argument(
+        '--level', choices=('rookie', 'veteran', 'warrior'),
+        default='warrior')
+    parser.add_argument(
+        '--geometry', choices=('rectangle', 'hexagonal', 'voronoi'),
+        default='rectangle')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='количество процессов; 0 -- играть в текущем')
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--results', metavar='PATH',
+        help='записать результаты партий в базу SQLite (см. results.py)')
+    args = parser.parse_args(argv)
+
+    results = None
+    if args.results:
+        results = ResultsStore(args.results)
+    try:
+        statistics = simulate(
+            args.strategy, LevelEnum[args.level.upper()], None, args.games,
+            args.workers, args.seed, args.batch, geometry=args.geometry,
+            results=results)
+    finally:
+        if results is not None:
+            results.close()
+    return statistics
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
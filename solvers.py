@@ -0,0 +1,337 @@
+"""
+Детерминированный решатель минного поля и
+генерация полей, которые можно пройти без
+угадывания.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from random import Random
+
+from fields import get_adjacency, sample_mines
+
+
+# Сколько попыток отдаётся одному процессу за раз
+# при параллельном переборе.
+ATTEMPTS_PER_TASK = 32
+
+
+class Solver:
+    """
+    Проходит поле от стартовой ячейки, не
+    угадывая. Знания о поле -- это открытые
+    ячейки и найденные мины. Каждая открытая
+    ячейка с числом даёт ограничение: среди
+    её неизвестных соседей (битовая маска по
+    индексам ячеек) ровно столько-то мин.
+
+    Применяемые правила:
+     * одиночные: в ограничении не осталось
+       мин -- все его ячейки безопасны; мин
+       столько же, сколько ячеек -- все ячейки
+       заминированы;
+     * парные (подмножества и линейная разность
+       двух пересекающихся ограничений);
+     * общее количество мин на поле.
+
+    Ограничения пересчитываются инкрементально:
+    только те, что задеты последними открытыми
+    ячейками или найденными минами, и парные
+    правила проверяются только для пар, в
+    которых хотя бы одно ограничение изменилось.
+    """
+    UNKNOWN = 0
+    OPENED = 1
+    MINE = 2
+
+    def __init__(self, neighbors, mines, mined_around, mines_count):
+        """
+        :param neighbors: кортежи индексов соседей
+            для каждой ячейки
+        :param mines: карта мин
+        :param mined_around: количество мин вокруг
+            каждой ячейки
+        :param mines_count: общее количество мин
+        """
+        self.neighbors = neighbors
+        self.mines = mines
+        self.mined_around = mined_around
+        self.mines_count = mines_count
+        self.cell_count = len(mines)
+
+        self.known = None
+        self.safe_left = None
+        self.flagged_count = None
+
+        # Ограничения: ячейка -> (маска, мин осталось)
+        self.constraints = None
+        # Ячейки, ограничения которых нужно пересчитать
+        self.dirty = None
+        # Ограничения, изменившиеся с последней
+        # проверки парных правил
+        self.changed = None
+
+    def solve(self, start_idx):
+        """
+        Возвращает True, если всё поле можно
+        открыть от start_idx без угадывания.
+        """
+        if self.has_enclosed_safe_cell():
+            return False
+
+        self.known = bytearray(self.cell_count)
+        self.safe_left = self.cell_count - self.mines_count
+        self.flagged_count = 0
+        self.constraints = {}
+        self.dirty = set()
+        self.changed = set()
+
+        self.open(start_idx)
+        while self.safe_left:
+            if self.apply_single_rules():
+                continue
+            if self.apply_pair_rules():
+                continue
+            if self.apply_global_rule():
+                continue
+            return False
+        return True
+
+    def has_enclosed_safe_cell(self):
+        """
+        Ранний отказ: безопасная ячейка, все соседи
+        которой заминированы, почти всегда требует
+        угадывания.
+        """
+        neighbors = self.neighbors
+        mined_around = self.mined_around
+        for idx, mine in enumerate(self.mines):
+            if not mine and mined_around[idx] == len(neighbors[idx]):
+                return True
+        return False
+
+    def open(self, idx):
+        """
+        Открывает ячейку так же, как это сделал бы
+        игрок: нулевые ячейки раскрывают соседей.
+        """
+        known = self.known
+        stack = [idx]
+        while stack:
+            idx = stack.pop()
+            if known[idx] != self.UNKNOWN:
+                continue
+            assert not self.mines[idx], 'Решатель открыл мину!'
+            known[idx] = self.OPENED
+            self.safe_left -= 1
+            self.dirty.add(idx)
+            for neighbor in self.neighbors[idx]:
+                if known[neighbor] == self.OPENED:
+                    self.dirty.add(neighbor)
+                elif self.mined_around[idx] == 0:
+                    stack.append(neighbor)
+
+    def flag(self, idx):
+        if self.known[idx] != self.UNKNOWN:
+            return
+        self.known[idx] = self.MINE
+        self.flagged_count += 1
+        for neighbor in self.neighbors[idx]:
+            if self.known[neighbor] == self.OPENED:
+                self.dirty.add(neighbor)
+
+    def get_constraint(self, idx):
+        mask = 0
+        left = self.mined_around[idx]
+        known = self.known
+        for neighbor in self.neighbors[idx]:
+            status = known[neighbor]
+            if status == self.UNKNOWN:
+                mask |= 1 << neighbor
+            elif status == self.MINE:
+                left -= 1
+        return mask, left
+
+    def apply(self, safe_mask, mine_mask):
+        for idx in iter_bits(safe_mask):
+            self.open(idx)
+        for idx in iter_bits(mine_mask):
+            self.flag(idx)
+
+    def apply_single_rules(self):
+        progress = False
+        while self.dirty:
+            idx = self.dirty.pop()
+            mask, left = self.get_constraint(idx)
+            if not mask:
+                self.constraints.pop(idx, None)
+                continue
+            self.constraints[idx] = (mask, left)
+            self.changed.add(idx)
+            if left == 0:
+                self.apply(mask, 0)
+                progress = True
+            elif left == mask.bit_count():
+                self.apply(0, mask)
+                progress = True
+        return progress
+
+    def apply_pair_rules(self):
+        constraints = self.constraints
+        safe_mask = 0
+        mine_mask = 0
+        for first in self.changed:
+            if first not in constraints:
+                continue
+            first_mask, first_left = constraints[first]
+
+            # Пересекающиеся ограничения дают открытые
+            # ячейки рядом с неизвестными ячейками first.
+            partners = set()
+            for idx in iter_bits(first_mask):
+                partners.update(self.neighbors[idx])
+            partners.discard(first)
+
+            for second in partners:
+                if second not in constraints:
+                    continue
+                second_mask, second_left = constraints[second]
+                if not first_mask & second_mask:
+                    continue
+                only_first = first_mask & ~second_mask
+                only_second = second_mask & ~first_mask
+                difference = first_left - second_left
+                if difference == only_first.bit_count():
+                    mine_mask |= only_first
+                    safe_mask |= only_second
+                elif -difference == only_second.bit_count():
+                    mine_mask |= only_second
+                    safe_mask |= only_first
+        self.changed.clear()
+
+        if not safe_mask and not mine_mask:
+            return False
+        self.apply(safe_mask, mine_mask)
+        return True
+
+    def apply_global_rule(self):
+        """
+        Если все мины найдены, остальные
+        неизвестные ячейки безопасны. (Обратный
+        случай -- все неизвестные ячейки
+        заминированы -- означает, что безопасных
+        ячеек не осталось, и решение уже найдено.)
+        """
+        if self.flagged_count != self.mines_count:
+            return False
+        for idx in range(self.cell_count):
+            if self.known[idx] == self.UNKNOWN:
+                self.open(idx)
+        return True
+
+
+def iter_bits(mask):
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+
+@lru_cache(maxsize=4)
+def get_neighbor_lists(field_type, width, height):
+    adjacency = get_adjacency(field_type, width, height)
+    offsets = adjacency.offsets
+    return tuple(
+        tuple(adjacency.neighbors[offsets[idx]:offsets[idx+1]])
+        for idx in range(len(offsets) - 1)
+    )
+
+
+def get_attempt_seed(seed, attempt):
+    """
+    Зерно попытки attempt -- целое число, как и
+    зерно поля. Первая попытка берёт само seed:
+    поэтому поиск от уже найденного зерна сразу
+    возвращает его же.
+    """
+    if not attempt:
+        return seed
+    return Random('{}/{}'.format(seed, attempt)).getrandbits(63)
+
+
+def is_solvable(field_type, width, height, mines_count, safe_idx, seed):
+    """
+    Генерирует поле так же, как
+    AbstractField.place_mines, и проверяет, что
+    его можно решить от safe_idx без угадывания.
+    """
+    neighbors = get_neighbor_lists(field_type, width, height)
+    excluded = sorted(set(neighbors[safe_idx]) | {safe_idx})
+    mines = bytearray(len(neighbors))
+    sample_mines(mines, mines_count, excluded, Random(seed))
+    mined_around = bytes(
+        sum(mines[neighbor] for neighbor in cell_neighbors)
+        for cell_neighbors in neighbors
+    )
+    solver = Solver(neighbors, mines, mined_around, mines_count)
+    return solver.solve(safe_idx)
+
+
+def find_in_attempts(field_type, width, height, mines_count,
+                     safe_idx, seed, attempts):
+    """
+    Возвращает номер первой попытки из attempts,
+    поле которой решается без угадывания, или None.
+    """
+    for attempt in attempts:
+        if is_solvable(field_type, width, height, mines_count,
+                       safe_idx, get_attempt_seed(seed, attempt)):
+            return attempt
+    return None
+
+
+def find_no_guess_seed(field_type, width, height, mines_count,
+                       safe_idx, seed, max_attempts, workers=0):
+    """
+    Подбирает зерно, с которым поле решается от
+    safe_idx без угадывания. Попытки перебираются
+    по порядку, поэтому результат зависит только
+    от seed, но не от количества процессов.
+
+    Если за max_attempts попыток подходящее поле
+    не найдено, возвращает seed: игра всё равно
+    должна начаться, пусть и с обычным полем.
+
+    Найденное зерно само определяет поле: с ним
+    и той же безопасной ячейкой поле получается
+    таким же и без режима без угадывания (см.
+    AbstractField.place_mines).
+
+    :param workers: количество процессов; 0 --
+        перебирать в текущем процессе.
+    """
+    args = (field_type, width, height, mines_count, safe_idx, seed)
+    if not workers:
+        attempt = find_in_attempts(*args, range(max_attempts))
+    else:
+        attempt = None
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(
+                    find_in_attempts, *args,
+                    range(start, min(start + ATTEMPTS_PER_TASK,
+                                     max_attempts)))
+                for start in range(0, max_attempts, ATTEMPTS_PER_TASK)
+            ]
+            # Результаты разбираются в порядке попыток,
+            # чтобы выбор не зависел от того, какой
+            # процесс справился быстрее.
+            for future in futures:
+                attempt = future.result()
+                if attempt is not None:
+                    break
+            for future in futures:
+                future.cancel()
+
+    if attempt is None:
+        return seed
+    return get_attempt_seed(seed, attempt)
@@ -0,0 +1,153 @@
+"""
+Атлас спрайтов: нарезанные тайлы ячеек в
+формате RGBA и их масштабированные варианты.
+
+Исходный спрайт -- вертикальная полоса
+квадратных тайлов. Декодированные тайлы
+сохраняются в кэш-файл рядом с res/, имя
+которого содержит хэш исходника, поэтому при
+следующем запуске JPEG не декодируется, а
+изменённый спрайт автоматически получает
+новый кэш.
+"""
+import hashlib
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SPRITE_PATH = os.path.join(BASE_DIR, 'res', 'sprite.jpg')
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+
+# Заголовок кэш-файла: сигнатура, сторона
+# тайла и количество тайлов. Дальше идут
+# сжатые zlib пиксели всех тайлов подряд.
+CACHE_HEADER = struct.Struct('<4sHH')
+CACHE_MAGIC = b'MSA1'
+
+
+class SpriteAtlas:
+    def __init__(self, source_path, cache_dir=CACHE_DIR, max_variants=4):
+        """
+        :param source_path: путь к исходному спрайту
+        :param cache_dir: каталог для кэш-файлов;
+            None -- не использовать кэш
+        :param max_variants: сколько масштабированных
+            вариантов держать в памяти одновременно
+        """
+        self.source_path = source_path
+        self.cache_dir = cache_dir
+        self.max_variants = max_variants
+
+        self.tile_side = None
+        self.tiles = None
+        self.variants = OrderedDict()
+        self.load()
+
+    def get_cache_path(self, source):
+        digest = hashlib.sha1(source).hexdigest()[:16]
+        name = '{}-{}.atlas'.format(
+            os.path.splitext(os.path.basename(self.source_path))[0], digest)
+        return os.path.join(self.cache_dir, name)
+
+    def load(self):
+        with open(self.source_path, 'rb') as source_file:
+            source = source_file.read()
+
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = self.get_cache_path(source)
+            if self.read_cache(cache_path):
+                return
+
+        sprite = Image.open(self.source_path).convert('RGBA')
+        side = sprite.size[0]
+        self.set_tiles(side, sprite, sprite.size[1] // side)
+        if cache_path is not None:
+            self.write_cache(cache_path, sprite)
+
+    def set_tiles(self, side, strip, count):
+        self.tile_side = side
+        self.tiles = tuple(
+            strip.crop((0, idx * side, side, (idx+1) * side))
+            for idx in range(count)
+        )
+        self.variants.clear()
+
+    def read_cache(self, cache_path):
+        """
+        Читает тайлы из кэш-файла. Возвращает False,
+        если файла нет или он повреждён.
+        """
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                data = cache_file.read()
+            magic, side, count = CACHE_HEADER.unpack_from(data)
+            if magic != CACHE_MAGIC:
+                return False
+            pixels = zlib.decompress(data[CACHE_HEADER.size:])
+            strip = Image.frombytes('RGBA', (side, side * count), pixels)
+        except (OSError, ValueError, struct.error, zlib.error):
+            return False
+        self.set_tiles(side, strip, count)
+        return True
+
+    def write_cache(self, cache_path, strip):
+        """
+        Записывает кэш через временный файл, чтобы
+        параллельно запущенные процессы не увидели
+        его недописанным. Ошибки записи не мешают
+        игре: в худшем случае спрайт будет
+        декодироваться при каждом запуске.
+        """
+        count = len(self.tiles)
+        strip = strip.crop((0, 0, self.tile_side, self.tile_side * count))
+        data = CACHE_HEADER.pack(CACHE_MAGIC, self.tile_side, count)
+        data += zlib.compress(strip.tobytes())
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
+    def get_tiles(self, side=None):
+        """
+        Возвращает тайлы со стороной side пикселей.
+        Варианты создаются по запросу; если их
+        больше max_variants, дольше всех не
+        использовавшийся вариант выбрасывается.
+        """
+        if side is None or side == self.tile_side:
+            return self.tiles
+
+        tiles = self.variants.get(side)
+        if tiles is not None:
+            self.variants.move_to_end(side)
+            return tiles
+
+        # При уменьшении усреднение (BOX) даёт
+        # меньше "грязи", чем интерполяция.
+        resample = Image.BOX if side < self.tile_side else Image.LANCZOS
+        tiles = tuple(
+            tile.resize((side, side), resample) for tile in self.tiles)
+        self.variants[side] = tiles
+        if len(self.variants) > self.max_variants:
+            self.variants.popitem(last=False)
+        return tiles
+
+
+@lru_cache(maxsize=None)
+def get_atlas(source_path=SPRITE_PATH):
+    """
+    Возвращает общий для всех рендереров
+    атлас спрайта source_path.
+    """
+    return SpriteAtlas(source_path)
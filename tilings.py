@@ -0,0 +1,198 @@
+"""
+Случайное разбиение прямоугольника на ячейки
+Вороного.
+
+Центры ячеек -- "дрожащая" решётка: по одной
+случайной точке в каждом квадрате сетки
+width*height со стороной 1. Это даёт
+случайные многоугольники без слишком мелких
+и слишком крупных ячеек, а сама сетка служит
+пространственным индексом:
+ * любая точка поля лежит не дальше sqrt(2) от
+   центра своего квадрата сетки, поэтому
+   ближайший к ней центр (а значит, и ячейка,
+   в которую она попала) находится в квадратах
+   не дальше двух от неё;
+ * ячейка целиком лежит в круге радиуса
+   sqrt(2) вокруг своего центра, поэтому соседи
+   (ячейки с общей стороной, т.е. рёбра
+   триангуляции Делоне) находятся в квадратах
+   не дальше трёх.
+"""
+from collections import namedtuple
+from functools import lru_cache
+from math import floor, hypot, sqrt
+from random import Random
+
+
+VoronoiTiling = namedtuple(
+    'VoronoiTiling',
+    ('width', 'height', 'points', 'polygons', 'neighbors', 'max_degree'))
+VoronoiTiling.__doc__ = """
+points -- центры ячеек, по одному на квадрат
+сетки, построчно; polygons -- вершины ячеек
+против часовой стрелки (в системе, где y
+растёт вниз, -- по часовой); neighbors --
+отсортированные кортежи индексов соседей;
+max_degree -- наибольшее количество соседей
+ячейки. Все координаты -- в сторонах квадрата сетки.
+"""
+
+# Рёбра короче этого считаются вырожденными:
+# ячейки, касающиеся лишь в точке, не соседи.
+MIN_EDGE_LENGTH = 1e-9
+
+
+def generate_points(width, height, seed):
+    rng = Random('voronoi:{}:{}x{}'.format(seed, width, height))
+    return [
+        (column + rng.random(), row + rng.random())
+        for row in range(height)
+        for column in range(width)
+    ]
+
+
+def clip(polygon, labels, point, other, other_idx):
+    """
+    Отсекает от многоугольника часть, которая
+    ближе к other, чем к point. labels[i] --
+    чья граница лежит на ребре polygon[i] ->
+    polygon[i+1]; новое ребро помечается other_idx.
+    """
+    nx = other[0] - point[0]
+    ny = other[1] - point[1]
+    limit = (nx * (point[0] + other[0]) + ny * (point[1] + other[1])) / 2
+
+    def intersect(start, end, start_side, end_side):
+        t = start_side / (start_side - end_side)
+        return (start[0] + t * (end[0] - start[0]),
+                start[1] + t * (end[1] - start[1]))
+
+    result = []
+    result_labels = []
+    count = len(polygon)
+    for i in range(count):
+        start = polygon[i]
+        end = polygon[(i + 1) % count]
+        start_side = nx * start[0] + ny * start[1] - limit
+        end_side = nx * end[0] + ny * end[1] - limit
+        if start_side <= 0:
+            result.append(start)
+            result_labels.append(labels[i])
+            if end_side > 0:
+                # Ребро выходит из полуплоскости: дальше
+                # до точки входа идёт новая граница.
+                result.append(intersect(start, end, start_side, end_side))
+                result_labels.append(other_idx)
+        elif end_side <= 0:
+            result.append(intersect(start, end, start_side, end_side))
+            result_labels.append(labels[i])
+    return result, result_labels
+
+
+def build_cell(points, width, height, idx):
+    """
+    Строит многоугольник ячейки idx и находит
+    её соседей.
+    """
+    point = points[idx]
+    row, column = divmod(idx, width)
+    # Ячейка лежит в круге радиуса sqrt(2) вокруг
+    # центра, поэтому начинать можно с квадрата
+    # чуть больше этого круга, обрезанного полем.
+    left = max(point[0] - 1.5, 0)
+    top = max(point[1] - 1.5, 0)
+    right = min(point[0] + 1.5, width)
+    bottom = min(point[1] + 1.5, height)
+    polygon = [(left, top), (right, top), (right, bottom), (left, bottom)]
+    labels = [-1] * 4
+
+    candidates = []
+    for other_row in range(max(row - 3, 0), min(row + 4, height)):
+        for other_column in range(max(column - 3, 0), min(column + 4, width)):
+            other_idx = other_row * width + other_column
+            if other_idx == idx:
+                continue
+            other = points[other_idx]
+            distance = hypot(other[0] - point[0], other[1] - point[1])
+            if distance <= 2 * sqrt(2):
+                candidates.append((distance, other_idx))
+    candidates.sort()
+
+    for distance, other_idx in candidates:
+        # Граница с other проходит на расстоянии
+        # distance / 2 от центра; если многоугольник
+        # целиком ближе, она (и все следующие, более
+        # дальние) его уже не задевает.
+        squared_radius = max(
+            (x - point[0]) ** 2 + (y - point[1]) ** 2 for x, y in polygon)
+        if distance * distance / 4 >= squared_radius:
+            break
+        polygon, labels = clip(
+            polygon, labels, point, points[other_idx], other_idx)
+
+    neighbors = set()
+    count = len(polygon)
+    for i, label in enumerate(labels):
+        if label < 0:
+            continue
+        start = polygon[i]
+        end = polygon[(i + 1) % count]
+        if hypot(end[0] - start[0], end[1] - start[1]) > MIN_EDGE_LENGTH:
+            neighbors.add(label)
+    return tuple(polygon), neighbors
+
+
+@lru_cache(maxsize=2)
+def build_voronoi_tiling(width, height, seed=0):
+    """
+    Строит разбиение. Результат зависит только
+    от аргументов и кэшируется: его используют
+    и поле, и таблица соседства, и решатель.
+    """
+    points = generate_points(width, height, seed)
+    polygons = []
+    neighbor_sets = []
+    for idx in range(width * height):
+        polygon, neighbors = build_cell(points, width, height, idx)
+        polygons.append(polygon)
+        neighbor_sets.append(neighbors)
+
+    # Из-за погрешностей вычислений вырожденное
+    # ребро может найтись только у одной из двух
+    # ячеек; соседство должно быть симметричным.
+    for idx, neighbors in enumerate(neighbor_sets):
+        for other_idx in neighbors:
+            neighbor_sets[other_idx].add(idx)
+
+    return VoronoiTiling(
+        width, height, points, polygons,
+        [tuple(sorted(neighbors)) for neighbors in neighbor_sets],
+        max(map(len, neighbor_sets), default=0))
+
+
+def find_cell(tiling, x, y):
+    """
+    Возвращает индекс ячейки, в которую попала
+    точка (x, y), или None, если точка вне поля.
+    Ближайший центр ищется только в квадратах
+    сетки не дальше двух от точки.
+    """
+    if not (0 <= x < tiling.width and 0 <= y < tiling.height):
+        return None
+    row = floor(y)
+    column = floor(x)
+    points = tiling.points
+    width = tiling.width
+    nearest_idx = None
+    nearest_distance = None
+    for other_row in range(max(row - 2, 0), min(row + 3, tiling.height)):
+        row_start = other_row * width
+        for other_column in range(max(column - 2, 0), min(column + 3, width)):
+            idx = row_start + other_column
+            point = points[idx]
+            distance = (point[0] - x) ** 2 + (point[1] - y) ** 2
+            if nearest_distance is None or distance < nearest_distance:
+                nearest_idx = idx
+                nearest_distance = distance
+    return nearest_idx
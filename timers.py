@@ -0,0 +1,123 @@
+"""
+Счётчики времени игры.
+
+Время отсчитывается по монотонным часам
+(time.monotonic), которые не прыгают при
+переводе системных часов. Таймер сам никого не
+будит: он лишь сообщает, через сколько секунд
+изменится показываемое на табло значение
+(get_display_delay), поэтому табло можно
+обновлять ровно тогда, когда это нужно, а
+после окончания игры не обновлять вовсе.
+"""
+import time
+from math import ceil, floor
+
+
+class GameTimer:
+    """
+    Прямой отсчёт: табло показывает время игры,
+    округлённое до секунды.
+    """
+    # Время на игру в секундах; 0 -- не ограничено.
+    limit = 0
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: функция, возвращающая текущее
+            время в секундах
+        """
+        self.clock = clock
+        self.start_clock = None
+        self.stop_clock = None
+
+    @property
+    def started(self):
+        return self.start_clock is not None
+
+    @property
+    def running(self):
+        return self.start_clock is not None and self.stop_clock is None
+
+    def start(self):
+        if self.start_clock is None:
+            self.start_clock = self.clock()
+
+    def stop(self):
+        if self.running:
+            self.stop_clock = self.clock()
+
+    def get_elapsed(self):
+        """
+        Возвращает время игры в секундах.
+        """
+        if self.start_clock is None:
+            return 0.0
+        if self.stop_clock is None:
+            return self.clock() - self.start_clock
+        return self.stop_clock - self.start_clock
+
+    def set_elapsed(self, elapsed, started=True, running=True):
+        """
+        Переводит таймер так, чтобы прошло elapsed
+        секунд игры, например при загрузке
+        сохранённой игры.
+        """
+        if not started:
+            self.start_clock = self.stop_clock = None
+            return
+        now = self.clock()
+        self.start_clock = now - elapsed
+        self.stop_clock = None if running else now
+
+    def get_state(self):
+        return self.start_clock, self.stop_clock
+
+    def set_state(self, state):
+        self.start_clock, self.stop_clock = state
+
+    def get_display(self):
+        return int(0.5 + self.get_elapsed())
+
+    def get_display_delay(self):
+        """
+        Возвращает, через сколько секунд изменится
+        get_display, или None, если таймер стоит.
+        """
+        if not self.running:
+            return None
+        elapsed = self.get_elapsed()
+        return floor(elapsed + 0.5) + 0.5 - elapsed
+
+    def is_expired(self):
+        return False
+
+
+class CountdownTimer(GameTimer):
+    """
+    Обратный отсчёт: табло показывает, сколько
+    секунд осталось из limit. Когда время
+    истекает, игра проиграна (см.
+    GameManager.update_timer).
+    """
+    def __init__(self, limit, clock=time.monotonic):
+        """
+        :param limit: время на игру в секундах
+        """
+        super().__init__(clock)
+        self.limit = limit
+
+    def get_remaining(self):
+        return max(self.limit - self.get_elapsed(), 0.0)
+
+    def get_display(self):
+        return ceil(self.get_remaining())
+
+    def get_display_delay(self):
+        if not self.running:
+            return None
+        remaining = self.get_remaining()
+        return max(remaining - (ceil(remaining) - 1), 0.0)
+
+    def is_expired(self):
+        return self.running and self.get_elapsed() >= self.limit
@@ -1,5 +1,8 @@
 import os.path
+import queue
+import time
 import tkinter as tk
+import tkinter.messagebox
 from functools import partial
 from abc import abstractmethod
 from collections import namedtuple
@@ -8,7 +11,9 @@ from PIL import Image, ImageTk
 
 from api import FieldParams
 from game_managers import LevelEnum
-from renderers import TkRenderContext
+from hints import HintEngine, supports_hints
+from renderers import CompositingRenderContext, TkRenderContext
+from viewports import Viewport
 
 
 class Window:
@@ -16,6 +21,10 @@ class Window:
         self.game_manager = None
         self.render_context = self.create_render_context()
 
+        # Значения, показанные на табло в последний
+        # раз (см. update_board).
+        self.board_info = None
+
     @abstractmethod
     def create_render_context(self):
         pass
@@ -28,14 +37,36 @@ class Window:
     def _update_board(self, time_info, mines_info, game_active, user_won):
         pass
 
+    @abstractmethod
+    def schedule_board_update(self, delay):
+        """
+        Просит вызвать update_board через delay
+        секунд, отменяя предыдущую просьбу. Если
+        delay равно None, вызывать не нужно.
+        """
+
     def update_board(self):
-        if self.game_manager is not None:
-            self._update_board(
-                self.game_manager.get_time_info(),
-                self.game_manager.get_mines_info(),
-                self.game_manager.game_active,
-                self.game_manager.user_won,
-            )
+        """
+        Обновляет табло, если изменилось что-то из
+        показанного на нём, и планирует следующее
+        обновление на момент, когда сменится
+        секунда. Вызывается после каждого действия
+        пользователя; когда время стоит, табло
+        больше ничего не стоит.
+        """
+        if self.game_manager is None:
+            return
+        self.game_manager.update_timer()
+        board_info = (
+            self.game_manager.get_time_info(),
+            self.game_manager.get_mines_info(),
+            self.game_manager.game_active,
+            self.game_manager.user_won,
+        )
+        if board_info != self.board_info:
+            self.board_info = board_info
+            self._update_board(*board_info)
+        self.schedule_board_update(self.game_manager.get_time_info_delay())
 
     def get_render_context(self):
         return self.render_context
@@ -45,13 +76,48 @@ LabeledWidget = namedtuple('LabeledWidget', ('label', 'widget'))
 
 
 class TkWindow(Window):
-    def __init__(self):
+    # Доступные размеры ячеек при масштабировании
+    # и шаг прокрутки в ячейках.
+    cell_sides = (8, 12, 16, 24, 32)
+    scroll_step = 3
+
+    # Сколько ходов можно отменить в режиме
+    # тренировки (Practice).
+    practice_undo_depth = 1000
+
+    # Время на игру в режиме обратного отсчёта
+    # (Countdown), в секундах.
+    countdown_seconds = 300
+
+    # Сколько лучших результатов показывать.
+    records_count = 10
+
+    def __init__(self, compositing=False):
+        """
+        :param compositing: рисовать поле одним
+            изображением (CompositingRenderContext)
+            вместо отдельного элемента канвы на
+            каждую ячейку
+        """
+        self.compositing = compositing
         self.font = ('arial', 8)
         self._create_widgets()
         self.level_radio_buttons = None
+
+        # Подсказки считаются в фоновом потоке и
+        # передаются в поток Tk через очередь.
+        self.hints = queue.Queue()
+        self.hint_engine = HintEngine(self.publish_hint)
+        self.hint_text = ''
+        # Отложенный опрос готовых подсказок (см.
+        # poll_hints) или None.
+        self.hint_poll_job = None
+        self.board_update_job = None
         super().__init__()
 
     def create_render_context(self):
+        if self.compositing:
+            return CompositingRenderContext(self.canvas)
         return TkRenderContext(self.canvas)
 
     def _update_board(self, time_info, mines_info, game_active, user_won):
@@ -63,12 +129,25 @@ class TkWindow(Window):
         else:
             win_info = ''
 
-        board_label_text = '{:03d}; Time: {:03d}\t{}'.format(
-            mines_info, time_info, win_info)
+        board_label_text = '{:03d}; Time: {:03d}\t{}{}'.format(
+            mines_info, time_info, win_info, self.hint_text)
         self.board_label.configure(
             text=board_label_text
         )
-        self.root.after(500, self.update_board)
+
+    def schedule_board_update(self, delay):
+        if self.board_update_job is not None:
+            self.root.after_cancel(self.board_update_job)
+            self.board_update_job = None
+        if delay is not None:
+            # Запас в миллисекунду, чтобы не проснуться
+            # чуть раньше смены секунды.
+            self.board_update_job = self.root.after(
+                int(delay * 1000) + 1, self.on_board_timer)
+
+    def on_board_timer(self):
+        self.board_update_job = None
+        self.update_board()
 
     def _set_icon(self):
         icon_path = os.path.join(
@@ -92,6 +171,41 @@ class TkWindow(Window):
             self.left_frame, text='New Game', font=self.font, padx=5)
         self.new_game_button.pack(anchor='nw', side='top')
 
+        self.hint_button = tk.Button(
+            self.left_frame, text='Hint', font=self.font, padx=5)
+        self.hint_button.pack(anchor='nw', side='top')
+
+        self.undo_button = tk.Button(
+            self.left_frame, text='Undo', font=self.font, padx=5)
+        self.undo_button.pack(anchor='nw', side='top')
+
+        self.redo_button = tk.Button(
+            self.left_frame, text='Redo', font=self.font, padx=5)
+        self.redo_button.pack(anchor='nw', side='top')
+
+        self.records_button = tk.Button(
+            self.left_frame, text='Records', font=self.font, padx=5)
+        self.records_button.pack(anchor='nw', side='top')
+
+        self.practice_intvar = tk.IntVar()
+        self.practice_button = tk.Checkbutton(
+            self.left_frame, text='Practice', font=self.font,
+            variable=self.practice_intvar)
+        self.practice_button.pack(anchor='nw', side='top')
+
+        self.countdown_intvar = tk.IntVar()
+        self.countdown_button = tk.Checkbutton(
+            self.left_frame, text='Countdown', font=self.font,
+            variable=self.countdown_intvar)
+        self.countdown_button.pack(anchor='nw', side='top')
+
+        self.geometry_stringvar = tk.StringVar(value='rectangle')
+        self.geometry_menu = tk.OptionMenu(
+            self.left_frame, self.geometry_stringvar,
+            'rectangle', 'hexagonal', 'voronoi')
+        self.geometry_menu.configure(font=self.font)
+        self.geometry_menu.pack(anchor='nw', side='top')
+
         self._create_level_group()
         self._create_custom_group()
 
@@ -152,9 +266,18 @@ class TkWindow(Window):
     def bind_manager(self, game_manager):
         self.game_manager = game_manager
         self.new_game_button.configure(command=self.on_new_game_clicked)
-        self.canvas.bind('<Button-1>', game_manager.mouse_click)
-        self.canvas.bind('<Button-2>', game_manager.mouse_click)
-        self.canvas.bind('<Button-3>', game_manager.mouse_click)
+        self.hint_button.configure(command=self.on_hint_clicked)
+        self.undo_button.configure(command=self.on_undo_clicked)
+        self.redo_button.configure(command=self.on_redo_clicked)
+        self.records_button.configure(command=self.on_records_clicked)
+        self.root.bind('<Control-z>', lambda event: self.on_undo_clicked())
+        self.root.bind('<Control-y>', lambda event: self.on_redo_clicked())
+        self.root.bind('<F12>', lambda event: self.toggle_profiling())
+        self.canvas.bind('<Button-1>', self.on_canvas_click)
+        self.canvas.bind('<Button-2>', self.on_canvas_click)
+        self.canvas.bind('<Button-3>', self.on_canvas_click)
+        self._bind_scrolling()
+        game_manager.set_viewport(Viewport(*self.get_max_view_size()))
 
         radio_button_fabric = partial(
             tk.Radiobutton,
@@ -175,6 +298,77 @@ class TkWindow(Window):
             for v in LevelEnum
         )
 
+    def get_max_view_size(self):
+        """
+        Окно просмотра занимает экран за вычетом
+        левой панели и заголовка.
+        """
+        self.root.update_idletasks()
+        return (
+            self.root.winfo_screenwidth()
+            - self.left_frame.winfo_reqwidth() - 40,
+            self.root.winfo_screenheight()
+            - self.board_label.winfo_reqheight() - 120,
+        )
+
+    def _bind_scrolling(self):
+        # Колесо мыши: в X11 приходит как кнопки
+        # 4 и 5, в остальных системах -- как
+        # <MouseWheel> с event.delta.
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.canvas.bind(sequence, self.on_mouse_wheel)
+        self.root.bind('<Left>', partial(self.on_scroll_key, -1, 0))
+        self.root.bind('<Right>', partial(self.on_scroll_key, 1, 0))
+        self.root.bind('<Up>', partial(self.on_scroll_key, 0, -1))
+        self.root.bind('<Down>', partial(self.on_scroll_key, 0, 1))
+        self.root.bind('<plus>', partial(self.on_zoom_key, 1))
+        self.root.bind('<equal>', partial(self.on_zoom_key, 1))
+        self.root.bind('<minus>', partial(self.on_zoom_key, -1))
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            direction = -1
+        else:
+            direction = 1
+
+        if event.state & 0x0004:
+            # Ctrl + колесо -- масштаб вокруг курсора
+            self.zoom(-direction, (event.x, event.y))
+        elif event.state & 0x0001:
+            # Shift + колесо -- горизонтальная прокрутка
+            self.scroll(direction, 0)
+        else:
+            self.scroll(0, direction)
+
+    def on_scroll_key(self, dx, dy, event):
+        self.scroll(dx, dy)
+
+    def on_zoom_key(self, direction, event):
+        self.zoom(direction)
+
+    def scroll(self, dx, dy):
+        width, height = self.game_manager.field.renderer.cell_size
+        step = self.scroll_step
+        self.game_manager.scroll(dx * width * step, dy * height * step)
+        self.update_profile_overlay()
+
+    def zoom(self, direction, pixel=(0, 0)):
+        side = self.game_manager.field.renderer.cell_size[0]
+        sides = self.cell_sides
+        if direction > 0:
+            larger = [s for s in sides if s > side]
+            if not larger:
+                return
+            side = larger[0]
+        else:
+            smaller = [s for s in sides if s < side]
+            if not smaller:
+                return
+            side = smaller[-1]
+        self.clear_hint()
+        self.game_manager.zoom(side, pixel)
+        self.update_profile_overlay()
+
     def change_level(self):
         # TODO: должен обновлять виджеты
         # кастомных параметров в соответствии
@@ -187,7 +381,143 @@ class TkWindow(Window):
                 int(e.widget.get())
                 for e in self.custom_params_editors
             ))
+            self.game_manager.geometry = self.geometry_stringvar.get()
+            self.game_manager.undo_depth = (
+                self.practice_undo_depth if self.practice_intvar.get() else 0)
+            self.game_manager.countdown = (
+                self.countdown_seconds if self.countdown_intvar.get() else 0)
             self.game_manager.new_game(self.level_intvar.get(), custom_params)
+            self.hint_button.configure(
+                state='normal' if supports_hints(self.game_manager.field)
+                else 'disabled')
+            self.update_board()
+
+    def on_canvas_click(self, event):
+        start = time.perf_counter()
+        self.clear_hint()
+        self.game_manager.mouse_click(event)
+        self.update_board()
+        profiler = self.game_manager.profiler
+        if profiler is not None:
+            # Задержка считается до конца перерисовки
+            # канвы, которую Tk иначе отложил бы.
+            self.root.update_idletasks()
+            profiler.record_latency(time.perf_counter() - start)
+            self.update_profile_overlay()
+
+    def on_undo_clicked(self):
+        self.clear_hint()
+        self.game_manager.undo()
+        self.update_board()
+
+    def on_redo_clicked(self):
+        self.clear_hint()
+        self.game_manager.redo()
+        self.update_board()
+
+    def on_records_clicked(self):
+        """
+        Показывает лучшие результаты на поле
+        текущей игры.
+        """
+        results = self.game_manager.results
+        if results is None:
+            tkinter.messagebox.showinfo(
+                'Records', 'Results are not stored (see --results)')
+            return
+        game_manager = self.game_manager
+        results.flush()
+        records = results.get_leaderboard(
+            game_manager.level, game_manager.field_params,
+            game_manager.get_geometry(),
+            game_manager.player, self.records_count)
+        lines = [
+            '{}. {:.1f} s, {} moves, 3BV {}'.format(
+                place, record.elapsed, record.moves, record.bbbv)
+            for place, record in enumerate(records, 1)
+        ]
+        tkinter.messagebox.showinfo(
+            'Records', '\n'.join(lines) or 'No wins yet')
+
+    def on_hint_clicked(self):
+        if (self.game_manager and self.game_manager.game_active
+                and supports_hints(self.game_manager.field)):
+            self.clear_hint()
+            self.hint_engine.request(self.game_manager.field)
+            if self.hint_poll_job is None:
+                self.hint_poll_job = self.root.after(50, self.poll_hints)
+
+    def publish_hint(self, snapshot, hint):
+        """
+        Вызывается из потока подсказок.
+        """
+        self.hints.put((snapshot, hint))
+
+    def poll_hints(self):
+        """
+        Забирает готовые подсказки. Опрос идёт только
+        пока подсказка считается, в остальное время
+        он ничего не стоит.
+        """
+        self.hint_poll_job = None
+        try:
+            snapshot, hint = self.hints.get_nowait()
+        except queue.Empty:
+            snapshot = None
+        if self.hint_engine.is_busy() or not self.hints.empty():
+            # Есть ещё запросы: поле могли изменить и
+            # попросить новую подсказку.
+            self.hint_poll_job = self.root.after(50, self.poll_hints)
+        if snapshot is None:
+            return
+
+        field = self.game_manager.field
+        if (snapshot.field_id != id(field)
+                or snapshot.statuses != bytes(field.state.statuses)
+                or hint.safest_idx is None):
+            # Подсказка устарела: поле изменилось,
+            # пока она считалась.
+            return
+        self.show_hint(field, hint)
+
+    def show_hint(self, field, hint):
+        self.canvas.create_rectangle(
+            *field.renderer.get_cell_box(field, hint.safest_idx),
+            outline='red', width=2, tags='hint')
+        self.hint_text = '\tHint: {:.0%} mine'.format(
+            hint.safest_probability)
+        self.board_info = None
+        self.update_board()
+
+    def clear_hint(self):
+        self.canvas.delete('hint')
+        if self.hint_text:
+            self.hint_text = ''
+            self.board_info = None
+            self.update_board()
+
+    def toggle_profiling(self):
+        """
+        Включает и выключает профилирование вместе с
+        отладочным оверлеем (F12).
+        """
+        if self.game_manager.profiler is None:
+            self.game_manager.enable_profiling()
+        else:
+            self.game_manager.disable_profiling()
+        self.update_profile_overlay()
+
+    def update_profile_overlay(self):
+        self.canvas.delete('profile')
+        profiler = self.game_manager.profiler
+        if profiler is None:
+            return
+        # Канва прокручивается, поэтому оверлей
+        # ставится в левый верхний угол видимой части.
+        self.canvas.create_text(
+            self.canvas.canvasx(4), self.canvas.canvasy(4),
+            text=profiler.format_summary() or 'Profiling...',
+            anchor='nw', fill='blue', font=self.font, tags='profile')
 
     def run(self):
         self.root.after(0, self.update_board)
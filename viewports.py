@@ -0,0 +1,47 @@
+class Viewport:
+    """
+    Окно просмотра: видимая часть рисунка поля.
+    Рисуются только ячейки, попавшие в окно, и
+    margin ячеек вокруг него, поэтому стоимость
+    отрисовки зависит от размера экрана, а не
+    от размера поля.
+    """
+    def __init__(self, width, height, margin=4):
+        """
+        :param width: ширина окна в пикселях
+        :param height: высота окна в пикселях
+        :param margin: запас в ячейках с каждой
+            стороны окна; пока окно прокручивается
+            в его пределах, ячейки не перерисовываются
+        """
+        # Пиксель рисунка поля, который виден в
+        # левом верхнем углу окна.
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+        self.margin = margin
+
+    def get_view_size(self, canvas_size):
+        """
+        Возвращает размер видимой области: окно
+        не бывает больше рисунка поля.
+        """
+        return (min(self.width, canvas_size[0]),
+                min(self.height, canvas_size[1]))
+
+    def to_canvas_pixel(self, pixel):
+        """
+        Переводит пиксель окна в пиксель рисунка
+        поля.
+        """
+        return pixel[0] + self.x, pixel[1] + self.y
+
+    def move_to(self, x, y, canvas_size):
+        """
+        Прокручивает окно так, чтобы в левом верхнем
+        углу оказался пиксель (x, y), не выходя за
+        пределы рисунка поля размера canvas_size.
+        """
+        self.x = max(0, min(x, canvas_size[0] - self.width))
+        self.y = max(0, min(y, canvas_size[1] - self.height))